@@ -0,0 +1,79 @@
+# Compares running a pybi in place (see run_in_place.py) with unpacking all of it:
+# how long each takes to set up, how long the first `python -c "import asyncio, json,
+# ssl"` takes right after that and the median over more runs, and how much disk each
+# uses: for the tree itself, for everything that has to stay afterwards (an unpacked
+# pybi can be deleted, but a stub needs its pybi), and at the peak during setup (the
+# downloaded pybi plus the tree, either way).
+#
+#   python3 bench-run-in-place.py built/cpython_unofficial-3.11.7-macosx_11_0_arm64.pybi
+#
+# The pybi has to be made with make_pybi(compile_bytecode=True, run_in_place=True), so
+# both sides have the same pycs to load.
+
+import argparse
+import importlib
+import os
+import statistics
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from pybi import read_chunks, unpack_pybi
+from run_in_place import make_stub
+
+# Same workload and timing as bench-startup.py
+bench_startup = importlib.import_module("bench-startup")
+IMPORTS = bench_startup.IMPORTS
+
+
+def disk_usage(path):
+    # Like du: allocated blocks, not file sizes, and symlinks aren't followed
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            total += os.lstat(os.path.join(dirpath, name)).st_blocks * 512
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("pybi")
+    parser.add_argument("-n", "--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    pybi_size = os.stat(args.pybi).st_size
+    # Read it once up front, so whichever setup runs first doesn't pay for the cold
+    # page cache
+    with open(args.pybi, "rb") as f:
+        for _ in read_chunks(f):
+            pass
+    # (label, setup function, whether the pybi has to be kept)
+    setups = [("unpacked", unpack_pybi, False), ("in place", make_stub, True)]
+    results = {}
+    with TemporaryDirectory() as tempdir:
+        for label, setup, keeps_pybi in setups:
+            base_path = Path(tempdir) / label
+            start = time.perf_counter()
+            setup(args.pybi, base_path, jobs=os.cpu_count())
+            setup_seconds = time.perf_counter() - start
+            python_path = bench_startup.find_python(base_path)
+            first = bench_startup.time_startup(python_path, 1)[0]
+            times = bench_startup.time_startup(python_path, args.runs)
+            usage = disk_usage(base_path)
+            kept = usage + pybi_size if keeps_pybi else usage
+            results[label] = (setup_seconds, first, times, usage, kept)
+
+    print(f"{IMPORTS!r}, {args.runs} runs, with a {pybi_size / 2 ** 20:.1f} MiB pybi:")
+    for label, (setup_seconds, first, times, usage, kept) in results.items():
+        median = statistics.median(times)
+        peak = usage + pybi_size
+        print(
+            f"  {label:>8}: setup {setup_seconds:5.2f} s, first run "
+            f"{first * 1000:6.1f} ms, median {median * 1000:6.1f} ms, "
+            f"min {min(times) * 1000:6.1f} ms; disk: tree {usage / 2 ** 20:5.1f} MiB, "
+            f"kept {kept / 2 ** 20:5.1f} MiB, peak {peak / 2 ** 20:5.1f} MiB"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# Measures what precompiled stdlib bytecode (make_pybi(compile_bytecode=True)) buys
+# at startup: unpacks a pybi twice, once as-is and once with all the pycs removed, and
+# times cold `python -c "import asyncio, json, ssl"` in each. Bytecode writing is
+# disabled, so the no-pyc copy behaves like a read-only install and pays the compile
+# cost on every run.
+#
+#   python3 bench-startup.py built/cpython_unofficial-3.9.6-manylinux_2_17_x86_64.pybi
+
+import argparse
+import email
+import json
+import os
+import statistics
+import subprocess
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from pybi import unpack_pybi
+
+IMPORTS = "import asyncio, json, ssl"
+
+
+def find_python(base_path):
+    metadata = email.message_from_bytes(
+        (base_path / "pybi-info" / "METADATA").read_bytes()
+    )
+    scripts_path = base_path / json.loads(metadata["Pybi-Paths"])["scripts"]
+    for name in ["python.exe", "python"]:
+        if (scripts_path / name).exists():
+            return scripts_path / name
+    raise RuntimeError(f"can't find python in {scripts_path}")
+
+
+def time_startup(python_path, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([python_path, "-I", "-B", "-c", IMPORTS], check=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("pybi")
+    parser.add_argument("-n", "--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as tempdir:
+        with_path = Path(tempdir) / "with-pyc"
+        without_path = Path(tempdir) / "without-pyc"
+        unpack_pybi(args.pybi, with_path, jobs=os.cpu_count())
+        unpack_pybi(args.pybi, without_path, jobs=os.cpu_count())
+        removed = 0
+        for path in without_path.rglob("*.pyc"):
+            path.unlink()
+            removed += 1
+        if not removed:
+            print("Warning: this pybi has no .pyc files, both runs will be the same")
+
+        results = {}
+        for label, base_path in [("without pyc", without_path), ("with pyc", with_path)]:
+            python_path = find_python(base_path)
+            # One untimed run to warm up the OS page cache
+            time_startup(python_path, 1)
+            results[label] = time_startup(python_path, args.runs)
+
+    print(f"{IMPORTS!r}, {args.runs} runs:")
+    for label, times in results.items():
+        print(
+            f"  {label:>12}: median {statistics.median(times) * 1000:.1f} ms, "
+            f"min {min(times) * 1000:.1f} ms"
+        )
+    speedup = statistics.median(results["without pyc"]) / statistics.median(
+        results["with pyc"]
+    )
+    print(f"  speedup: {speedup:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
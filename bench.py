@@ -0,0 +1,331 @@
+# Benchmarks for the slow parts of the pipeline, run against synthetic inputs so the
+# numbers are comparable between machines and over time:
+#
+#   pack: pack_pybi over a generated interpreter tree (thousands of small .py files,
+#       a few large binaries, symlinks, and scripts with absolute #! lines for
+#       fixup_shebang to rewrite)
+#   index: regen-simple.py over a built/ directory of generated pybis, both from
+#       scratch and with an up-to-date manifest
+#   elf: linux_vendor's ELF scan and repair planning over a tree of shared libraries
+#       compiled with cc (skipped if there's no cc, or auditwheel isn't importable)
+#
+# Each benchmark runs in a fresh process, so its peak RSS is its own. Results are
+# printed as JSON, and written to --output if given.
+#
+#   python3 bench.py --output bench-results.json
+
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from pybi import pack_pybi
+
+REPO_PATH = Path(__file__).resolve().parent
+PYTHON_DIR = "lib/python3.99"
+
+
+def peak_rss(who="self"):
+    import resource
+
+    usage = resource.getrusage(
+        resource.RUSAGE_SELF if who == "self" else resource.RUSAGE_CHILDREN
+    )
+    # Bytes on macOS, KiB everywhere else
+    if sys.platform == "darwin":
+        return usage.ru_maxrss
+    return usage.ru_maxrss * 1024
+
+
+def fake_source(rng, size):
+    # Compresses roughly like real Python source
+    chunks = []
+    total = 0
+    while total < size:
+        n = rng.randrange(1000)
+        chunk = (
+            f"def function_{n}(value, *, factor={rng.randrange(10)}):\n"
+            f"    # Scale value by factor, then offset it by {n}\n"
+            f"    return value * factor + {n}\n\n\n"
+        )
+        chunks.append(chunk)
+        total += len(chunk)
+    return "".join(chunks)
+
+
+def fake_binary(rng, size):
+    # Half random bytes, half runs of repeated bytes, so it deflates to roughly the
+    # same ratio as real shared libraries (~40%)
+    out = bytearray()
+    while len(out) < size:
+        out += rng.getrandbits(64 * 8).to_bytes(64, "little")
+        out += bytes([rng.randrange(256)]) * 64
+    return bytes(out[:size])
+
+
+def write_metadata(base_path, version):
+    pybi_info_path = base_path / "pybi-info"
+    pybi_info_path.mkdir(parents=True, exist_ok=True)
+    (pybi_info_path / "METADATA").write_text(
+        "Metadata-Version: 2.2\n"
+        "Name: cpython_unofficial\n"
+        f"Version: {version}\n"
+        'Pybi-Paths: {"stdlib": "lib/python3.99", "scripts": "bin"}\n'
+    )
+    (pybi_info_path / "PYBI").write_text(
+        "Pybi-Version: 1.0\nGenerator: bench.py\nTag: bench_x86_64\n"
+    )
+
+
+# Returns (file count, total bytes)
+def make_tree(
+    base_path, *, files, binaries, binary_size, scripts, seed=0, version="3.99.0"
+):
+    rng = random.Random(seed)
+    count = 0
+    total = 0
+
+    def write(path, data, mode=0o644):
+        nonlocal count, total
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        path.write_bytes(data)
+        path.chmod(mode)
+        count += 1
+        total += len(data)
+
+    write_metadata(base_path, version)
+    bin_path = base_path / "bin"
+    write(bin_path / "python3.99", fake_binary(rng, 64 * 1024), 0o755)
+    (bin_path / "python3").symlink_to("python3.99")
+    (bin_path / "python").symlink_to("python3")
+
+    for i in range(files):
+        size = int(rng.lognormvariate(8.5, 1))
+        path = base_path / PYTHON_DIR / f"pkg{i % 50}" / f"mod{i}.py"
+        write(path, fake_source(rng, size))
+
+    for i in range(binaries):
+        lib_path = base_path / "lib" / f"libbench{i}.so.1.0"
+        write(lib_path, fake_binary(rng, binary_size), 0o755)
+        (base_path / "lib" / f"libbench{i}.so").symlink_to(lib_path.name)
+
+    for i in range(scripts):
+        # Absolute #! lines, like the CPython build system writes
+        write(
+            bin_path / f"script{i}",
+            f"#!{bin_path / 'python3.99'}\nimport sys\nsys.exit(0)\n",
+            0o755,
+        )
+    return count, total
+
+
+def bench_pack(params, workdir):
+    base_path = workdir / "tree"
+    start = time.perf_counter()
+    file_count, total = make_tree(
+        base_path,
+        files=params["files"],
+        binaries=params["binaries"],
+        binary_size=params["binary_size"],
+        scripts=params["scripts"],
+    )
+    generate_seconds = time.perf_counter() - start
+
+    pybi_path = workdir / "bench.pybi"
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    pack_pybi(base_path, pybi_path, "bin", jobs=params["jobs"])
+    seconds = time.perf_counter() - start
+    cpu_seconds = time.process_time() - cpu_start
+    return {
+        "files": file_count,
+        "input_bytes": total,
+        "output_bytes": pybi_path.stat().st_size,
+        "generate_seconds": generate_seconds,
+        "seconds": seconds,
+        "cpu_seconds": cpu_seconds,
+        "mb_per_second": total / 1e6 / seconds,
+        "files_per_second": file_count / seconds,
+    }
+
+
+def bench_index(params, workdir):
+    built_path = workdir / "built"
+    built_path.mkdir()
+    for i in range(params["archives"]):
+        base_path = workdir / f"tree{i}"
+        make_tree(
+            base_path,
+            files=params["index_files"],
+            binaries=1,
+            binary_size=params["index_binary_size"],
+            scripts=2,
+            seed=i,
+            version=f"3.99.{i}",
+        )
+        pack_pybi(
+            base_path,
+            built_path / f"cpython_unofficial-3.99.{i}-bench_x86_64.pybi",
+            "bin",
+            jobs=params["jobs"],
+        )
+        shutil.rmtree(base_path)
+    archive_bytes = sum(p.stat().st_size for p in built_path.glob("*.pybi"))
+
+    def regen():
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, REPO_PATH / "regen-simple.py"],
+            cwd=workdir,
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        return time.perf_counter() - start
+
+    cold_seconds = regen()
+    warm_seconds = regen()
+    return {
+        "archives": params["archives"],
+        "archive_bytes": archive_bytes,
+        "cold_seconds": cold_seconds,
+        "warm_seconds": warm_seconds,
+        "child_peak_rss": peak_rss("children"),
+    }
+
+
+ELF_SOURCE = """
+extern int bench_ext(int);
+int bench_{i}(int x) {{ return bench_ext(x) + {i}; }}
+"""
+
+
+def bench_elf(params, workdir):
+    cc = shutil.which("cc")
+    if cc is None:
+        return {"skipped": "no cc"}
+    try:
+        from linux_vendor import get_tree_elfdata, plan_repair
+    except ImportError as exc:
+        return {"skipped": f"can't import linux_vendor: {exc}"}
+
+    # One library outside the tree, so repair planning has something to graft
+    ext_path = workdir / "ext"
+    ext_path.mkdir()
+    (ext_path / "ext.c").write_text("int bench_ext(int x) { return x * 2; }\n")
+    subprocess.run(
+        [cc, "-shared", "-fPIC", "-o", ext_path / "libbenchext.so", ext_path / "ext.c"],
+        check=True,
+    )
+
+    base_path = workdir / "tree"
+    lib_path = base_path / "lib"
+    lib_path.mkdir(parents=True)
+    start = time.perf_counter()
+    for i in range(params["elf_libs"]):
+        c_path = workdir / f"lib{i}.c"
+        c_path.write_text(ELF_SOURCE.format(i=i))
+        subprocess.run(
+            [
+                cc, "-shared", "-fPIC", "-g",
+                "-o", lib_path / f"libbench{i}.so",
+                c_path,
+                f"-L{ext_path}", "-lbenchext",
+                f"-Wl,-rpath,{ext_path}",
+            ],
+            check=True,
+        )
+    generate_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    get_tree_elfdata(base_path, jobs=params["jobs"])
+    scan_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    grafts, patches = plan_repair(
+        base_path, f"manylinux_2_17_{platform.machine()}", jobs=params["jobs"]
+    )
+    plan_seconds = time.perf_counter() - start
+    return {
+        "elf_files": params["elf_libs"],
+        "generate_seconds": generate_seconds,
+        "scan_seconds": scan_seconds,
+        "plan_repair_seconds": plan_seconds,
+        "grafts": len(grafts),
+        "patched_files": len(patches),
+    }
+
+
+BENCHMARKS = {"pack": bench_pack, "index": bench_index, "elf": bench_elf}
+
+
+# Runs in a fresh worker process
+def run_benchmark(name, params):
+    # Keep progress output from the code under test out of the JSON on stdout
+    with TemporaryDirectory() as tempdir, contextlib.redirect_stdout(sys.stderr):
+        result = BENCHMARKS[name](params, Path(tempdir))
+    result["peak_rss"] = peak_rss()
+    return result
+
+
+def git_commit():
+    result = subprocess.run(
+        ["git", "rev-parse", "HEAD"], cwd=REPO_PATH, capture_output=True, text=True
+    )
+    return result.stdout.strip() or None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmarks", nargs="*", default=list(BENCHMARKS))
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count())
+    parser.add_argument("--files", type=int, default=5000)
+    parser.add_argument("--binaries", type=int, default=4)
+    parser.add_argument("--binary-size", type=int, default=16 * 1024 * 1024)
+    parser.add_argument("--scripts", type=int, default=20)
+    parser.add_argument("--archives", type=int, default=20)
+    parser.add_argument("--index-files", type=int, default=200)
+    parser.add_argument("--index-binary-size", type=int, default=1024 * 1024)
+    parser.add_argument("--elf-libs", type=int, default=100)
+    parser.add_argument("-o", "--output")
+    args = parser.parse_args()
+
+    params = vars(args).copy()
+    del params["benchmarks"], params["output"]
+
+    results = {}
+    for name in args.benchmarks:
+        print(f"Running {name} benchmark...", file=sys.stderr)
+        # spawn, not fork, so the worker's peak RSS doesn't start out as ours
+        mp_context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(1, mp_context=mp_context) as executor:
+            results[name] = executor.submit(run_benchmark, name, params).result()
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "params": params,
+        "results": results,
+    }
+    report_json = json.dumps(report, indent=1)
+    print(report_json)
+    if args.output is not None:
+        Path(args.output).write_text(report_json + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+# Builds a whole matrix of pybis in parallel: each job is an interpreter tree (or a
+# function that fetches one), plus its scripts path and platform tag. Jobs run on a
+# process pool, each one doing the (optional) linux_vendor.repair and then make_pybi,
+# and they all share the blob cache, the probe cache and the packaging bootstrap.
+#
+# The runner is resumable: finished jobs are recorded in build-matrix.json in the output
+# directory's state directory (see pybi.state_path_for; it's kept out of the output
+# directory, which gets synced to the server), and skipped on the next run as long as
+# their pybi is still there. Failed or interrupted jobs aren't recorded, so just run it
+# again to retry them.
+#
+#   python3 build_matrix.py matrix.json --output built
+#
+# where matrix.json is a list of jobs like:
+#
+#   [{"name": "3.9.6", "source": "trees/3.9.6", "scripts_path": "bin",
+#     "platform_tag": "manylinux_2_17_x86_64", "prune_profile": "no-tests"}]
+#
+# Any keys besides the MatrixJob fields are passed through to make_pybi.
+
+import argparse
+import collections
+import json
+import os
+import shutil
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from pybi import (
+    BlobCache,
+    BuildTrace,
+    TreeIndex,
+    default_cache_path,
+    make_pybi,
+    packaging_bootstrap,
+    remove_stale_claims,
+    save_trace,
+    state_path_for,
+)
+
+STATE_NAME = "build-matrix.json"
+
+# source is either the path to an interpreter tree, which gets copied into a scratch
+# directory first (repair and make_pybi modify the tree in place), or a picklable
+# callable that takes a scratch directory, puts a tree somewhere inside it, and returns
+# that tree's path. repair=None means "repair if it's a Linux platform tag". options
+# are extra keyword arguments for make_pybi, like prune_profile.
+MatrixJob = collections.namedtuple(
+    "MatrixJob",
+    ["name", "source", "scripts_path", "platform_tag", "repair", "options"],
+    defaults=(None, None),
+)
+
+# The top-level stages of each job, in the order they're shown in the summary
+JOB_STAGES = ["fetch", "repair", "make_pybi"]
+
+
+def wants_repair(job):
+    if job.repair is not None:
+        return job.repair
+    return job.platform_tag.startswith(("manylinux", "musllinux", "linux"))
+
+
+# Runs in the build process pool
+def run_job(job, out_dir_path, cache_path, pack_jobs):
+    trace = BuildTrace()
+    start = time.perf_counter()
+    with TemporaryDirectory() as work_dir:
+        work_path = Path(work_dir)
+        with trace.stage("fetch"):
+            if callable(job.source):
+                base_path = Path(job.source(work_path))
+            else:
+                base_path = work_path / "tree"
+                shutil.copytree(job.source, base_path, symlinks=True)
+        index = TreeIndex(base_path)
+        if wants_repair(job):
+            # Only importable where auditwheel is installed, so only import it if a job
+            # actually needs it
+            from linux_vendor import repair
+
+            with trace.stage("repair"):
+                repair(
+                    base_path,
+                    job.platform_tag,
+                    jobs=pack_jobs,
+                    trace=trace,
+                    index=index,
+                )
+        with trace.stage("make_pybi"):
+            pybi_path = make_pybi(
+                base_path,
+                out_dir_path,
+                scripts_path=job.scripts_path,
+                platform_tag=job.platform_tag,
+                jobs=pack_jobs,
+                cache=BlobCache(cache_path / "blobs"),
+                cache_path=cache_path,
+                trace=trace,
+                index=index,
+                **(job.options or {}),
+            )
+    if os.environ.get("PYBI_TRACE_DIR"):
+        save_trace(trace, pybi_path.name)
+    stages = {}
+    for stage in trace.stages:
+        if stage["name"] in JOB_STAGES:
+            stages[stage["name"]] = stage["wall"]
+    return {
+        "pybi": pybi_path.name,
+        "seconds": time.perf_counter() - start,
+        "stages": stages,
+    }
+
+
+def load_state(out_dir_path):
+    try:
+        return json.loads((state_path_for(out_dir_path) / STATE_NAME).read_text())
+    except FileNotFoundError:
+        return {}
+
+
+def save_state(out_dir_path, state):
+    state_path = state_path_for(out_dir_path) / STATE_NAME
+    state_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = state_path.with_name(f"{state_path.name}.{os.getpid()}.tmp")
+    temp_path.write_text(json.dumps(state, indent=1, sort_keys=True))
+    os.replace(temp_path, state_path)
+
+
+def print_summary(jobs, results, wall_seconds):
+    print("Build matrix summary (seconds):")
+    print(
+        f"  {'job':<30} {'status':<8} {'total':>8} "
+        + " ".join(f"{stage:>9}" for stage in JOB_STAGES)
+        + "  pybi"
+    )
+    busy_seconds = 0
+    for job in jobs:
+        status, result = results[job.name]
+        if status == "failed":
+            print(f"  {job.name:<30} {status:<8}")
+            continue
+        if status == "built":
+            busy_seconds += result["seconds"]
+        stage_columns = []
+        for stage in JOB_STAGES:
+            if stage in result["stages"]:
+                stage_columns.append(f"{result['stages'][stage]:9.1f}")
+            else:
+                stage_columns.append(" " * 9)
+        print(
+            f"  {job.name:<30} {status:<8} {result['seconds']:8.1f} "
+            + " ".join(stage_columns)
+            + f"  {result['pybi']}"
+        )
+    in_flight = busy_seconds / wall_seconds if wall_seconds else 0
+    print(
+        f"  {wall_seconds:.1f} s wall for {busy_seconds:.1f} s of builds "
+        f"({in_flight:.1f} jobs in flight on average)"
+    )
+
+
+# Builds every job that isn't already done, and returns {job name: (status, result)},
+# where status is "built", "done" (built by an earlier run) or "failed".
+def run_matrix(jobs, out_dir_path, *, build_jobs=None, pack_jobs=None, cache_path=None):
+    jobs = list(jobs)
+    names = [job.name for job in jobs]
+    duplicates = {name for name in names if names.count(name) > 1}
+    if duplicates:
+        raise ValueError(f"duplicate job names: {sorted(duplicates)}")
+    out_dir_path = Path(out_dir_path).absolute()
+    out_dir_path.mkdir(parents=True, exist_ok=True)
+    if cache_path is None:
+        cache_path = default_cache_path()
+    cache_path = Path(cache_path).absolute()
+    if build_jobs is None:
+        build_jobs = os.cpu_count()
+    if pack_jobs is None:
+        pack_jobs = max(1, os.cpu_count() // build_jobs)
+
+    removed = remove_stale_claims(out_dir_path)
+    if removed:
+        print(f"Removed {removed} build number claims left by dead builds")
+
+    state = load_state(out_dir_path)
+    results = {}
+    todo = []
+    for job in jobs:
+        previous = state.get(job.name)
+        if previous is not None and (out_dir_path / previous["pybi"]).exists():
+            results[job.name] = ("done", previous)
+        else:
+            todo.append(job)
+    print(f"{len(todo)} jobs to build, {len(jobs) - len(todo)} already done")
+
+    start = time.perf_counter()
+    if todo:
+        # Once up front, rather than every worker racing to pip install it
+        packaging_bootstrap(cache_path)
+        with ProcessPoolExecutor(min(build_jobs, len(todo))) as executor:
+            futures = {
+                executor.submit(run_job, job, out_dir_path, cache_path, pack_jobs): job
+                for job in todo
+            }
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    result = future.result()
+                except Exception:
+                    print(f"Job {job.name} failed:", file=sys.stderr)
+                    traceback.print_exc()
+                    results[job.name] = ("failed", None)
+                    continue
+                print(f"Built {result['pybi']} ({result['seconds']:.1f} s)")
+                results[job.name] = ("built", result)
+                # Saved after every job, so an interrupted run keeps what it finished
+                state[job.name] = result
+                save_state(out_dir_path, state)
+    print_summary(jobs, results, time.perf_counter() - start)
+    return results
+
+
+def load_matrix(matrix_path):
+    jobs = []
+    for spec in json.loads(Path(matrix_path).read_text()):
+        spec = dict(spec)
+        fields = {
+            field: spec.pop(field)
+            for field in MatrixJob._fields
+            if field in spec and field != "options"
+        }
+        # Relative tree paths are relative to the matrix file
+        fields["source"] = Path(matrix_path).parent / fields["source"]
+        jobs.append(MatrixJob(**fields, options=spec))
+    return jobs
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="build_matrix.py")
+    parser.add_argument("matrix")
+    parser.add_argument("-o", "--output", default="built")
+    parser.add_argument("-j", "--build-jobs", type=int, default=os.cpu_count())
+    parser.add_argument("--pack-jobs", type=int)
+    parser.add_argument("--cache-path")
+    args = parser.parse_args()
+    results = run_matrix(
+        load_matrix(args.matrix),
+        args.output,
+        build_jobs=args.build_jobs,
+        pack_jobs=args.pack_jobs,
+        cache_path=args.cache_path,
+    )
+    if any(status == "failed" for status, _ in results.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
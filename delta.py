@@ -0,0 +1,445 @@
+# Delta pybis: everything needed to turn an unpacked copy of one pybi into an unpacked
+# copy of another (typically the next patch release), without downloading the whole
+# new pybi. Most members are byte-identical between patch releases, so a delta only
+# carries what actually changed.
+#
+# A delta is a zip file containing:
+#
+#   delta-info/DELTA.json: which source and target it's for (by name, and by the
+#       sha256 of their RECORDs), the members that were removed, and the members that
+#       are stored as binary patches (with the target member's mode bits)
+#   files/<name>: members that are new or changed, copied from the target pybi as-is
+#       (same compression, same mode bits, symlinks stay symlinks). Always includes the
+#       target's pybi-info/, so the target RECORD is available for verification.
+#   patches/<name>: bsdiff4 patches against the source version of a member, for big
+#       binaries that changed a little. Only made if the bsdiff4 package is installed,
+#       and only used if the patch is actually smaller.
+#
+# Every member of the target that isn't in files/ or patches/ is identical to the
+# source member with the same name.
+#
+#   python3 delta.py make OLD.pybi NEW.pybi
+#   python3 delta.py apply OLD-TREE/ DELTA NEW-TREE/
+#   python3 delta.py make-all built/
+
+import argparse
+import hashlib
+import io
+import json
+import mmap
+import os
+import re
+import shutil
+import zipfile
+from pathlib import Path
+
+from pybi import (
+    CHUNK_SIZE,
+    MODE_SHIFT,
+    SYMLINK_MASK,
+    SYMLINK_MODE,
+    RECORD_NAME,
+    check_created_symlinks,
+    matches_record,
+    member_data_chunks,
+    member_raw_chunks,
+    ordered_map,
+    parse_record,
+    read_chunks,
+    record_hash,
+    safe_member_path,
+    symlink_problems,
+    write_chunks,
+    write_compressed,
+)
+
+try:
+    import bsdiff4
+except ImportError:
+    bsdiff4 = None
+
+DELTA_VERSION = 1
+DELTA_INFO_NAME = "delta-info/DELTA.json"
+DEFAULT_BINARY_DIFF_MIN_SIZE = 1024 * 1024
+
+FINAL_VERSION_RE = re.compile(r"[0-9]+\.[0-9]+\.[0-9]+")
+# name-version[-build]-platform.pybi
+PYBI_NAME_RE = re.compile(
+    r"^(?P<name>[^-]+)-(?P<version>[^-]+)(-(?P<build>[0-9]+))?-(?P<tag>[^-]+)\.pybi$"
+)
+
+
+def delta_name(source_name, target_name):
+    source_version = PYBI_NAME_RE.match(source_name)["version"]
+    return f"{target_name[: -len('.pybi')]}.from-{source_version}.pybi-delta"
+
+
+def is_symlink_member(zi):
+    return (zi.external_attr >> MODE_SHIFT) & SYMLINK_MASK == SYMLINK_MODE
+
+
+def make_delta(
+    source_pybi,
+    target_pybi,
+    delta_path=None,
+    *,
+    binary_diff_min_size=DEFAULT_BINARY_DIFF_MIN_SIZE,
+    jobs=1,
+):
+    source_pybi = Path(source_pybi)
+    target_pybi = Path(target_pybi)
+    if delta_path is None:
+        delta_path = target_pybi.with_name(
+            delta_name(source_pybi.name, target_pybi.name)
+        )
+    delta_path = Path(delta_path)
+
+    with open(source_pybi, "rb") as source_f, open(target_pybi, "rb") as target_f:
+        source_z = zipfile.ZipFile(source_f)
+        target_z = zipfile.ZipFile(target_f)
+        source_record_bytes = source_z.read(RECORD_NAME)
+        target_record_bytes = target_z.read(RECORD_NAME)
+        source_record = parse_record(source_record_bytes)
+        target_record = parse_record(target_record_bytes)
+        source_infos = {zi.filename: zi for zi in source_z.infolist()}
+
+        changed = []
+        for zi in target_z.infolist():
+            if zi.is_dir():
+                continue
+            source_zi = source_infos.get(zi.filename)
+            if (
+                zi.filename.startswith("pybi-info/")
+                or source_zi is None
+                or source_record.get(zi.filename) != target_record[zi.filename]
+                or source_zi.external_attr != zi.external_attr
+            ):
+                changed.append(zi)
+        removed = sorted(source_record.keys() - target_record.keys())
+
+        with mmap.mmap(
+            source_f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as source_m, mmap.mmap(
+            target_f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as target_m:
+            source_view = memoryview(source_m)
+            target_view = memoryview(target_m)
+
+            # Returns the patch bytes, or None if we should ship the member whole.
+            # pybi-info/ always ships whole: apply_delta needs the target RECORD out of
+            # files/ before it can check anything else.
+            def try_patch(zi):
+                source_zi = source_infos.get(zi.filename)
+                if (
+                    bsdiff4 is None
+                    or zi.filename.startswith("pybi-info/")
+                    or source_zi is None
+                    or zi.file_size < binary_diff_min_size
+                    or is_symlink_member(zi)
+                    or is_symlink_member(source_zi)
+                ):
+                    return None
+                old = b"".join(member_data_chunks(source_view, source_zi))
+                new = b"".join(member_data_chunks(target_view, zi))
+                patch = bsdiff4.diff(old, new)
+                if len(patch) >= zi.compress_size:
+                    return None
+                return patch
+
+            patched = {}
+            temp_path = delta_path.with_name(f".{delta_path.name}.{os.getpid()}.tmp")
+            try:
+                with zipfile.ZipFile(
+                    temp_path, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True
+                ) as delta_z:
+                    patches = ordered_map(try_patch, changed, jobs)
+                    for zi, patch in zip(changed, patches):
+                        if patch is not None:
+                            patched[zi.filename] = {
+                                "method": "bsdiff4",
+                                "source_hash": source_record[zi.filename][0],
+                                "mode": (zi.external_attr >> MODE_SHIFT) & 0o777,
+                            }
+                            # bsdiff4 patches are already bzip2-compressed
+                            delta_z.writestr(
+                                f"patches/{zi.filename}",
+                                patch,
+                                compress_type=zipfile.ZIP_STORED,
+                            )
+                        else:
+                            new_zi = zipfile.ZipInfo(f"files/{zi.filename}")
+                            new_zi.external_attr = zi.external_attr
+                            new_zi.compress_type = zi.compress_type
+                            new_zi.CRC = zi.CRC
+                            new_zi.file_size = zi.file_size
+                            new_zi.compress_size = zi.compress_size
+                            write_compressed(
+                                delta_z,
+                                new_zi,
+                                io.BytesIO(
+                                    b"".join(member_raw_chunks(target_view, zi))
+                                ),
+                            )
+                    delta_info = {
+                        "delta-version": DELTA_VERSION,
+                        "source": {
+                            "name": source_pybi.name,
+                            "record_sha256": hashlib.sha256(
+                                source_record_bytes
+                            ).hexdigest(),
+                        },
+                        "target": {
+                            "name": target_pybi.name,
+                            "record_sha256": hashlib.sha256(
+                                target_record_bytes
+                            ).hexdigest(),
+                        },
+                        "removed": removed,
+                        "patched": patched,
+                    }
+                    delta_z.writestr(DELTA_INFO_NAME, json.dumps(delta_info, indent=1))
+                os.replace(temp_path, delta_path)
+            except BaseException:
+                temp_path.unlink(missing_ok=True)
+                raise
+            finally:
+                source_view.release()
+                target_view.release()
+
+    print(
+        f"{delta_path.name}: {len(changed) - len(patched)} new/changed, "
+        f"{len(patched)} patched, {len(removed)} removed, "
+        f"{delta_path.stat().st_size} bytes "
+        f"(vs {target_pybi.stat().st_size} for the full pybi)"
+    )
+    return delta_path
+
+
+def copy_verified(src_path, dest_path, expected_hash, expected_size, name):
+    with open(src_path, "rb") as src:
+        digest, size = write_chunks(read_chunks(src), dest_path)
+    check_written(dest_path, digest, size, expected_hash, expected_size, name)
+    shutil.copymode(src_path, dest_path)
+
+
+def check_written(path, digest, size, expected_hash, expected_size, name):
+    if not matches_record(name, digest, size, expected_hash, expected_size):
+        path.unlink()
+        raise RuntimeError(f"{name}: doesn't match target RECORD")
+
+
+# Applies a delta to source_tree (an unpacked copy of the delta's source pybi), writing
+# the target tree to dest, which must be empty. source_tree isn't modified. Anything in
+# source_tree that isn't in its RECORD (e.g. installed packages) is not carried over.
+# Every file written is checked against the target RECORD.
+def apply_delta(source_tree, delta_path, dest, *, jobs=1):
+    source_path = Path(source_tree).resolve()
+    dest_path = Path(dest)
+    dest_path.mkdir(parents=True, exist_ok=True)
+    dest_path = dest_path.resolve()
+    if any(dest_path.iterdir()):
+        raise RuntimeError(f"{dest_path} is not empty")
+
+    source_record_bytes = (source_path / RECORD_NAME).read_bytes()
+    source_record = parse_record(source_record_bytes)
+
+    with open(delta_path, "rb") as f, mmap.mmap(
+        f.fileno(), 0, access=mmap.ACCESS_READ
+    ) as m, zipfile.ZipFile(f) as z:
+        delta_info = json.loads(z.read(DELTA_INFO_NAME))
+        if delta_info["delta-version"] != DELTA_VERSION:
+            raise RuntimeError(
+                f"unsupported delta version {delta_info['delta-version']}"
+            )
+        if (
+            hashlib.sha256(source_record_bytes).hexdigest()
+            != delta_info["source"]["record_sha256"]
+        ):
+            raise RuntimeError(
+                f"{source_path} is not an unpacked {delta_info['source']['name']}"
+            )
+        target_record_bytes = z.read(f"files/{RECORD_NAME}")
+        if (
+            hashlib.sha256(target_record_bytes).hexdigest()
+            != delta_info["target"]["record_sha256"]
+        ):
+            raise RuntimeError("delta's RECORD doesn't match its DELTA.json")
+        target_record = parse_record(target_record_bytes)
+        patched = delta_info["patched"]
+        if patched and bsdiff4 is None:
+            raise RuntimeError("this delta contains binary patches; install bsdiff4")
+
+        delta_infos = {}
+        for zi in z.infolist():
+            if zi.filename.startswith("files/"):
+                delta_infos[zi.filename[len("files/") :]] = zi
+        unknown = (delta_infos.keys() | patched.keys()) - target_record.keys()
+        if unknown:
+            raise RuntimeError(f"delta has members not in RECORD: {sorted(unknown)}")
+
+        view = memoryview(m)
+        try:
+            files = []
+            symlinks = []
+            for name in target_record:
+                path = safe_member_path(dest_path, name)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                if name in delta_infos:
+                    zi = delta_infos[name]
+                    if is_symlink_member(zi):
+                        symlinks.append((name, z.read(zi).decode("utf-8")))
+                    else:
+                        files.append(("delta", name, path))
+                elif name in patched:
+                    files.append(("patch", name, path))
+                else:
+                    if source_record.get(name) != target_record[name]:
+                        raise RuntimeError(f"{name}: missing from delta")
+                    hash = target_record[name][0]
+                    if hash.startswith("symlink="):
+                        symlinks.append((name, hash[len("symlink=") :]))
+                    else:
+                        files.append(("source", name, path))
+
+            def write_file(item):
+                kind, name, path = item
+                expected_hash, expected_size = target_record[name]
+                if kind == "source":
+                    copy_verified(
+                        safe_member_path(source_path, name),
+                        path,
+                        expected_hash,
+                        expected_size,
+                        name,
+                    )
+                    return
+                if kind == "delta":
+                    zi = delta_infos[name]
+                    chunks = member_data_chunks(view, zi)
+                    mode = (zi.external_attr >> MODE_SHIFT) & 0o777
+                else:
+                    source_file = safe_member_path(source_path, name)
+                    old = source_file.read_bytes()
+                    if record_hash(hashlib.sha256(old).digest()) != patched[name][
+                        "source_hash"
+                    ].rstrip("="):
+                        raise RuntimeError(f"{name}: source doesn't match delta")
+                    new = bsdiff4.patch(old, z.read(f"patches/{name}"))
+                    chunks = (
+                        new[i : i + CHUNK_SIZE] for i in range(0, len(new), CHUNK_SIZE)
+                    )
+                    # Deltas made before "mode" was recorded only have the source's
+                    mode = patched[name].get("mode")
+                    if mode is None:
+                        mode = source_file.stat().st_mode & 0o777
+                digest, size = write_chunks(chunks, path)
+                check_written(path, digest, size, expected_hash, expected_size, name)
+                if mode & 0o111 and os.name == "posix":
+                    os.chmod(path, mode)
+
+            for name, target in symlinks:
+                if target_record[name][0] != f"symlink={target}":
+                    raise RuntimeError(f"{name}: doesn't match target RECORD")
+            problems = symlink_problems(
+                dict(symlinks), [name for (_, name, _) in files]
+            )
+            if problems:
+                raise RuntimeError(f"refusing to apply delta: {problems[0]}")
+
+            for _ in ordered_map(write_file, files, jobs):
+                pass
+            for name, target in symlinks:
+                os.symlink(target, safe_member_path(dest_path, name))
+            check_created_symlinks(
+                [safe_member_path(dest_path, name) for (name, _) in symlinks], dest_path
+            )
+        finally:
+            view.release()
+    return len(files), len(symlinks)
+
+
+def version_key(version):
+    return tuple(int(part) for part in version.split("."))
+
+
+# Makes any missing deltas between consecutive patch releases in built_path (e.g.
+# 3.9.5 -> 3.9.6) with the same name and platform. Only final releases are considered,
+# and only the latest build of each.
+def make_all_deltas(built_path, *, jobs=1, **kwargs):
+    latest = {}
+    for pybi_path in built_path.glob("*.pybi"):
+        match = PYBI_NAME_RE.match(pybi_path.name)
+        if match is None or not FINAL_VERSION_RE.fullmatch(match["version"]):
+            continue
+        key = (match["name"], match["tag"], match["version"])
+        build = int(match["build"] or 0)
+        if key not in latest or build > latest[key][0]:
+            latest[key] = (build, pybi_path)
+
+    series = {}
+    for (name, tag, version), (_, pybi_path) in latest.items():
+        major_minor = version_key(version)[:2]
+        series.setdefault((name, tag, major_minor), []).append((version, pybi_path))
+
+    made = []
+    for releases in series.values():
+        releases.sort(key=lambda release: version_key(release[0]))
+        for (_, source), (_, target) in zip(releases, releases[1:]):
+            delta_path = built_path / delta_name(source.name, target.name)
+            if not delta_path.exists():
+                made.append(make_delta(source, target, delta_path, jobs=jobs, **kwargs))
+    return made
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="delta.py")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    make_parser = subparsers.add_parser("make", help="make a delta between two pybis")
+    make_parser.add_argument("source")
+    make_parser.add_argument("target")
+    make_parser.add_argument("-o", "--output")
+
+    apply_parser = subparsers.add_parser(
+        "apply", help="apply a delta to an unpacked source pybi"
+    )
+    apply_parser.add_argument("source_tree")
+    apply_parser.add_argument("delta")
+    apply_parser.add_argument("dest")
+
+    make_all_parser = subparsers.add_parser(
+        "make-all", help="make missing deltas between consecutive patch releases"
+    )
+    make_all_parser.add_argument("built", nargs="?", default="built")
+
+    for subparser in [make_parser, make_all_parser]:
+        subparser.add_argument(
+            "--binary-diff-min-size", type=int, default=DEFAULT_BINARY_DIFF_MIN_SIZE
+        )
+    for subparser in [make_parser, apply_parser, make_all_parser]:
+        subparser.add_argument("-j", "--jobs", type=int, default=os.cpu_count())
+
+    args = parser.parse_args()
+    if args.command == "make":
+        make_delta(
+            args.source,
+            args.target,
+            args.output,
+            binary_diff_min_size=args.binary_diff_min_size,
+            jobs=args.jobs,
+        )
+    elif args.command == "apply":
+        file_count, symlink_count = apply_delta(
+            args.source_tree, args.delta, args.dest, jobs=args.jobs
+        )
+        print(f"Wrote {file_count} files and {symlink_count} symlinks to {args.dest}")
+    elif args.command == "make-all":
+        make_all_deltas(
+            Path(args.built),
+            binary_diff_min_size=args.binary_diff_min_size,
+            jobs=args.jobs,
+        )
+
+
+if __name__ == "__main__":
+    main()
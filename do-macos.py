@@ -1,13 +1,18 @@
 import subprocess
+import os
 from pathlib import Path
-from tempfile import TemporaryDirectory
 from bs4 import BeautifulSoup
-import shutil
 import re
+import json
+import functools
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 import requests
+import requests.adapters
 http = requests.Session()
 
-from pybi import make_pybi
+from pybi import default_cache_path
+from build_matrix import MatrixJob, run_matrix
 
 # --os-version 10.6, 10.9, 11
 #   3.6 has 10.6 and 10.9
@@ -24,76 +29,143 @@ built_path = Path("built").absolute()
 
 version_link_re = re.compile(r"^([0-9]+)\.([0-9]+)(\.[0-9]+)?/")
 
-def find_all_macos_builds():
-    r = http.get("https://www.python.org/ftp/python/")
+listing_cache_path = default_cache_path() / "python-org-listings.json"
+LISTING_JOBS = 16
+# So the listing threads can all share a connection pool instead of each opening their
+# own connections.
+http.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=LISTING_JOBS))
+http.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=LISTING_JOBS))
+
+
+def is_final_listing(target, hrefs):
+    # Once the final release of X.Y.Z has a macOS installer in its directory, that
+    # directory isn't going to change in any way we care about, so we never need to
+    # fetch it again.
+    version = target.rstrip("/")
+    return any(
+        href.startswith(f"python-{version}-mac") and href.endswith(".pkg")
+        for href in hrefs
+    )
+
+
+# Returns the list of hrefs on a directory listing page. Listings are cached on disk:
+# final listings (see above) are used as-is, and anything else is revalidated with
+# If-None-Match/If-Modified-Since, so unchanged pages come back as a cheap 304.
+def fetch_listing(url, cache, is_final=lambda hrefs: False):
+    entry = cache.get(url)
+    if entry is not None and entry["final"]:
+        return entry["hrefs"]
+    headers = {}
+    if entry is not None:
+        if entry["etag"] is not None:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"] is not None:
+            headers["If-Modified-Since"] = entry["last_modified"]
+    r = http.get(url, headers=headers)
+    if r.status_code == 304 and entry is not None:
+        return entry["hrefs"]
     r.raise_for_status()
-    for link in BeautifulSoup(r.text, features="lxml").find_all("a"):
-        target = link.get("href")
+    hrefs = [
+        link.get("href") for link in BeautifulSoup(r.text, features="lxml").find_all("a")
+    ]
+    cache[url] = {
+        "etag": r.headers.get("ETag"),
+        "last_modified": r.headers.get("Last-Modified"),
+        "hrefs": hrefs,
+        "final": is_final(hrefs),
+    }
+    return hrefs
+
+
+def load_listing_cache():
+    try:
+        return json.loads(listing_cache_path.read_text())
+    except FileNotFoundError:
+        return {}
+
+
+def save_listing_cache(cache):
+    listing_cache_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = listing_cache_path.with_name(listing_cache_path.name + ".tmp")
+    temp_path.write_text(json.dumps(cache, indent=1, sort_keys=True))
+    os.replace(temp_path, listing_cache_path)
+
+
+def find_all_macos_builds(base_url="https://www.python.org/ftp/python/"):
+    cache = load_listing_cache()
+    targets = []
+    for target in fetch_listing(base_url, cache):
         match = version_link_re.match(target)
         if match:
             major = int(match.group(1))
             minor = int(match.group(2))
             if (major, minor) >= (3, 6):
-                base_url = f"https://www.python.org/ftp/python/{target}/"
-                r = http.get(base_url)
-                r.raise_for_status()
-                for link in BeautifulSoup(r.text, features="lxml").find_all("a"):
-                    package = link.get("href")
-                    # "python-3.9.6-macos11.pkg"
-                    if not package.startswith("python-"):
-                        continue
-                    version_str = package.split("-")[1]
-                    if version_str.startswith("3.6.0a"):
-                        # Some 3.6 alphas didn't yet support variable annotations, so
-                        # they can't parse current 'packaging'
-                        continue
-                    if package.endswith("macos11.pkg"):
-                        yield (version_str, "macosx_11_0_universal2", "11")
-                    elif package.endswith("macosx10.9.pkg"):
-                        yield (version_str, "macosx_10_9_x86_64", "10.9")
-                    elif package.endswith("macosx10.6.pkg"):
-                        yield (version_str, "macosx_10_6_intel", "10.6")
-
-
-def maybe_repack(py_version, tag, os_version):
-    pybi = built_path / f"cpython_unofficial-{py_version}-{tag}.pybi"
-    print(f"\n\n\n\n\n\n----------------- Repacking {pybi} ----------------")
-    if pybi.exists():
-        print("   -> already exists, skipping")
-        return
-    with TemporaryDirectory() as tempdir:
-        subprocess.run(
-            [
-                "../relocatable-python/make_relocatable_python_framework.py",
-                "--python-version", py_version,
-                "--os-version", os_version,
-                "--destination", tempdir,
-                "--pip-requirements", "/dev/null",
-            ],
-            check=True,
+                targets.append(target)
+
+    def fetch_version_listing(target):
+        return fetch_listing(
+            f"{base_url}{target}",
+            cache,
+            functools.partial(is_final_listing, target),
         )
-        base_path = Path(tempdir)
-        (scripts_path,) = base_path.glob("Python.framework/Versions/3.*/bin")
-        (site_packages_path,) = base_path.glob("Python.framework/Versions/Current/lib/*/site-packages")
 
-        for p in scripts_path.glob("pip*"):
-            print(f"Blowing away {p}")
-            p.unlink()
+    with ThreadPoolExecutor(LISTING_JOBS) as executor:
+        listings = list(executor.map(fetch_version_listing, targets))
+    save_listing_cache(cache)
 
-        for p in site_packages_path.iterdir():
-            if p.name != "README.txt":
-                print(f"Blowing away {p}")
-                if p.is_dir():
-                    shutil.rmtree(p)
-                else:
-                    p.unlink()
+    for listing in listings:
+        for package in listing:
+            # "python-3.9.6-macos11.pkg"
+            if not package.startswith("python-"):
+                continue
+            version_str = package.split("-")[1]
+            if version_str.startswith("3.6.0a"):
+                # Some 3.6 alphas didn't yet support variable annotations, so
+                # they can't parse current 'packaging'
+                continue
+            if package.endswith("macos11.pkg"):
+                yield (version_str, "macosx_11_0_universal2", "11")
+            elif package.endswith("macosx10.9.pkg"):
+                yield (version_str, "macosx_10_9_x86_64", "10.9")
+            elif package.endswith("macosx10.6.pkg"):
+                yield (version_str, "macosx_10_6_intel", "10.6")
 
-        print("Removing stdlib `test` module")
-        shutil.rmtree(site_packages_path.parent / "test")
 
-        make_pybi(base_path, built_path, scripts_path=scripts_path, platform_tag=tag)
+def fetch_relocatable(py_version, os_version, work_path):
+    # Runs in the build matrix's process pool
+    base_path = work_path / "tree"
+    base_path.mkdir()
+    subprocess.run(
+        [
+            "../relocatable-python/make_relocatable_python_framework.py",
+            "--python-version", py_version,
+            "--os-version", os_version,
+            "--destination", base_path,
+            "--pip-requirements", "/dev/null",
+        ],
+        check=True,
+    )
+    return base_path
+
+
+def wanted_jobs(base_url):
+    for py_version, tag, os_version in find_all_macos_builds(base_url):
+        pybi_name = f"cpython_unofficial-{py_version}-{tag}"
+        if (built_path / f"{pybi_name}.pybi").exists():
+            continue
+        major, minor = py_version.split(".")[:2]
+        yield MatrixJob(
+            name=pybi_name,
+            source=functools.partial(fetch_relocatable, py_version, os_version),
+            scripts_path=f"Python.framework/Versions/{major}.{minor}/bin",
+            platform_tag=tag,
+            options={"prune_profile": "no-tests"},
+        )
 
 
-for py_version, tag, os_version in find_all_macos_builds():
-    #print((py_version, tag, os_version))
-    maybe_repack(py_version, tag, os_version)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base-url", default="https://www.python.org/ftp/python/")
+    parser.add_argument("--build-jobs", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    run_matrix(wanted_jobs(args.base_url), built_path, build_jobs=args.build_jobs)
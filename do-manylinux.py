@@ -4,14 +4,51 @@
 #   for VERSION in $(seq -f 3.9.%g 6) $(seq -f 3.8.%g 11) $(seq -f 3.7.%g 11) $(seq -f 3.6.%g 14); do docker run --rm -it -v $(pwd):/host pybi-build-image sh -c "PREFIX=/pyinstall /build_scripts/build-cpython.sh ${VERSION} && /opt/_internal/cpython-3.9.5/bin/python3 -m ensurepip && PYTHONPATH=/host/local-pkgs /opt/_internal/cpython-3.9.5/bin/python3 /host/do-manylinux.py"; done
 
 import sys
+import os
 from pathlib import Path
 import platform
 
-from pybi import make_pybi
+from pybi import (
+    make_pybi,
+    BlobCache,
+    TreeIndex,
+    trace_from_env,
+    save_trace,
+    remove_stale_claims,
+)
 from linux_vendor import repair
 
-tag = f"manylinux_2_17_{platform.machine().lower()}"
 
-base_path = Path("/pyinstall")
-repair(base_path, tag)
-make_pybi(base_path, Path("/host/built"), scripts_path="bin", platform_tag=tag)
+def main():
+    tag = f"manylinux_2_17_{platform.machine().lower()}"
+    built_path = Path("/host/built")
+
+    base_path = Path("/pyinstall")
+    # Lives on the host, so it's shared between all the docker runs
+    cache_path = Path("/host/cache")
+    blob_cache = BlobCache(cache_path / "blobs")
+    removed = remove_stale_claims(built_path)
+    if removed:
+        print(f"Removed {removed} build number claims left by dead builds")
+    trace = trace_from_env()
+    # Walked once, and kept up to date by repair, so make_pybi doesn't have to
+    # re-walk it
+    index = TreeIndex(base_path)
+    repair(base_path, tag, jobs=os.cpu_count(), trace=trace, index=index)
+    pybi_path = make_pybi(
+        base_path,
+        built_path,
+        scripts_path="bin",
+        platform_tag=tag,
+        jobs=os.cpu_count(),
+        cache=blob_cache,
+        cache_path=cache_path,
+        prune_profile="no-tests",
+        trace=trace,
+        index=index,
+    )
+    save_trace(trace, pybi_path.name)
+
+
+if __name__ == "__main__":
+    main()
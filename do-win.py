@@ -1,18 +1,29 @@
 import zipfile
 from tempfile import TemporaryDirectory
-import shutil
 from pathlib import Path
 import json
-import io
+import os
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
-from pybi import make_pybi
+from pybi import (
+    make_pybi,
+    BlobCache,
+    default_cache_path,
+    trace_from_env,
+    save_trace,
+    remove_stale_claims,
+    CHUNK_SIZE,
+)
 
 import requests
 http = requests.Session()
 
 built_path = Path("built").absolute()
+blob_cache = BlobCache(default_cache_path() / "blobs")
 
-def repack_nupkg(tag, nupkg_file, work_path):
+def repack_nupkg(tag, nupkg_file, work_path, jobs):
     zipfile.ZipFile(nupkg_file).extractall(work_path)
 
     # actual python environment is nested inside a "tools/" directory
@@ -25,19 +36,42 @@ def repack_nupkg(tag, nupkg_file, work_path):
         if p.suffix in (".exe", ".dll"):
             p.rename(base_path / "Scripts" / p.name)
 
-    for p in (base_path / "Lib" / "site-packages").iterdir():
-        if p.name != "README.txt":
-            print(f"Blowing away {p}")
-            if p.is_dir():
-                shutil.rmtree(p)
-            else:
-                p.unlink()
+    trace = trace_from_env()
+    pybi_path = make_pybi(
+        base_path,
+        built_path,
+        scripts_path="Scripts",
+        platform_tag=tag,
+        jobs=jobs,
+        cache=blob_cache,
+        prune_profile="minimal",
+        trace=trace,
+    )
+    save_trace(trace, pybi_path.name)
 
-    make_pybi(base_path, built_path, scripts_path="Scripts", platform_tag=tag)
 
+# Runs in the build process pool
+def build_pybi(pybi_name, tag, nupkg_path, jobs):
+    print(f"Building {pybi_name}")
+    try:
+        with TemporaryDirectory() as work_path:
+            repack_nupkg(tag, nupkg_path, Path(work_path), jobs)
+    finally:
+        nupkg_path.unlink()
+    return pybi_name
+
+
+def download(url, dest_path):
+    # Streamed straight to disk; these are ~15 MB each and there are a lot of them.
+    with http.get(url, stream=True) as response:
+        response.raise_for_status()
+        with open(dest_path, "wb") as f:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                f.write(chunk)
 
-def python_nupkg_urls():
-    response = http.get("https://api.nuget.org/v3/index.json")
+
+def python_nupkg_urls(index_url):
+    response = http.get(index_url)
     response.raise_for_status()
     for resource in response.json()["resources"]:
         if resource["@type"] == "PackageBaseAddress/3.0.0":
@@ -52,17 +86,58 @@ def python_nupkg_urls():
             yield (pkg, version, f"{base}{pkg}/{version}/{pkg}.{version}.nupkg")
 
 
-for pkg, version, url in python_nupkg_urls():
-    if version.startswith("3.5.") or version.startswith("3.6."):
-        continue
-    if pkg == "python":
-        tag = "win_amd64"
-    else:
-        assert pkg == "pythonx86"
-        tag = "win32"
-    pybi_name = f"cpython_unofficial-{version}-{tag}.pybi"
-    if not (built_path / pybi_name).exists():
-        print(f"Building {pybi_name}")
-        nupkg_data = http.get(url).content
-        with TemporaryDirectory() as work_path:
-            repack_nupkg(tag, io.BytesIO(nupkg_data), Path(work_path))
+def wanted_pybis(index_url):
+    for pkg, version, url in python_nupkg_urls(index_url):
+        if version.startswith("3.5.") or version.startswith("3.6."):
+            continue
+        if pkg == "python":
+            tag = "win_amd64"
+        else:
+            assert pkg == "pythonx86"
+            tag = "win32"
+        pybi_name = f"cpython_unofficial-{version}-{tag}.pybi"
+        if not (built_path / pybi_name).exists():
+            yield pybi_name, tag, url
+
+
+# Downloads run on a thread pool, and as each one finishes it's handed off to a process
+# pool for the repack. To bound how many downloaded-but-not-yet-built nupkgs pile up on
+# disk, we only start a download once there's room for it in the build queue.
+def main(index_url, download_jobs, build_jobs):
+    pack_jobs = max(1, os.cpu_count() // build_jobs)
+    removed = remove_stale_claims(built_path)
+    if removed:
+        print(f"Removed {removed} build number claims left by dead builds")
+    in_flight = threading.BoundedSemaphore(2 * build_jobs)
+    with TemporaryDirectory() as download_dir, ThreadPoolExecutor(
+        download_jobs
+    ) as downloads, ProcessPoolExecutor(build_jobs) as builds:
+
+        def fetch(pybi_name, tag, url):
+            nupkg_path = Path(download_dir) / f"{pybi_name}.nupkg"
+            try:
+                print(f"Downloading {url}")
+                download(url, nupkg_path)
+                build = builds.submit(build_pybi, pybi_name, tag, nupkg_path, pack_jobs)
+            except BaseException:
+                in_flight.release()
+                raise
+            build.add_done_callback(lambda _: in_flight.release())
+            return build
+
+        fetches = []
+        for pybi_name, tag, url in wanted_pybis(index_url):
+            in_flight.acquire()
+            fetches.append(downloads.submit(fetch, pybi_name, tag, url))
+
+        for fetch_future in fetches:
+            print(f"Built {fetch_future.result().result()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--index-url", default="https://api.nuget.org/v3/index.json")
+    parser.add_argument("--download-jobs", type=int, default=4)
+    parser.add_argument("--build-jobs", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    main(args.index_url, args.download_jobs, args.build_jobs)
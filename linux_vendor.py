@@ -1,52 +1,355 @@
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
+import itertools
+import os
 import os.path
-from auditwheel.lddtree import lddtree
+import platform
+import shlex
+import shutil
+import stat
+import subprocess
+from elftools.common.exceptions import ELFError
+from elftools.elf.elffile import ELFFile
+from auditwheel.lddtree import (
+    find_lib,
+    load_ld_paths,
+    normpath,
+    parse_ld_paths,
+    readlink,
+)
 from auditwheel.elfutils import (
-    elf_file_filter,
     elf_find_versioned_symbols,
     elf_read_dt_needed,
+    elf_read_rpaths,
 )
+from auditwheel.hashfile import hashfile
 from auditwheel.policy import lddtree_external_references
-from auditwheel.repair import get_wheel_elfdata, copylib, append_rpath_within_wheel
 from auditwheel.patcher import Patchelf
 
+from pybi import TreeIndex, trace_stage
+
+
+ELF_MAGIC = b"\x7fELF"
+
+
+def is_elf(path):
+    # Most of a CPython install is .py files and other non-ELF data, and reading 4 bytes
+    # is much cheaper than having pyelftools try to parse each one.
+    with open(path, "rb") as f:
+        return f.read(len(ELF_MAGIC)) == ELF_MAGIC
+
+
+# (soname, ELF flavor, search path) -> {soname: lib info} for that library and
+# everything it pulls in. Every extension module in lib-dynload needs libc, libpthread,
+# etc., and without this we'd re-resolve (and re-parse) the same libraries hundreds of
+# times. It's per-process, so each worker in the pool has its own.
+_subtree_memo = {}
+
+
+# Copy/pasted from auditwheel.repair._resolve_rpath_tokens (auditwheel 5.0.0), since
+# it's private: expands the dynamic string tokens that ld.so understands.
+def resolve_rpath_tokens(rpath, lib_base_dir):
+    if platform.architecture()[0] == "64bit":
+        system_lib_dir = "lib64"
+    else:
+        system_lib_dir = "lib"
+    token_replacements = {
+        "ORIGIN": lib_base_dir,
+        "LIB": system_lib_dir,
+        "PLATFORM": platform.machine(),
+    }
+    for token, target in token_replacements.items():
+        rpath = rpath.replace(f"${token}", target)
+        rpath = rpath.replace(f"${{{token}}}", target)
+    return rpath
+
+
+# Copy/pasted from auditwheel.repair._is_valid_rpath (auditwheel 5.0.0): whether an
+# existing rpath entry is an absolute path (after token expansion) inside base_dir.
+def is_valid_rpath(rpath, lib_dir, base_dir):
+    full_rpath_entry = resolve_rpath_tokens(rpath, lib_dir)
+    if not os.path.isabs(full_rpath_entry):
+        return False
+    relative = os.path.relpath(
+        os.path.realpath(full_rpath_entry), os.path.realpath(base_dir)
+    )
+    return not relative.startswith(os.pardir)
+
+
+# Copy/pasted and tweaked from auditwheel.lddtree.lddtree (auditwheel 5.0.0), to
+# memoize the resolution of each dependency subtree. Returns the same structure as
+# the original.
+def lddtree(
+    path, root="/", prefix="", ldpaths=None, display=None, _first=True, _all_libs=None
+):
+    if not ldpaths:
+        ldpaths = load_ld_paths().copy()
+
+    if _first:
+        _all_libs = {}
+
+    ret = {
+        "interp": None,
+        "path": path if display is None else display,
+        "realpath": path,
+        "needed": [],
+        "rpath": [],
+        "runpath": [],
+        "libs": _all_libs,
+    }
+
+    with open(path, "rb") as f:
+        elf = ELFFile(f)
+
+        # If this is the first ELF, extract the interpreter.
+        if _first:
+            for segment in elf.iter_segments():
+                if segment.header.p_type != "PT_INTERP":
+                    continue
+
+                interp = segment.get_interp_name()
+                ret["interp"] = normpath(root + interp)
+                ret["libs"][os.path.basename(interp)] = {
+                    "path": ret["interp"],
+                    "realpath": readlink(ret["interp"], root, prefixed=True),
+                    "needed": [],
+                }
+                ldpaths["interp"] = [
+                    normpath(root + os.path.dirname(interp)),
+                    normpath(
+                        root + prefix + "/usr" + os.path.dirname(interp).lstrip(prefix)
+                    ),
+                ]
+                break
+
+        # Parse the ELF's dynamic tags.
+        libs = []
+        rpaths = []
+        runpaths = []
+        for segment in elf.iter_segments():
+            if segment.header.p_type != "PT_DYNAMIC":
+                continue
+
+            for t in segment.iter_tags():
+                if t.entry.d_tag == "DT_RPATH":
+                    rpaths = parse_ld_paths(t.rpath, path=path, root=root)
+                elif t.entry.d_tag == "DT_RUNPATH":
+                    runpaths = parse_ld_paths(t.runpath, path=path, root=root)
+                elif t.entry.d_tag == "DT_NEEDED":
+                    libs.append(t.needed)
+            if runpaths:
+                # If both RPATH and RUNPATH are set, only the latter is used.
+                rpaths = []
+            break
+        if _first:
+            # Propagate the rpaths used by the main ELF since those will be
+            # used at runtime to locate things.
+            ldpaths["rpath"] = rpaths
+            ldpaths["runpath"] = runpaths
+        ret["rpath"] = rpaths
+        ret["runpath"] = runpaths
+        ret["needed"] = libs
+
+        # Search for the libs this ELF uses.
+        all_ldpaths = (
+            ldpaths["rpath"]
+            + rpaths
+            + runpaths
+            + ldpaths["env"]
+            + ldpaths["runpath"]
+            + ldpaths["conf"]
+            + ldpaths["interp"]
+        )
+        for lib in libs:
+            if lib in _all_libs:
+                continue
+            # Where a lib resolves to depends on the search path, and on which libs
+            # find_lib considers compatible with this ELF. The search path for its own
+            # dependencies also depends on the main ELF's ldpaths.
+            key = (
+                lib,
+                elf.elfclass,
+                elf.little_endian,
+                elf.header["e_machine"],
+                elf.header["e_ident"]["EI_OSABI"],
+                tuple(all_ldpaths),
+                tuple((k, tuple(v)) for (k, v) in sorted(ldpaths.items())),
+            )
+            subtree = _subtree_memo.get(key)
+            if subtree is None:
+                realpath, fullpath = find_lib(elf, lib, all_ldpaths, root)
+                subtree = {lib: {"realpath": realpath, "path": fullpath, "needed": []}}
+                if realpath and fullpath:
+                    lret = lddtree(
+                        realpath,
+                        root,
+                        prefix,
+                        ldpaths,
+                        display=fullpath,
+                        _first=False,
+                        _all_libs=subtree,
+                    )
+                    subtree[lib]["needed"] = lret["needed"]
+                _subtree_memo[key] = subtree
+            for sub_lib, info in subtree.items():
+                if sub_lib not in _all_libs:
+                    _all_libs[sub_lib] = dict(info)
+
+        del elf
+
+    return ret
+
+
+# Runs in the worker pool. Returns None for files that turn out not to be ELF.
+def analyze_elf(fn, base_path):
+    try:
+        with open(fn, "rb") as f:
+            versioned_symbols = list(elf_find_versioned_symbols(ELFFile(f)))
+    except ELFError:
+        return None
+    elftree = lddtree(fn)
+    external_refs = lddtree_external_references(elftree, base_path)
+    return fn, elftree, external_refs, versioned_symbols
+
 
 # Copy/pasted and tweaked from auditwheel.wheel_abi.get_wheel_elfdata
-def get_tree_elfdata(base_path: Path):
+def get_tree_elfdata(base_path: Path, *, jobs=1, index=None):
     versioned_symbols = defaultdict(lambda: set())  # type: Dict[str, Set[str]]
     full_elftree = {}
     full_external_refs = {}
 
-    for fn, elf in elf_file_filter(
-        str(fn) for fn in base_path.rglob("*") if fn.is_file()
-    ):
-        elftree = lddtree(fn)
-        for key, value in elf_find_versioned_symbols(elf):
-            versioned_symbols[key].add(value)
+    if index is None:
+        index = TreeIndex(base_path)
+    # Spelled relative to base_path as given, like rglob would, since the paths end up
+    # in the results. Symlinks to files are included, like Path.is_file().
+    elf_paths = [
+        str(base_path / entry.path.relative_to(index.base_path))
+        for entry in index.files(follow_symlinks=True)
+        if is_elf(entry.path)
+    ]
+    base_paths = [base_path] * len(elf_paths)
+    if jobs == 1:
+        results = map(analyze_elf, elf_paths, base_paths)
+    else:
+        executor = ProcessPoolExecutor(jobs)
+        # Big chunks, so each worker gets to reuse its _subtree_memo a lot
+        chunksize = max(1, len(elf_paths) // (4 * jobs))
+        results = executor.map(analyze_elf, elf_paths, base_paths, chunksize=chunksize)
 
-        full_elftree[fn] = elftree
-        full_external_refs[fn] = lddtree_external_references(elftree, base_path)
+    try:
+        for result in results:
+            if result is None:
+                continue
+            fn, elftree, external_refs, symbols = result
+            for key, value in symbols:
+                versioned_symbols[key].add(value)
+
+            full_elftree[fn] = elftree
+            full_external_refs[fn] = external_refs
+    finally:
+        if jobs != 1:
+            executor.shutdown()
 
     return (full_elftree, full_external_refs, versioned_symbols)
 
 
-# Copy/pasted and tweaked from auditwheel.repair.repair_wheel
-# Takes the path to an unpacked pybi tree, and does the auditwheel vendoring.
-# ABI should be something like "manylinux_2_17_x86_64"
-def repair(base_path: Path, abi: str, *, lib_sdir=".libs"):
-    patcher = Patchelf()
+# Copy/pasted and tweaked from auditwheel.repair.copylib: the name that src_path gets
+# when it's grafted into the tree.
+def grafted_soname(src_path):
+    with open(src_path, "rb") as f:
+        shorthash = hashfile(f)[:8]
+
+    src_name = os.path.basename(src_path)
+    base, ext = src_name.split(".", 1)
+    if not base.endswith("-%s" % shorthash):
+        return f"{base}-{shorthash}.{ext}"
+    else:
+        return src_name
+
+
+def elf_read_raw_rpaths(fn):
+    # Returns the (DT_RPATH, DT_RUNPATH) strings, or None if missing. Unlike
+    # auditwheel.elfutils.elf_read_rpaths, these are left as-is, without expanding
+    # $ORIGIN -- i.e., the same thing `patchelf --print-rpath` gives, without having to
+    # spawn patchelf.
+    rpath = runpath = None
+    with open(fn, "rb") as f:
+        section = ELFFile(f).get_section_by_name(".dynamic")
+        if section is not None:
+            for t in section.iter_tags():
+                if t.entry.d_tag == "DT_RPATH":
+                    rpath = t.rpath
+                elif t.entry.d_tag == "DT_RUNPATH":
+                    runpath = t.runpath
+    return rpath, runpath
 
-    external_refs_by_fn = get_tree_elfdata(base_path)[1]
+
+def new_patch():
+    return {
+        # old soname -> new soname
+        "replace_needed": {},
+        # new DT_SONAME, or None to leave it alone
+        "soname": None,
+        # new DT_RPATH, or None to leave it alone
+        "rpath": None,
+        # Set if the file has both DT_RPATH and DT_RUNPATH, in which case patchelf needs
+        # a separate --remove-rpath pass before --set-rpath does the right thing.
+        "remove_rpath": False,
+    }
+
+
+def set_rpath(patch, fn, rpath):
+    old_rpath, old_runpath = elf_read_raw_rpaths(fn)
+    patch["rpath"] = rpath
+    patch["remove_rpath"] = old_rpath is not None and old_runpath is not None
+
+
+def patchelf_commands(fn, patch):
+    commands = []
+    args = []
+    for old, new in patch["replace_needed"].items():
+        args += ["--replace-needed", old, new]
+    if patch["soname"] is not None:
+        args += ["--set-soname", patch["soname"]]
+    if patch["rpath"] is not None:
+        if patch["remove_rpath"]:
+            commands.append(["patchelf", "--remove-rpath", fn])
+        args += ["--force-rpath", "--set-rpath", patch["rpath"]]
+    if args:
+        commands.append(["patchelf", *args, fn])
+    return commands
+
+
+# Copy/pasted and tweaked from auditwheel.repair.repair_wheel
+#
+# Instead of patching files as we go (one patchelf subprocess per soname per file, plus
+# a few more per file for the rpath, and each one rewriting the whole file), we first
+# work out the full plan: which libraries to graft in, and every edit for every file.
+# Then each file gets all its edits in a single patchelf invocation, with files patched
+# in parallel.
+#
+# Returns the plan, as (grafts, patches), where grafts is a list of (src_path,
+# dest_path) copies, and patches maps each file path to its patch (see new_patch).
+def plan_repair(
+    base_path: Path, abi: str, *, lib_sdir=".libs", jobs=1, trace=None, index=None
+):
+    with trace_stage(trace, "ELF scan"):
+        external_refs_by_fn = get_tree_elfdata(base_path, jobs=jobs, index=index)[1]
 
     soname_map = {}  # type: Dict[str, Tuple[str, str]]
+    grafts = []
+    patches = defaultdict(new_patch)
 
     dest_dir = base_path / lib_sdir
-    dest_dir.mkdir(parents=True, exist_ok=True)
 
     # here, fn is a path to an ELF file in the wheel, and v['libs'] contains its
     # required libs
     for fn, v in external_refs_by_fn.items():
+        if os.path.islink(fn):
+            # Its target is in the tree too, and gets its own entry. Patching both would
+            # run two patchelfs on the same file at once.
+            continue
         ext_libs = v[abi]["libs"]  # type: Dict[str, str]
         for soname, src_path in ext_libs.items():
             if src_path is None:
@@ -61,21 +364,109 @@ def repair(base_path: Path, abi: str, *, lib_sdir=".libs"):
                     % soname
                 )
 
-            new_soname, new_path = copylib(src_path, dest_dir, patcher)
-            soname_map[soname] = (new_soname, new_path)
-            patcher.replace_needed(fn, soname, new_soname)
+            if soname not in soname_map:
+                new_soname = grafted_soname(src_path)
+                new_path = str(dest_dir / new_soname)
+                soname_map[soname] = (new_soname, new_path)
+                # Like copylib, leave alone anything that was grafted in on an earlier
+                # run
+                if not os.path.exists(new_path):
+                    grafts.append((src_path, new_path))
+                    patch = patches[new_path]
+                    patch["soname"] = new_soname
+                    rpaths = elf_read_rpaths(src_path)
+                    if any(itertools.chain(rpaths["rpaths"], rpaths["runpaths"])):
+                        set_rpath(patch, src_path, str(dest_dir))
+            new_soname = soname_map[soname][0]
+            patches[fn]["replace_needed"][soname] = new_soname
 
         if len(ext_libs) > 0:
             new_rpath = os.path.relpath(dest_dir, os.path.dirname(fn))
             new_rpath = os.path.join("$ORIGIN", new_rpath)
-            append_rpath_within_wheel(fn, new_rpath, base_path, patcher)
+            # Copy/pasted and tweaked from auditwheel.repair.append_rpath_within_wheel:
+            # keep existing entries that point inside the tree, and add ours.
+            old_rpath, old_runpath = elf_read_raw_rpaths(fn)
+            old_rpaths = (old_runpath or old_rpath or "").split(":")
+            lib_dir = os.path.dirname(os.path.abspath(fn))
+            rpath_set = {
+                old: None
+                for old in old_rpaths
+                if is_valid_rpath(old, lib_dir, str(base_path.absolute()))
+            }
+            rpath_set[new_rpath] = None
+            set_rpath(patches[fn], fn, ":".join(rpath_set))
 
     # we grafted in a bunch of libraries and modified their sonames, but
     # they may have internal dependencies (DT_NEEDED) on one another, so
     # we need to update those records so each now knows about the new
     # name of the other.
-    for old_soname, (new_soname, path) in soname_map.items():
-        needed = elf_read_dt_needed(path)
-        for n in needed:
+    for src_path, new_path in grafts:
+        for n in elf_read_dt_needed(src_path):
             if n in soname_map:
-                patcher.replace_needed(path, n, soname_map[n][0])
+                patches[new_path]["replace_needed"][n] = soname_map[n][0]
+
+    return grafts, dict(patches)
+
+
+def print_repair_plan(grafts, patches):
+    for src_path, dest_path in grafts:
+        print(f"graft {src_path} -> {dest_path}")
+    for fn, patch in sorted(patches.items()):
+        for command in patchelf_commands(fn, patch):
+            print(shlex.join(command))
+
+
+# If given a pybi.TreeIndex of the tree, keeps it up to date with the grafted and
+# patched files.
+def apply_repair_plan(grafts, patches, *, jobs=1, index=None):
+    # Make sure patchelf is actually available before we start touching things
+    Patchelf()
+
+    for src_path, dest_path in grafts:
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        shutil.copy2(src_path, dest_path)
+        statinfo = os.stat(dest_path)
+        if not statinfo.st_mode & stat.S_IWRITE:
+            os.chmod(dest_path, statinfo.st_mode | stat.S_IWRITE)
+        if index is not None:
+            index.update(dest_path)
+
+    def patch_file(item):
+        fn, patch = item
+        for command in patchelf_commands(fn, patch):
+            subprocess.run(command, check=True)
+
+    # patchelf does the work in a subprocess, so threads are enough
+    with ThreadPoolExecutor(jobs) as executor:
+        list(executor.map(patch_file, patches.items()))
+    if index is not None:
+        for fn in patches:
+            index.update(fn)
+
+
+# Takes the path to an unpacked pybi tree, and does the auditwheel vendoring.
+# ABI should be something like "manylinux_2_17_x86_64"
+def repair(
+    base_path: Path,
+    abi: str,
+    *,
+    lib_sdir=".libs",
+    jobs=1,
+    dry_run=False,
+    trace=None,
+    index=None,
+):
+    # index is an optional pybi.TreeIndex of base_path. Pass one in to have it kept up
+    # to date, so it can be reused for make_pybi afterwards.
+    if index is None:
+        index = TreeIndex(base_path)
+    with trace_stage(trace, "plan repair"):
+        grafts, patches = plan_repair(
+            base_path, abi, lib_sdir=lib_sdir, jobs=jobs, trace=trace, index=index
+        )
+    if dry_run:
+        print_repair_plan(grafts, patches)
+    else:
+        with trace_stage(trace, "apply repair"):
+            apply_repair_plan(grafts, patches, jobs=jobs, index=index)
+    return grafts, patches
@@ -0,0 +1,203 @@
+import email
+import json
+import os
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# Declarative description of what we can prune from an interpreter tree before packing
+# it. Each rule lists (sysconfig path name, glob pattern) pairs. The paths come from
+# the Pybi-Paths in pybi-info/METADATA (plus "base" for the root of the tree), so the
+# same rule works for every platform's layout. A pattern without wildcards names a
+# single file or directory, and "." means the path itself.
+RULES = {
+    # pip and friends get installed by the upstream builds, but pybis should start out
+    # with an empty site-packages.
+    "site-packages": {
+        "remove": [("purelib", "*"), ("scripts", "pip*")],
+        "keep": [("purelib", "README.txt")],
+    },
+    "tests": {
+        "remove": [
+            ("stdlib", "test"),
+            ("stdlib", "**/test"),
+            ("stdlib", "**/tests"),
+            ("stdlib", "**/idle_test"),
+            ("stdlib", "lib-dynload/_*test*"),
+            ("base", "DLLs/_*test*.pyd"),
+        ],
+    },
+    "idle-tkinter": {
+        "remove": [
+            ("stdlib", "idlelib"),
+            ("stdlib", "tkinter"),
+            ("stdlib", "turtle.py"),
+            ("stdlib", "turtledemo"),
+            ("stdlib", "lib-dynload/_tkinter*"),
+            ("scripts", "idle*"),
+            ("data", "lib/libtcl8*"),
+            ("data", "lib/libtk8*"),
+            ("data", "lib/tcl8*"),
+            ("data", "lib/tk8*"),
+            ("base", ".libs/libtcl8*"),
+            ("base", ".libs/libtk8*"),
+            ("base", "DLLs/_tkinter.pyd"),
+            ("base", "DLLs/tcl*.dll"),
+            ("base", "DLLs/tk*.dll"),
+            ("base", "tcl"),
+        ],
+    },
+    "ensurepip-wheels": {
+        "remove": [("stdlib", "ensurepip/_bundled/*.whl")],
+    },
+    "static-libs": {
+        "remove": [("base", "**/*.a")],
+    },
+    "headers": {
+        "remove": [("include", "."), ("platinclude", ".")],
+    },
+    # Not a removal: runs `strip --strip-debug` on every ELF file. Does nothing on
+    # platforms that don't use ELF.
+    "debug-symbols": {
+        "strip": True,
+    },
+}
+
+PROFILES = {
+    "minimal": ["site-packages"],
+    "no-tests": ["site-packages", "tests", "debug-symbols"],
+    "slim": [
+        "site-packages",
+        "tests",
+        "idle-tkinter",
+        "ensurepip-wheels",
+        "static-libs",
+        "headers",
+        "debug-symbols",
+    ],
+}
+
+ELF_MAGIC = b"\x7fELF"
+
+
+def read_pybi_paths(base_path):
+    metadata = email.message_from_bytes(
+        (base_path / "pybi-info" / "METADATA").read_bytes()
+    )
+    paths = json.loads(metadata["Pybi-Paths"])
+    paths["base"] = "."
+    return paths
+
+
+def tree_size(path):
+    # Returns (file count, total bytes)
+    if path.is_symlink() or not path.is_dir():
+        return 1, path.lstat().st_size
+    count = 0
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            count += 1
+            size += os.lstat(os.path.join(dirpath, filename)).st_size
+    return count, size
+
+
+def match_rule_paths(base_path, pybi_paths, patterns):
+    matched = set()
+    for key, pattern in patterns:
+        if key not in pybi_paths:
+            continue
+        root = base_path / pybi_paths[key]
+        if not root.is_dir():
+            continue
+        if any(c in pattern for c in "*?["):
+            matched.update(root.glob(pattern))
+        else:
+            path = (root / pattern).absolute()
+            if path.exists() or path.is_symlink():
+                matched.add(path)
+    return matched
+
+
+def remove_path(path):
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path)
+    else:
+        path.unlink()
+
+
+def strip_debug_symbols(base_path, *, jobs=1, index=None):
+    # Returns (file count, bytes saved)
+    if shutil.which("strip") is None:
+        print("  (no strip binary found, skipping debug symbol stripping)")
+        return 0, 0
+    if index is not None:
+        paths = [entry.path for entry in index.files()]
+    else:
+        paths = [
+            path
+            for path in base_path.rglob("*")
+            if not path.is_symlink() and path.is_file()
+        ]
+    elf_paths = []
+    for path in paths:
+        with open(path, "rb") as f:
+            if f.read(len(ELF_MAGIC)) == ELF_MAGIC:
+                elf_paths.append(path)
+
+    def strip_one(path):
+        before = path.stat().st_size
+        subprocess.run(["strip", "--strip-debug", str(path)], check=True)
+        return before - path.stat().st_size
+
+    with ThreadPoolExecutor(jobs) as executor:
+        saved = sum(executor.map(strip_one, elf_paths))
+    if index is not None:
+        for path in elf_paths:
+            index.update(path)
+    return len(elf_paths), saved
+
+
+# Applies a profile (a name from PROFILES, or a list of rule names) to an unpacked tree
+# that already has its pybi-info/METADATA. Prints and returns how much each rule
+# removed, as {rule name: (file count, bytes)}. If given a pybi.TreeIndex of the tree,
+# keeps it up to date.
+def prune_tree(base_path, profile, *, jobs=1, index=None):
+    base_path = Path(base_path).absolute()
+    if isinstance(profile, str):
+        rule_names = PROFILES[profile]
+        print(f"Pruning with profile {profile!r}:")
+    else:
+        rule_names = list(profile)
+        print(f"Pruning with rules {rule_names}:")
+    pybi_paths = read_pybi_paths(base_path)
+    pybi_info_path = base_path / "pybi-info"
+
+    report = {}
+    for rule_name in rule_names:
+        rule = RULES[rule_name]
+        if rule.get("strip"):
+            report[rule_name] = strip_debug_symbols(base_path, jobs=jobs, index=index)
+        else:
+            keep = match_rule_paths(base_path, pybi_paths, rule.get("keep", []))
+            doomed = match_rule_paths(base_path, pybi_paths, rule["remove"]) - keep
+            count = 0
+            size = 0
+            # Shortest first, so we don't try to remove things inside a directory
+            # we've already removed
+            for path in sorted(doomed, key=lambda p: len(p.parts)):
+                if path == pybi_info_path or pybi_info_path in path.parents:
+                    continue
+                if not (path.exists() or path.is_symlink()):
+                    continue
+                path_count, path_size = tree_size(path)
+                count += path_count
+                size += path_size
+                remove_path(path)
+                if index is not None:
+                    index.update(path)
+            report[rule_name] = (count, size)
+        count, size = report[rule_name]
+        print(f"  {rule_name}: {count} files, {size / 2 ** 20:.1f} MiB")
+    return report
@@ -5,17 +5,56 @@ import csv
 import base64
 import os
 import os.path
+import posixpath
 import io
 import json
 from pathlib import Path, PurePosixPath
 import subprocess
-from tempfile import TemporaryDirectory
+import tempfile
+from tempfile import TemporaryDirectory, SpooledTemporaryFile
+import shutil
+import stat
 import itertools
+import collections
+import contextlib
+import functools
+import threading
+import zlib
+import struct
+import socket
+import time
+import marshal
+import mmap
+import argparse
+import email
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+from prune import prune_tree, read_pybi_paths
+
+RECORD_NAME = "pybi-info/RECORD"
+# Where pack_pybi(run_in_place=...) puts the table of stdlib members that can be
+# imported straight out of the pybi; see run_in_place.py
+RUN_IN_PLACE_NAME = "pybi-info/RUN-IN-PLACE"
+# marshal format version of that table: the newest that every Python we build (3.6+)
+# can read
+RUN_IN_PLACE_MARSHAL_VERSION = 4
 
 SYMLINK_MODE = 0xA000
 SYMLINK_MASK = 0xF000
 MODE_SHIFT = 16
 
+CHUNK_SIZE = 1024 * 1024
+# Each member's compressed data is buffered in memory up to this size while it waits
+# to be written, and spills to a temporary file beyond that.
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+DEFAULT_BLOB_CACHE_SIZE = 10 * 1024 ** 3
+
 
 def path_in(inner, outer):
     return os.path.commonpath([inner, outer]) == str(outer)
@@ -25,6 +64,9 @@ def path_in(inner, outer):
 # absolute path to the interpreter, which of course will break if the interpreter is
 # unpacked at a different location. This replaces those #! lines with some
 # location-independent magic.
+#
+# Only the first line of data is examined, so callers can pass just the first line of
+# the file and stream the rest through unchanged.
 def fixup_shebang(base_path, scripts_path, path, data):
     if not data.startswith(b"#!"):
         return data
@@ -59,13 +101,618 @@ exec "$(dirname "$SCRIPT")/{interpreter_relative}" "$0" "$@"
     return (new_shebang + rest).encode("utf-8")
 
 
-def is_exec_bit_set(path):
+def is_exec_mode(mode):
     if os.name != "posix":
         return False
-    return bool(path.stat().st_mode & 0o100)
+    return bool(mode & 0o100)
+
+
+def ordered_map(fn, iterable, jobs):
+    # Like map(), but runs fn on a thread pool. Results come back in order, and only a
+    # bounded number of them are in flight at once, so we don't end up buffering a
+    # whole interpreter's worth of compressed data while waiting on one slow file.
+    if jobs == 1:
+        yield from map(fn, iterable)
+        return
+    with ThreadPoolExecutor(jobs) as executor:
+        pending = collections.deque()
+        for item in iterable:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= 2 * jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def read_chunks(f):
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+def member_chunks(f, fixup=None):
+    # Chunks of a member's contents. If fixup is given, it's applied to the first line
+    # if that's a #! line -- this only ever looks at the first line, so even binaries
+    # in the scripts directory stream through without being read in full.
+    if fixup is not None:
+        head = f.read(2)
+        if head == b"#!":
+            head += f.readline()
+            head = fixup(head)
+        yield head
+    yield from read_chunks(f)
+
+
+def hash_chunks(chunks):
+    # Returns (sha256 digest, size, crc32)
+    hasher = hashlib.new("sha256")
+    size = 0
+    crc = 0
+    for chunk in chunks:
+        hasher.update(chunk)
+        size += len(chunk)
+        crc = zlib.crc32(chunk, crc)
+    return hasher.digest(), size, crc
+
+
+def deflate_chunks(chunks, out, compresslevel=None):
+    # Streams chunks through sha256, crc32, and a raw deflate stream (exactly as
+    # zipfile would produce for ZIP_DEFLATED), writing the compressed bytes to out.
+    # zlib and hashlib release the GIL, so this parallelizes fine on threads.
+    #
+    # Returns (sha256 digest, uncompressed size, crc32)
+    if compresslevel is None:
+        compresslevel = zlib.Z_DEFAULT_COMPRESSION
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    hasher = hashlib.new("sha256")
+    size = 0
+    crc = 0
+    for chunk in chunks:
+        hasher.update(chunk)
+        size += len(chunk)
+        crc = zlib.crc32(chunk, crc)
+        out.write(compressor.compress(chunk))
+    out.write(compressor.flush())
+    return hasher.digest(), size, crc
+
+
+def store_chunks(chunks, out):
+    # Like deflate_chunks, but for ZIP_STORED members: the chunks are written to out
+    # as-is.
+    def passthrough():
+        for chunk in chunks:
+            out.write(chunk)
+            yield chunk
+
+    return hash_chunks(passthrough())
+
+
+# The zipfile internals that write_compressed relies on
+ZIPFILE_INTERNALS = ["_lock", "_seekable", "_writecheck", "_didModify", "start_dir"]
+
+
+def write_compressed(z, zi, compressed):
+    # Append an entry whose payload has already been compressed. zipfile has no public
+    # API for this, so this mirrors what ZipFile.mkdir does internally. zi must already
+    # have compress_type, CRC, file_size, and compress_size filled in. compressed is a
+    # file object positioned at the start of the payload.
+    if not all(hasattr(z, attr) for attr in ZIPFILE_INTERNALS) or not hasattr(
+        zi, "FileHeader"
+    ):
+        write_recompressed(z, zi, compressed)
+        return
+    with z._lock:
+        if z._seekable:
+            z.fp.seek(z.start_dir)
+        zi.header_offset = z.fp.tell()
+        z._writecheck(zi)
+        z._didModify = True
+        z.fp.write(zi.FileHeader())
+        shutil.copyfileobj(compressed, z.fp, CHUNK_SIZE)
+        z.filelist.append(zi)
+        z.NameToInfo[zi.filename] = zi
+        z.start_dir = z.fp.tell()
+
+
+def write_recompressed(z, zi, compressed):
+    # write_compressed's fallback, for a zipfile whose internals have changed: only
+    # uses public API, by decompressing the payload and letting ZipFile.open compress
+    # it again. Slower, the compressed bytes can differ, and on unseekable outputs it
+    # needs a data descriptor, but the contents (and so CRC and RECORD) are the same.
+    if zi.compress_type == zipfile.ZIP_DEFLATED:
+        chunks = inflate_chunks(read_chunks(compressed))
+    else:
+        chunks = read_chunks(compressed)
+    with z.open(zi, "w") as out:
+        for chunk in chunks:
+            out.write(chunk)
+
+
+ArchiveDigest = collections.namedtuple("ArchiveDigest", ["sha256", "size"])
+
+
+class DigestWriter:
+    # Wraps a writable binary stream, and computes the sha256 and size of everything
+    # written through it, so nobody has to read the archive back to hash it. It has
+    # tell() but no seek(), which makes zipfile write in streaming mode: it never goes
+    # back to patch up earlier bytes, so the digest stays valid. pack_pybi knows each
+    # member's sizes and CRC before writing its local header, so this costs nothing --
+    # no data descriptors, and the output is the same as writing to a regular file.
+    def __init__(self, f):
+        self._f = f
+        self._hasher = hashlib.new("sha256")
+        self.size = 0
+
+    def write(self, data):
+        self._f.write(data)
+        self._hasher.update(data)
+        self.size += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        self._f.flush()
+
+    def digest(self):
+        return ArchiveDigest(self._hasher.hexdigest(), self.size)
+
+
+class BlobCache:
+    # On-disk cache of compressed member payloads, keyed by the sha256 of the
+    # uncompressed data + the compression settings. Most of the stdlib is byte-identical
+    # between patch releases and between platforms, so when rebuilding the whole matrix
+    # most members can be copied straight out of here instead of being recompressed.
+    #
+    # Each entry's mtime doubles as its last-used time, and trim() evicts the least
+    # recently used entries once the cache is over max_size. Entries are written
+    # atomically, so it's safe for concurrent builds to share a cache directory.
+    def __init__(self, path, max_size=DEFAULT_BLOB_CACHE_SIZE):
+        self.path = Path(path)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _entry_path(self, key):
+        return self.path / key[:2] / key
+
+    def get(self, key):
+        # Returns an open file, or None
+        entry_path = self._entry_path(key)
+        try:
+            f = open(entry_path, "rb")
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass
+        return f
+
+    def put(self, key, f):
+        # Copies f (from its current position) into the cache
+        entry_path = self._entry_path(key)
+        entry_path.parent.mkdir(parents=True, exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=entry_path.parent, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                shutil.copyfileobj(f, out, CHUNK_SIZE)
+            os.replace(temp, entry_path)
+        except BaseException:
+            os.unlink(temp)
+            raise
+
+    def trim(self):
+        entries = []
+        total = 0
+        for entry_path in self.path.glob("*/*"):
+            if entry_path.name.startswith(".tmp-"):
+                continue
+            try:
+                st = entry_path.stat()
+            except FileNotFoundError:
+                # someone else evicted it
+                continue
+            entries.append((st.st_mtime, st.st_size, entry_path))
+            total += st.st_size
+        entries.sort()
+        for _, size, entry_path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                entry_path.unlink()
+            except OSError:
+                # Already gone, or (on Windows) in use by another build
+                continue
+            total -= size
+
+
+class CompressionPolicy:
+    # Decides how each member gets stored. The pybi spec (like the wheel spec) only
+    # allows ZIP_STORED and ZIP_DEFLATED, so the choice is "stored" or "deflate at some
+    # level". Each file lands in a category, which pack_pybi also uses to report where
+    # the time and bytes went:
+    #
+    #   precompressed: known compressed formats (.whl, .zip, .png, .gz, ...), stored
+    #   incompressible: a quick trial compression of the file's first trial_size bytes
+    #       saved less than incompressible_saving, so deflating it is a waste of time
+    #   large-binary: shared libraries, extension modules and static archives of at
+    #       least binary_min_size, deflated at binary_level. These are most of every
+    #       download and most of the packing time. Defaults to the normal level: on
+    #       libpython, level 9 is ~3x slower than 6 and saves under 1%, but with the
+    #       blob cache the slower level is only paid once, so it's a knob worth having.
+    #   default: everything else, deflated at level
+    PRECOMPRESSED_SUFFIXES = {
+        ".whl", ".zip", ".egg", ".jar", ".gz", ".tgz", ".bz2", ".xz", ".lzma", ".zst",
+        ".png", ".jpg", ".jpeg", ".gif", ".icns", ".webp",
+    }
+    BINARY_SUFFIXES = {".so", ".dylib", ".dll", ".pyd", ".exe", ".a", ".lib"}
+
+    def __init__(
+        self,
+        level=6,
+        *,
+        binary_level=None,
+        binary_min_size=1024 * 1024,
+        trial_size=64 * 1024,
+        trial_min_size=4096,
+        incompressible_saving=0.05,
+    ):
+        self.level = level
+        self.binary_level = level if binary_level is None else binary_level
+        self.binary_min_size = binary_min_size
+        self.trial_size = trial_size
+        self.trial_min_size = trial_min_size
+        self.incompressible_saving = incompressible_saving
+
+    def is_binary(self, path):
+        if path.suffix.lower() in self.BINARY_SUFFIXES or ".so." in path.name:
+            return True
+        with open(path, "rb") as f:
+            return f.read(4) == b"\x7fELF"
+
+    def choose(self, path, size=None):
+        # Returns (category, compress_type, compresslevel)
+        if size is None:
+            size = path.stat().st_size
+        if path.suffix.lower() in self.PRECOMPRESSED_SUFFIXES:
+            return "precompressed", zipfile.ZIP_STORED, None
+        if size >= self.trial_min_size:
+            with open(path, "rb") as f:
+                sample = f.read(self.trial_size)
+            # size can be stale (say, from a TreeIndex), and the file empty by now
+            if sample:
+                saving = 1 - len(zlib.compress(sample, 1)) / len(sample)
+                if saving < self.incompressible_saving:
+                    return "incompressible", zipfile.ZIP_STORED, None
+        if size >= self.binary_min_size and self.is_binary(path):
+            return "large-binary", zipfile.ZIP_DEFLATED, self.binary_level
+        return "default", zipfile.ZIP_DEFLATED, self.level
+
+
+class BuildTrace:
+    # Optional instrumentation for make_pybi, pack_pybi and linux_vendor.repair: pass
+    # one in as trace= and it records the wall and CPU time of each stage, plus what
+    # each file cost to pack. Afterwards it can print a summary, and write the data out
+    # as JSON and as a Chrome trace-event file (load it in chrome://tracing or
+    # https://ui.perfetto.dev).
+    #
+    # CPU time is split into our own process (all threads) and child processes, since
+    # the interpreter probe, compileall and patchelf all run as subprocesses.
+    def __init__(self):
+        self.stages = []
+        self.files = []
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def now(self):
+        # Seconds since the trace started
+        return time.perf_counter() - self._start
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = self.now()
+        cpu_start = time.process_time()
+        times_start = os.times()
+        try:
+            yield
+        finally:
+            times_end = os.times()
+            child_cpu = (times_end.children_user + times_end.children_system) - (
+                times_start.children_user + times_start.children_system
+            )
+            with self._lock:
+                self.stages.append(
+                    {
+                        "name": name,
+                        "start": start,
+                        "wall": self.now() - start,
+                        "cpu": time.process_time() - cpu_start,
+                        "child_cpu": child_cpu,
+                        "thread": threading.get_ident(),
+                    }
+                )
+
+    def add_file(self, name, *, category, bytes_in, bytes_out, start, seconds, thread):
+        with self._lock:
+            self.files.append(
+                {
+                    "name": name,
+                    "category": category,
+                    "bytes_in": bytes_in,
+                    "bytes_out": bytes_out,
+                    "start": start,
+                    "seconds": seconds,
+                    "thread": thread,
+                }
+            )
+
+    def print_summary(self, top_n=10):
+        print("Stages (wall / cpu / child cpu seconds):")
+        for stage in self.stages:
+            print(
+                f"  {stage['name']:>30}: {stage['wall']:8.2f} {stage['cpu']:8.2f} "
+                f"{stage['child_cpu']:8.2f}"
+            )
+        if self.files:
+            print(f"Top {top_n} most expensive files:")
+            for f in sorted(self.files, key=lambda f: f["seconds"], reverse=True)[
+                :top_n
+            ]:
+                print(
+                    f"  {f['seconds']:8.3f} s  {f['bytes_in']:>12} -> "
+                    f"{f['bytes_out']:>12}  {f['name']}"
+                )
+
+    def chrome_trace_events(self):
+        pid = os.getpid()
+        events = []
+        for stage in self.stages:
+            events.append(
+                {
+                    "name": stage["name"],
+                    "cat": "stage",
+                    "ph": "X",
+                    "ts": stage["start"] * 1e6,
+                    "dur": stage["wall"] * 1e6,
+                    "pid": pid,
+                    "tid": stage["thread"],
+                    "args": {"cpu": stage["cpu"], "child_cpu": stage["child_cpu"]},
+                }
+            )
+        for f in self.files:
+            events.append(
+                {
+                    "name": f["name"],
+                    "cat": f["category"],
+                    "ph": "X",
+                    "ts": f["start"] * 1e6,
+                    "dur": f["seconds"] * 1e6,
+                    "pid": pid,
+                    "tid": f["thread"],
+                    "args": {"bytes_in": f["bytes_in"], "bytes_out": f["bytes_out"]},
+                }
+            )
+        return events
+
+    def write(self, path_prefix):
+        # Writes {path_prefix}.trace.json and {path_prefix}.chrome.json
+        path_prefix = Path(path_prefix)
+        path_prefix.parent.mkdir(parents=True, exist_ok=True)
+        trace_path = path_prefix.with_name(path_prefix.name + ".trace.json")
+        trace_path.write_text(
+            json.dumps({"stages": self.stages, "files": self.files}, indent=1)
+        )
+        chrome_path = path_prefix.with_name(path_prefix.name + ".chrome.json")
+        chrome_path.write_text(json.dumps({"traceEvents": self.chrome_trace_events()}))
+        return trace_path, chrome_path
+
+
+def trace_stage(trace, name):
+    # For code that takes an optional trace
+    if trace is None:
+        return contextlib.nullcontext()
+    return trace.stage(name)
+
+
+def trace_from_env():
+    # The build scripts turn tracing on when $PYBI_TRACE_DIR is set; see save_trace
+    if os.environ.get("PYBI_TRACE_DIR"):
+        return BuildTrace()
+    return None
+
+
+def save_trace(trace, name):
+    if trace is None:
+        return
+    trace.print_summary()
+    trace_path, chrome_path = trace.write(Path(os.environ["PYBI_TRACE_DIR"]) / name)
+    print(f"Wrote {trace_path} and {chrome_path}")
+
+
+def default_cache_path():
+    return Path(
+        os.environ.get("PYBI_TOOLS_CACHE", Path.home() / ".cache" / "pybi-tools")
+    )
+
+
+def platform_allows_symlinks(platform_tag):
+    return not platform_tag.startswith("win")
+
+
+TreeEntry = collections.namedtuple(
+    "TreeEntry", ["path", "kind", "mode", "size", "link_target"]
+)
+
+
+class TreeIndex:
+    # One os.scandir walk over a tree, remembering what pack_pybi, prune and
+    # linux_vendor need to know about each entry: its kind ("file", "dir", "symlink" or
+    # "other"), mode, size, and symlink target. That's one lstat per entry, where
+    # otherwise each of them would re-walk the tree with rglob and make several
+    # is_symlink/is_file/stat calls per path. Like rglob, symlinks to directories
+    # aren't followed.
+    #
+    # Anything that changes the tree after it's been indexed (grafting libraries,
+    # patchelf, pruning, strip) calls update() on what it touched.
+    def __init__(self, base_path):
+        self.base_path = Path(base_path).resolve()
+        self.entries = {}
+        # {directory path: set of paths directly inside it}, so update() only has to
+        # visit what it replaces. Callers update one file at a time, so scanning every
+        # entry on each update would make a big prune or repair quadratic.
+        self._children = collections.defaultdict(set)
+        self._sorted_paths = None
+        self._scan(self.base_path)
+
+    def _add(self, path, st):
+        link_target = None
+        if stat.S_ISLNK(st.st_mode):
+            kind = "symlink"
+            link_target = os.readlink(path)
+        elif stat.S_ISDIR(st.st_mode):
+            kind = "dir"
+        elif stat.S_ISREG(st.st_mode):
+            kind = "file"
+        else:
+            kind = "other"
+        self.entries[path] = TreeEntry(path, kind, st.st_mode, st.st_size, link_target)
+        self._children[path.parent].add(path)
+        self._sorted_paths = None
+
+    def _drop(self, path):
+        # Removes path, and everything under it if it's a directory
+        entry = self.entries.pop(path, None)
+        if entry is None:
+            return
+        self._children[path.parent].discard(path)
+        if entry.kind == "dir":
+            for child in self._children.pop(path, ()):
+                self._drop(child)
+
+    def _scan(self, dir_path):
+        pending = [dir_path]
+        while pending:
+            with os.scandir(pending.pop()) as it:
+                for dir_entry in it:
+                    path = Path(dir_entry.path)
+                    self._add(path, dir_entry.stat(follow_symlinks=False))
+                    if dir_entry.is_dir(follow_symlinks=False):
+                        pending.append(path)
+
+    def update(self, path):
+        # Re-reads path (and everything under it, if it's a directory), or drops it
+        # from the index if it's gone
+        # Resolve the parent but not path itself, which might be a symlink
+        path = Path(path)
+        path = path.parent.resolve() / path.name
+        path.relative_to(self.base_path)
+        self._sorted_paths = None
+        if path == self.base_path:
+            self.entries.clear()
+            self._children.clear()
+            self._scan(path)
+            return
+        self._drop(path)
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            return
+        for parent in path.relative_to(self.base_path).parents:
+            parent_path = self.base_path / parent
+            if parent_path != self.base_path and parent_path not in self.entries:
+                self._add(parent_path, os.lstat(parent_path))
+        self._add(path, st)
+        if stat.S_ISDIR(st.st_mode):
+            self._scan(path)
 
+    def __getitem__(self, path):
+        return self.entries[path]
 
-def pack_pybi(base, zipname, scripts_dir):
+    def paths(self):
+        # All paths, in the same order as sorted(base_path.rglob("*"))
+        if self._sorted_paths is None:
+            self._sorted_paths = sorted(self.entries)
+        return self._sorted_paths
+
+    def files(self, *, follow_symlinks=False):
+        # Regular files, in sorted order. With follow_symlinks, also symlinks that
+        # point at regular files (like Path.is_file()).
+        files = []
+        for path in self.paths():
+            entry = self.entries[path]
+            if entry.kind == "file" or (
+                follow_symlinks and entry.kind == "symlink" and path.is_file()
+            ):
+                files.append(entry)
+        return files
+
+
+def find_duplicates(entries, *, jobs=1):
+    # Takes TreeEntry objects, and returns {duplicate path: canonical path} for regular
+    # files that are byte-identical and have the same exec bit. The canonical copy is
+    # the first one in sorted order. Only files that share a size with some other file
+    # need to be hashed.
+    by_size = collections.defaultdict(list)
+    for entry in entries:
+        if entry.kind != "file":
+            continue
+        if entry.size == 0:
+            # Not worth it
+            continue
+        by_size[entry.size, is_exec_mode(entry.mode)].append(entry)
+    candidates = [
+        entry for group in by_size.values() if len(group) > 1 for entry in group
+    ]
+
+    def hash_entry(entry):
+        with open(entry.path, "rb") as f:
+            return hash_chunks(read_chunks(f))[0], is_exec_mode(entry.mode)
+
+    by_hash = collections.defaultdict(list)
+    for entry, key in zip(candidates, ordered_map(hash_entry, candidates, jobs)):
+        by_hash[key].append(entry.path)
+    duplicates = {}
+    for group in by_hash.values():
+        canonical, *rest = sorted(group)
+        for path in rest:
+            duplicates[path] = canonical
+    return duplicates
+
+
+def pack_pybi(
+    base,
+    zipname,
+    scripts_dir,
+    *,
+    jobs=1,
+    compresslevel=None,
+    cache=None,
+    dedup=False,
+    include_pyc=False,
+    policy=None,
+    trace=None,
+    index=None,
+    run_in_place=None,
+):
+    # zipname is a path, or any writable binary stream; it doesn't have to be seekable,
+    # so it can be a pipe or a socket. Returns an ArchiveDigest of what was written.
+    #
+    # policy is an optional CompressionPolicy. Without one, every file is deflated at
+    # compresslevel, so the archive doesn't depend on sniffing file contents.
+    #
+    # run_in_place is None, or the names (relative to base, with /s) of the stdlib
+    # sources that have to stay on disk when the pybi runs in place, as returned by
+    # run_in_place.prepare_tree.
+    #
     # *_path are absolute filesystem Path objects
     # *_name are relative PurePosixPath objects referring to locations in the zip file
     base_path = Path(base).resolve()
@@ -77,113 +724,978 @@ def pack_pybi(base, zipname, scripts_dir):
     record_name = pybi_info_name / "RECORD"
     records = [(str(record_name), "", "")]
 
-    z = zipfile.ZipFile(zipname, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True)
-    with z:
-        deferred = []
+    if compresslevel in (None, zlib.Z_DEFAULT_COMPRESSION):
+        # zlib's default, spelled out so that it gives the same cache keys
+        compresslevel = 6
+
+    if index is None:
+        with trace_stage(trace, "walk tree"):
+            index = TreeIndex(base_path)
+    elif index.base_path != base_path:
+        raise RuntimeError(f"index is for {index.base_path}, not {base_path}")
+    paths = index.paths()
+
+    # With run_in_place, the pure-Python stdlib is laid out so run_in_place.py can
+    # import it straight out of the archive: the __pycache__ pycs that it serves are
+    # stored rather than deflated, so importing them is just a slice of a memory map,
+    # and we record where each served member ends up in the archive. The sources are
+    # only read for tracebacks and inspect, so they stay deflated, unless there are no
+    # pycs.
+    stdlib_path = None
+    if run_in_place is not None:
+        pybi_paths = read_pybi_paths(base_path)
+        stdlib_path = base_path / pybi_paths["stdlib"]
+        # site-packages lives inside the stdlib directory, but it isn't the stdlib
+        not_stdlib_paths = [
+            base_path / pybi_paths[key]
+            for key in ["purelib", "platlib"]
+            if key in pybi_paths
+        ]
+
+    def in_stdlib(path):
+        return (
+            stdlib_path is not None
+            and path_in(path, stdlib_path)
+            and not any(path_in(path, other) for other in not_stdlib_paths)
+        )
 
-        def add_file(path):
+    # With dedup, files that are byte-identical to another file in the tree get stored
+    # as relative symlinks to it, e.g. python3.X vs python3 copies, or libraries that
+    # linux_vendor grafted in next to identical copies. Only valid for platforms that
+    # support symlinks.
+    duplicates = {}
+    if dedup:
+        def dedup_candidate(entry):
+            path = entry.path
             name = PurePosixPath(path.relative_to(base_path).as_posix())
-            if name == record_name:
-                return
-            if path.suffix == ".pyc":
-                return
-            if path.is_symlink():
-                if name.parents[0] == pybi_info_name:
-                    raise RuntimeError("can't have symlinks inside .pybi-info")
-                target = os.readlink(path)
-                if os.path.isabs(target):
-                    raise RuntimeError(
-                        f"absolute symlinks are forbidden: {path} -> {target}"
-                    )
-                target_normed = os.path.normpath(path.parent / target)
-                if not path_in(target_normed, base_path):
-                    raise RuntimeError(
-                        f"symlink points outside base: {path} -> {target}"
+            if name.parents[0] == pybi_info_name or path.suffix == ".pyc":
+                return False
+            if path_in(path, scripts_path) and entry.kind == "file":
+                # #! lines get rewritten relative to the script's location
+                with open(path, "rb") as f:
+                    return f.read(2) != b"#!"
+            return True
+
+        with trace_stage(trace, "dedup"):
+            duplicates = find_duplicates(
+                filter(dedup_candidate, index.files()), jobs=jobs
+            )
+        saved = sum(index[path].size for path in duplicates)
+        print(
+            f"Dedup: storing {len(duplicates)} duplicate files as symlinks, "
+            f"saving {saved} bytes"
+        )
+
+    # Symlinks, and the files they point to, stay on disk when running in place: the
+    # importer only knows about regular members
+    linked_paths = set(duplicates) | set(duplicates.values())
+    if stdlib_path is not None:
+        for entry in index.entries.values():
+            if entry.kind == "symlink":
+                linked_paths.add(entry.path)
+                linked_paths.add(
+                    Path(os.path.normpath(entry.path.parent / entry.link_target))
+                )
+
+    def is_served(path, name):
+        # Whether run_in_place.py imports this straight out of the pybi: stdlib sources,
+        # and their pycs in __pycache__ (stray pycs next to their sources are sourceless
+        # modules, which the importer doesn't do)
+        if not in_stdlib(path) or path in linked_paths:
+            return False
+        if path.suffix == ".py":
+            source_name = name
+        elif path.suffix == ".pyc" and path.parent.name == "__pycache__":
+            source_name = name.parent.parent / f"{path.name.split('.')[0]}.py"
+        else:
+            return False
+        return str(source_name) not in run_in_place
+
+    # Runs on the worker pool: does all the expensive per-file work (reading, hashing,
+    # compressing), and returns a fully filled-in ZipInfo + the bytes to write, plus the
+    # RECORD row, and a dict with the CompressionPolicy category and when/where/how long
+    # it took. Returns None for paths that don't go in the pybi.
+    def prepare_file(path):
+        name = PurePosixPath(path.relative_to(base_path).as_posix())
+        if name == record_name:
+            return None
+        # Normally .pyc files are just whatever stale leftovers the build happened to
+        # produce, but with include_pyc they're the ones compile_stdlib made
+        if path.suffix == ".pyc" and not include_pyc:
+            return None
+        start = time.perf_counter()
+        trace_start = trace.now() if trace is not None else 0.0
+        entry = index[path]
+        target = None
+        if entry.kind == "symlink":
+            if name.parents[0] == pybi_info_name:
+                raise RuntimeError("can't have symlinks inside .pybi-info")
+            target = entry.link_target
+            if os.path.isabs(target):
+                raise RuntimeError(
+                    f"absolute symlinks are forbidden: {path} -> {target}"
+                )
+            target_normed = os.path.normpath(path.parent / target)
+            if not path_in(target_normed, base_path):
+                raise RuntimeError(
+                    f"symlink points outside base: {path} -> {target}"
+                )
+            # This symlink is OK
+        elif path in duplicates:
+            target = Path(os.path.relpath(duplicates[path], path.parent)).as_posix()
+
+        if target is not None:
+            record = (str(name), f"symlink={target}", "")
+            data = target.encode("utf-8")
+            zi = zipfile.ZipInfo(str(name))
+            # on macOS, if the symlink doesn't have permission bits set, you can't
+            # follow the link!
+            zi.external_attr = (SYMLINK_MODE | 0o644) << MODE_SHIFT
+            zi.compress_type = zipfile.ZIP_STORED
+            zi.CRC = zlib.crc32(data)
+            zi.file_size = zi.compress_size = len(data)
+            cost = {
+                "category": "symlink",
+                "start": trace_start,
+                "seconds": time.perf_counter() - start,
+                "thread": threading.get_ident(),
+            }
+            return name, record, zi, io.BytesIO(data), cost
+        elif entry.kind == "file":
+            fixup = None
+            if path_in(path, scripts_path):
+                fixup = functools.partial(fixup_shebang, base_path, scripts_path, path)
+
+            served = run_in_place is not None and is_served(path, name)
+            if served and (path.suffix == ".pyc" or not include_pyc):
+                category, compress_type, level = "served", zipfile.ZIP_STORED, None
+            elif policy is None:
+                category, compress_type, level = (
+                    "default",
+                    zipfile.ZIP_DEFLATED,
+                    compresslevel,
+                )
+            else:
+                category, compress_type, level = policy.choose(path, entry.size)
+            compressed = None
+            if compress_type == zipfile.ZIP_STORED:
+                # Nothing to save by caching these
+                compressed = SpooledTemporaryFile(SPOOL_MAX_SIZE)
+                with open(path, "rb") as f:
+                    digest, size, crc = store_chunks(
+                        member_chunks(f, fixup), compressed
                     )
-                # This symlink is OK
-                records.append((str(name), f"symlink={target}", ""))
-                zi = zipfile.ZipInfo(str(name))
-                # on macOS, if the symlink doesn't have permission bits set, you can't
-                # follow the link!
-                zi.external_attr = (SYMLINK_MODE | 0o644) << MODE_SHIFT
-                z.writestr(zi, target)
-            elif path.is_file():
-                data = path.read_bytes()
-                if path_in(path, scripts_path):
-                    data = fixup_shebang(base_path, scripts_path, path, data)
-
-                hasher = hashlib.new("sha256")
-                hasher.update(data)
-                hashed = base64.urlsafe_b64encode(hasher.digest()).decode("ascii")
-                records.append((str(name), f"sha256={hashed}", str(len(data))))
-
-                if is_exec_bit_set(path):
-                    mode = 0o755
-                else:
-                    mode = 0o644
-                zi = zipfile.ZipInfo(str(name))
-                zi.external_attr = mode << MODE_SHIFT
-                zi.compress_type = zipfile.ZIP_DEFLATED
+            else:
+                if cache is not None:
+                    # Hash first, so on a cache hit we can skip compression entirely.
+                    with open(path, "rb") as f:
+                        digest, size, crc = hash_chunks(member_chunks(f, fixup))
+                    cache_key = f"{digest.hex()}-deflate{level}"
+                    compressed = cache.get(cache_key)
+                if compressed is None:
+                    # Files are streamed through in chunks, so memory use stays bounded
+                    # no matter how big libpython or the static archives are. The
+                    # compressed output spills to disk if it gets large.
+                    compressed = SpooledTemporaryFile(SPOOL_MAX_SIZE)
+                    with open(path, "rb") as f:
+                        digest, size, crc = deflate_chunks(
+                            member_chunks(f, fixup), compressed, level
+                        )
+                    if cache is not None:
+                        compressed.seek(0)
+                        cache.put(cache_key, compressed)
 
-                if name.parents[0] == pybi_info_name:
-                    deferred.append((zi, data))
-                else:
-                    z.writestr(zi, data)
+            hashed = base64.urlsafe_b64encode(digest).decode("ascii")
+            record = (str(name), f"sha256={hashed}", str(size))
+
+            if is_exec_mode(entry.mode):
+                mode = 0o755
             else:
-                pass
+                mode = 0o644
+            zi = zipfile.ZipInfo(str(name))
+            zi.external_attr = mode << MODE_SHIFT
+            zi.compress_type = compress_type
+            zi.CRC = crc
+            zi.file_size = size
+            zi.compress_size = compressed.seek(0, os.SEEK_END)
+            compressed.seek(0)
+            cost = {
+                "category": category,
+                "start": trace_start,
+                "seconds": time.perf_counter() - start,
+                "thread": threading.get_ident(),
+            }
+            return name, record, zi, compressed, cost
+        else:
+            return None
 
-        # Add all the normal files, and compute the full RECORD
-        for path in sorted(base_path.rglob("*")):
-            add_file(path)
+    # {category: [files, uncompressed bytes, compressed bytes, seconds]}
+    stats = collections.defaultdict(lambda: [0, 0, 0, 0.0])
+    with contextlib.ExitStack() as stack:
+        if hasattr(zipname, "write"):
+            out = zipname
+        else:
+            out = stack.enter_context(open(zipname, "wb"))
+        writer = DigestWriter(out)
+        z = stack.enter_context(
+            zipfile.ZipFile(
+                writer, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True
+            )
+        )
+        deferred = []
+        # {name relative to the stdlib: (local header offset, compression method,
+        # compressed size, size, mtime)} of the members run_in_place.py serves
+        served_members = {}
 
-        # Add the RECORD file
-        record = io.StringIO()
-        record_writer = csv.writer(
-            record, delimiter=",", quotechar='"', lineterminator="\n"
+        # Add all the normal files, and compute the full RECORD. The work happens in
+        # parallel, but results come back (and are written) in sorted order, so the
+        # output doesn't depend on jobs.
+        with trace_stage(trace, "hash, compress and write files"):
+            for prepared in ordered_map(prepare_file, paths, jobs):
+                if prepared is None:
+                    continue
+                name, record, zi, compressed, cost = prepared
+                if record is not None:
+                    records.append(record)
+                category_stats = stats[cost["category"]]
+                category_stats[0] += 1
+                category_stats[1] += zi.file_size
+                category_stats[2] += zi.compress_size
+                category_stats[3] += cost["seconds"]
+                if trace is not None:
+                    trace.add_file(
+                        str(name),
+                        bytes_in=zi.file_size,
+                        bytes_out=zi.compress_size,
+                        **cost,
+                    )
+                if name.parents[0] == pybi_info_name:
+                    deferred.append((zi, compressed))
+                    continue
+                with compressed:
+                    write_compressed(z, zi, compressed)
+                if run_in_place is not None and is_served(base_path / name, name):
+                    relative = name.relative_to(pybi_paths["stdlib"]).as_posix()
+                    served_members[relative] = (
+                        zi.header_offset,
+                        zi.compress_type,
+                        zi.compress_size,
+                        zi.file_size,
+                        # Only ever compared against timestamp pycs, which
+                        # compile_bytecode doesn't make
+                        int(time.mktime(zi.date_time + (0, 0, -1))),
+                    )
+
+        if run_in_place is not None:
+            # Written here rather than with the rest of pybi-info, and skipped by
+            # read_pybi_info, so it doesn't make metadata range requests any bigger:
+            # it lists the whole stdlib, so it's often bigger than RECORD
+            with trace_stage(trace, "write run-in-place table"):
+                zi, compressed, record = run_in_place_table(
+                    pybi_paths["stdlib"], served_members
+                )
+                records.append(record)
+                write_compressed(z, zi, compressed)
+
+        with trace_stage(trace, "write RECORD and pybi-info"):
+            # Add the RECORD file
+            record = io.StringIO()
+            record_writer = csv.writer(
+                record, delimiter=",", quotechar='"', lineterminator="\n"
+            )
+            record_writer.writerows(records)
+            # Same as z.writestr would do, but compressed up front, because in
+            # streaming mode writestr would need a data descriptor
+            record_data = record.getvalue().encode("utf-8")
+            zi = zipfile.ZipInfo(str(record_name), time.localtime(time.time())[:6])
+            zi.external_attr = 0o600 << MODE_SHIFT
+            zi.compress_type = zipfile.ZIP_DEFLATED
+            compressed = io.BytesIO()
+            _, zi.file_size, zi.CRC = deflate_chunks([record_data], compressed)
+            zi.compress_size = compressed.tell()
+            compressed.seek(0)
+            write_compressed(z, zi, compressed)
+
+            # Add the rest of the .pybi-info files, so that metadata is right at the end
+            # of the zip file and easy to find without downloading the whole file
+            for zi, compressed in deferred:
+                with compressed:
+                    write_compressed(z, zi, compressed)
+
+    print("Compression by category (seconds are summed over all workers):")
+    for category, (files, size, compress_size, elapsed) in sorted(stats.items()):
+        ratio = compress_size / size if size else 1
+        print(
+            f"  {category:>14}: {files:6} files, {size / 2 ** 20:8.1f} MiB -> "
+            f"{compress_size / 2 ** 20:8.1f} MiB ({ratio:6.1%}), {elapsed:7.2f} s"
         )
-        record_writer.writerows(records)
-        z.writestr(str(record_name), record.getvalue())
+    if cache is not None:
+        print(f"Blob cache: {cache.hits} hits, {cache.misses} misses")
+        with trace_stage(trace, "trim blob cache"):
+            cache.trim()
+    return writer.digest()
 
-        # Add the rest of the .pybi-info files, so that metadata is right at the end of
-        # the zip file and easy to find without downloading the whole file
-        for zi, data in deferred:
-            z.writestr(zi, data)
 
+def run_in_place_table(stdlib_name, members):
+    # Returns (ZipInfo, compressed data, RECORD row) for the RUN_IN_PLACE_NAME member,
+    # which tells run_in_place.py which stdlib members it can import out of the pybi,
+    # and where they are. It's marshalled, since the importer reads it at every startup,
+    # before anything but builtin modules can be imported.
+    directories = {"": set()}
+    for name in members:
+        entry = PurePosixPath(name)
+        for parent in entry.parents:
+            key = "" if parent == PurePosixPath(".") else parent.as_posix()
+            directories.setdefault(key, set()).add(entry.name)
+            entry = parent
+    table = {
+        "stdlib": stdlib_name,
+        "members": members,
+        "directories": {key: sorted(value) for (key, value) in directories.items()},
+    }
+    data = marshal.dumps(table, RUN_IN_PLACE_MARSHAL_VERSION)
+    zi = zipfile.ZipInfo(RUN_IN_PLACE_NAME)
+    zi.external_attr = 0o644 << MODE_SHIFT
+    zi.compress_type = zipfile.ZIP_DEFLATED
+    compressed = io.BytesIO()
+    digest, zi.file_size, zi.CRC = deflate_chunks([data], compressed)
+    zi.compress_size = compressed.tell()
+    compressed.seek(0)
+    hashed = base64.urlsafe_b64encode(digest).decode("ascii")
+    return zi, compressed, (RUN_IN_PLACE_NAME, f"sha256={hashed}", str(zi.file_size))
 
-def add_pybi_metadata(
-    base_path: Path, scripts_path: Path, platform_tag: str, out_dir_path: Path
-):
-    scripts_path = base_path / scripts_path
 
-    if os.name == "nt":
-        if not (scripts_path / "python.exe").exists():
-            raise RuntimeError(f"can't find python.exe in {scripts_path}")
+# Reading pybi-info/ without fetching the whole archive. pack_pybi puts the pybi-info
+# files right before the central directory, so the end-of-central-directory record,
+# the central directory, and the pybi-info members are one contiguous chunk at the end
+# of the file, and we can get everything with at most 3 range requests: one for the
+# tail (EOCD and, for small archives, the central directory too), one for the rest of
+# the central directory, and one for the pybi-info members. (Plus one more if the
+# archive has a long comment, which pack_pybi never writes.)
+#
+# A "source" is anything with:
+#   read_tail(length) -> (offset, data): the last `length` bytes of the file, plus
+#       where they start. If it's easier to return the whole file, that's fine too.
+#   read_range(start, end) -> data: bytes [start, end) of the file
+# Each call counts as one round trip.
+
+# The first fetch only has to find the end-of-central-directory record: the 22 byte
+# EOCD, plus the zip64 EOCD record and locator (56 + 20) if there are any, and pack_pybi
+# never writes an archive comment. A real pybi's central directory is hundreds of KB,
+# so fetching more up front wouldn't save a round trip anyway; this is a few KB of
+# slack, e.g. for archives repacked by other tools.
+TAIL_FETCH_SIZE = 4096
+# The most the EOCD can be from the end: a max-size 64 KiB comment comes after it. We
+# only fetch this much if the EOCD isn't in the first TAIL_FETCH_SIZE bytes.
+MAX_TAIL_SIZE = 22 + 0xFFFF + 56 + 20
+
+EOCD_STRUCT = struct.Struct("<4s4H2LH")
+ZIP64_LOCATOR_STRUCT = struct.Struct("<4sLQL")
+ZIP64_EOCD_STRUCT = struct.Struct("<4sQ2H2L4Q")
+CENTRAL_DIRECTORY_STRUCT = struct.Struct("<4s4B4HL2L5H2L")
+LOCAL_HEADER_STRUCT = struct.Struct("<4s2B4HL2L2H")
+
+
+class FileRangeSource:
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def read_tail(self, length):
+        with open(self.path, "rb") as f:
+            size = f.seek(0, os.SEEK_END)
+            offset = max(0, size - length)
+            f.seek(offset)
+            return offset, f.read()
+
+    def read_range(self, start, end):
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            return f.read(end - start)
+
+
+class HTTPRangeSource:
+    # Any server that supports Range requests (including suffix ranges, like
+    # "bytes=-1000"). If the server ignores Range and sends the whole file, that works
+    # too, it's just slow.
+    def __init__(self, url):
+        self.url = url
+
+    def _get(self, range_header):
+        request = urllib.request.Request(self.url, headers={"Range": range_header})
+        with urllib.request.urlopen(request) as response:
+            return response.status, response.headers, response.read()
+
+    def read_tail(self, length):
+        status, headers, data = self._get(f"bytes=-{length}")
+        if status == 206:
+            # Content-Range: bytes START-END/TOTAL
+            offset = int(headers["Content-Range"].split()[1].split("-")[0])
+            return offset, data
+        return 0, data
+
+    def read_range(self, start, end):
+        status, headers, data = self._get(f"bytes={start}-{end - 1}")
+        if status == 206:
+            return data
+        return data[start:end]
+
+
+class _TailBuffer:
+    # Holds a contiguous chunk of the end of the file, and grows it backwards as needed.
+    def __init__(self, source, tail_size):
+        self.source = source
+        self.round_trips = 1
+        self.start, self.data = source.read_tail(tail_size)
+        self.bytes_fetched = len(self.data)
+
+    def get(self, start, end):
+        if start < self.start:
+            more = self.source.read_range(start, self.start)
+            if len(more) != self.start - start:
+                raise RuntimeError("short read from source")
+            self.round_trips += 1
+            self.bytes_fetched += len(more)
+            self.data = more + self.data
+            self.start = start
+        return self.data[start - self.start : end - self.start]
+
+
+PybiInfo = collections.namedtuple(
+    "PybiInfo", ["pybi", "metadata", "record", "files", "bytes_fetched", "round_trips"]
+)
+
+
+def read_pybi_info(source, *, tail_size=TAIL_FETCH_SIZE):
+    # source is a path, or a range source (see above). Returns a PybiInfo, where pybi and
+    # metadata are email.message.Message objects, record is a list of RECORD rows, and
+    # files maps each pybi-info/ member name to its raw contents -- except for the
+    # run-in-place table, which installers have no use for, and which pack_pybi keeps
+    # out of the way by writing it before RECORD.
+    if not hasattr(source, "read_range"):
+        source = FileRangeSource(source)
+    buf = _TailBuffer(source, tail_size)
+    file_size = buf.start + len(buf.data)
+    tail = buf.get(buf.start, file_size)
+    eocd_index = tail.rfind(b"PK\x05\x06")
+    if eocd_index < 0 and buf.start > 0:
+        # Must have a long archive comment
+        tail = buf.get(max(0, file_size - MAX_TAIL_SIZE), file_size)
+        eocd_index = tail.rfind(b"PK\x05\x06")
+    if eocd_index < 0:
+        raise RuntimeError("not a zip file (can't find end of central directory)")
+    (_, _, _, _, count, cd_size, cd_offset, _) = EOCD_STRUCT.unpack_from(
+        tail, eocd_index
+    )
+    # Fetched through buf, in case the tail cut the locator off
+    locator_offset = file_size - len(tail) + eocd_index - ZIP64_LOCATOR_STRUCT.size
+    locator = b""
+    if locator_offset >= 0:
+        locator = buf.get(locator_offset, locator_offset + ZIP64_LOCATOR_STRUCT.size)
+    if locator.startswith(b"PK\x06\x07"):
+        (_, _, zip64_eocd_offset, _) = ZIP64_LOCATOR_STRUCT.unpack(locator)
+        zip64_eocd = buf.get(
+            zip64_eocd_offset, zip64_eocd_offset + ZIP64_EOCD_STRUCT.size
+        )
+        (_, _, _, _, _, _, _, count, cd_size, cd_offset) = ZIP64_EOCD_STRUCT.unpack(
+            zip64_eocd
+        )
+
+    central_directory = buf.get(cd_offset, cd_offset + cd_size)
+    members = []
+    pos = 0
+    for _ in range(count):
+        (
+            signature,
+            _, _, _, _, _,
+            compress_type,
+            _, _,
+            crc,
+            compress_size,
+            file_size,
+            name_len,
+            extra_len,
+            comment_len,
+            _, _, _,
+            header_offset,
+        ) = CENTRAL_DIRECTORY_STRUCT.unpack_from(central_directory, pos)
+        if signature != b"PK\x01\x02":
+            raise RuntimeError("corrupt central directory")
+        pos += CENTRAL_DIRECTORY_STRUCT.size
+        name = central_directory[pos : pos + name_len].decode("utf-8")
+        extra = central_directory[pos + name_len : pos + name_len + extra_len]
+        pos += name_len + extra_len + comment_len
+        if not name.startswith("pybi-info/") or name == RUN_IN_PLACE_NAME:
+            continue
+        if 0xFFFFFFFF in (compress_size, file_size, header_offset):
+            file_size, compress_size, header_offset = _parse_zip64_extra(
+                extra, file_size, compress_size, header_offset
+            )
+        members.append((name, compress_type, crc, compress_size, header_offset))
+
+    if not members:
+        raise RuntimeError("no pybi-info/ in archive")
+    # One request for all the members -- they're all together right before the central
+    # directory.
+    members_start = min(member[-1] for member in members)
+    span = buf.get(members_start, cd_offset)
+
+    files = {}
+    for name, compress_type, crc, compress_size, header_offset in members:
+        pos = header_offset - members_start
+        fields = LOCAL_HEADER_STRUCT.unpack_from(span, pos)
+        if fields[0] != b"PK\x03\x04":
+            raise RuntimeError(f"corrupt local header for {name}")
+        name_len, extra_len = fields[-2:]
+        pos += LOCAL_HEADER_STRUCT.size + name_len + extra_len
+        raw = span[pos : pos + compress_size]
+        if compress_type == zipfile.ZIP_STORED:
+            data = raw
+        elif compress_type == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(raw, -15)
+        else:
+            raise RuntimeError(f"{name}: unsupported compression type {compress_type}")
+        if zlib.crc32(data) != crc:
+            raise RuntimeError(f"{name}: bad CRC")
+        files[name] = data
+
+    return PybiInfo(
+        pybi=email.message_from_bytes(files["pybi-info/PYBI"]),
+        metadata=email.message_from_bytes(files["pybi-info/METADATA"]),
+        record=list(csv.reader(io.StringIO(files["pybi-info/RECORD"].decode("utf-8")))),
+        files=files,
+        bytes_fetched=buf.bytes_fetched,
+        round_trips=buf.round_trips,
+    )
+
+
+def _parse_zip64_extra(extra, file_size, compress_size, header_offset):
+    # The zip64 extra field only contains the values that overflowed, in this order.
+    pos = 0
+    while pos + 4 <= len(extra):
+        tag, size = struct.unpack_from("<2H", extra, pos)
+        pos += 4
+        if tag == 0x0001:
+            values = iter(struct.unpack_from(f"<{size // 8}Q", extra, pos))
+            if file_size == 0xFFFFFFFF:
+                file_size = next(values)
+            if compress_size == 0xFFFFFFFF:
+                compress_size = next(values)
+            if header_offset == 0xFFFFFFFF:
+                header_offset = next(values)
+            break
+        pos += size
+    return file_size, compress_size, header_offset
+
+
+def read_pybi_metadata(pybi_path):
+    return read_pybi_info(pybi_path).files["pybi-info/METADATA"]
+
+
+def parse_record(record_bytes):
+    # Returns {name: (hash, size)}, with hash like "sha256=..." or "symlink=..."
+    rows = csv.reader(io.StringIO(record_bytes.decode("utf-8")))
+    return {name: (hash, size) for (name, hash, size) in rows}
+
+
+def record_hash(digest):
+    return "sha256=" + base64.urlsafe_b64encode(digest).decode("ascii").rstrip("=")
+
+
+def safe_member_path(dest_path, name):
+    # Refuse anything that could end up outside dest_path
+    name_path = PurePosixPath(name)
+    if (
+        name_path.is_absolute()
+        or ".." in name_path.parts
+        or any(":" in part or "\\" in part for part in name_path.parts)
+    ):
+        raise RuntimeError(f"refusing to unpack unsafe path {name!r}")
+    return dest_path.joinpath(*name_path.parts)
+
+
+# Like the OS's limit on how many links one lookup can go through
+MAX_SYMLINK_DEPTH = 40
+
+
+def symlink_problems(symlinks, names):
+    # The rules pack_pybi enforces on symlinks, checked against a whole archive the way
+    # the OS will resolve its links once they're all on disk: through symlinked
+    # directories, and along chains of links. Each link can be fine on its own as text,
+    # but "A -> ." plus "A/B -> ../x" puts B next to the base, pointing outside it.
+    # unpack_pybi, verify_pybi and delta.apply_delta all use this, so they can't
+    # disagree about what's acceptable. symlinks is {member name: target} for every
+    # symlink member, names is every other member's name. Returns a list of problems.
+    problems = []
+
+    def resolve(parts, depth):
+        # The parts of the path relative to the base once all the links in it are
+        # followed, or None if it leaves the base
+        if depth > MAX_SYMLINK_DEPTH:
+            raise RecursionError
+        resolved = []
+        for part in parts:
+            if part in ("", "."):
+                continue
+            if part == "..":
+                if not resolved:
+                    return None
+                resolved.pop()
+                continue
+            resolved.append(part)
+            target = symlinks.get("/".join(resolved))
+            if target is not None:
+                if posixpath.isabs(target):
+                    return None
+                resolved = resolve(resolved[:-1] + target.split("/"), depth + 1)
+                if resolved is None:
+                    return None
+        return resolved
+
+    def through_symlink(name):
+        parts = name.split("/")
+        return any("/".join(parts[:i]) in symlinks for i in range(1, len(parts)))
+
+    for name in names:
+        if through_symlink(name):
+            problems.append(f"{name}: is inside a symlinked directory")
+    for name, target in symlinks.items():
+        if posixpath.isabs(target):
+            problems.append(f"{name}: absolute symlinks are forbidden: {target}")
+        elif through_symlink(name):
+            problems.append(f"{name}: is inside a symlinked directory")
+        else:
+            try:
+                resolved = resolve(name.split("/"), 0)
+            except RecursionError:
+                problems.append(f"{name}: symlink loop")
+                continue
+            if resolved is None:
+                problems.append(f"{name}: symlink points outside base: {target}")
+    return problems
+
+
+def check_created_symlinks(paths, dest_path):
+    # symlink_problems should have caught anything that gets here, but once the links
+    # all exist, check where they really go anyway
+    for path in paths:
+        if not path_in(os.path.realpath(path), dest_path):
+            raise RuntimeError(f"symlink points outside base: {path}")
+
+
+def matches_record(name, digest, size, expected_hash, expected_size):
+    # RECORD itself is the one entry without a hash; for anything else, a missing hash
+    # is as bad as a wrong one
+    if name == RECORD_NAME:
+        return True
+    return (
+        record_hash(digest) == expected_hash.rstrip("=") and str(size) == expected_size
+    )
+
+
+def inflate_chunks(raw_chunks):
+    # Decompresses a raw deflate stream, without ever producing more than CHUNK_SIZE
+    # bytes at a time.
+    decompressor = zlib.decompressobj(-15)
+    for data in raw_chunks:
+        while data:
+            yield decompressor.decompress(data, CHUNK_SIZE)
+            data = decompressor.unconsumed_tail
+    yield decompressor.flush()
+
+
+def member_raw_chunks(view, zi):
+    # The member's payload, still compressed. view is a memoryview of the whole
+    # archive. The chunks are copied out as bytes rather than sliced, so when something
+    # fails partway, the frames in the traceback don't hold slices of view, which would
+    # keep its memory map from closing and replace the real error with a BufferError.
+    (signature, *_, name_len, extra_len) = LOCAL_HEADER_STRUCT.unpack_from(
+        view, zi.header_offset
+    )
+    if signature != b"PK\x03\x04":
+        raise RuntimeError(f"corrupt local header for {zi.filename}")
+    start = zi.header_offset + LOCAL_HEADER_STRUCT.size + name_len + extra_len
+    end = start + zi.compress_size
+    if end > len(view):
+        raise RuntimeError(f"{zi.filename}: truncated member")
+    return (
+        bytes(view[pos : min(pos + CHUNK_SIZE, end)])
+        for pos in range(start, end, CHUNK_SIZE)
+    )
+
+
+def member_data_chunks(view, zi):
+    # view is a memoryview of the whole archive; see member_raw_chunks
+    raw_chunks = member_raw_chunks(view, zi)
+    if zi.compress_type == zipfile.ZIP_STORED:
+        return raw_chunks
+    elif zi.compress_type == zipfile.ZIP_DEFLATED:
+        return inflate_chunks(raw_chunks)
     else:
-        if not (scripts_path / "python").exists():
-            if (scripts_path / "python3").exists():
-                (scripts_path / "python").symlink_to("python3")
-            else:
-                raise RuntimeError(f"can't find python in {scripts_path}")
+        raise RuntimeError(
+            f"{zi.filename}: unsupported compression type {zi.compress_type}"
+        )
 
-    with TemporaryDirectory() as temp:
+
+def write_chunks(chunks, path):
+    # Writes chunks to a new file at path, and returns (sha256 digest, size) of what
+    # was written. If anything goes wrong partway, the partial file is removed.
+    hasher = hashlib.new("sha256")
+    size = 0
+    try:
+        with open(path, "wb") as out:
+            for chunk in chunks:
+                hasher.update(chunk)
+                size += len(chunk)
+                out.write(chunk)
+    except BaseException:
+        path.unlink(missing_ok=True)
+        raise
+    return hasher.digest(), size
+
+
+def unpack_pybi(pybi_path, dest, *, jobs=1, keep=None):
+    # The inverse of pack_pybi. dest must not exist yet, or be empty. If keep is given,
+    # it's called with each member's name, and only the members it returns true for are
+    # unpacked (directories are always created).
+    #
+    # Members are decompressed in parallel straight out of a memory-mapped archive, and
+    # each file's sha256 and size are checked against RECORD as it's written. Symlinks
+    # are created last, after their targets exist, and only if they follow the same
+    # rules pack_pybi enforces.
+    dest_path = Path(dest)
+    dest_path.mkdir(parents=True, exist_ok=True)
+    dest_path = dest_path.resolve()
+    if any(dest_path.iterdir()):
+        raise RuntimeError(f"{dest_path} is not empty")
+
+    with open(pybi_path, "rb") as f, mmap.mmap(
+        f.fileno(), 0, access=mmap.ACCESS_READ
+    ) as m, zipfile.ZipFile(f) as z:
+        record = parse_record(z.read(RECORD_NAME))
+        view = memoryview(m)
+        try:
+            files = []
+            symlinks = []
+            # {name: target} of every symlink member, and every other member's name,
+            # whether or not we keep them
+            targets = {}
+            names = []
+            for zi in z.infolist():
+                path = safe_member_path(dest_path, zi.filename)
+                if zi.is_dir():
+                    names.append(zi.filename.rstrip("/"))
+                    continue
+                if zi.filename not in record:
+                    raise RuntimeError(f"{zi.filename} is missing from RECORD")
+                if (zi.external_attr >> MODE_SHIFT) & SYMLINK_MASK == SYMLINK_MODE:
+                    target = z.read(zi).decode("utf-8")
+                    if record[zi.filename][0] != f"symlink={target}":
+                        raise RuntimeError(f"{zi.filename}: doesn't match RECORD")
+                    targets[zi.filename] = target
+                    if keep is None or keep(zi.filename):
+                        symlinks.append((path, target))
+                else:
+                    names.append(zi.filename)
+                    if keep is None or keep(zi.filename):
+                        files.append((zi, path))
+            missing = record.keys() - set(z.namelist())
+            if missing:
+                raise RuntimeError(f"RECORD lists missing members: {sorted(missing)}")
+            problems = symlink_problems(targets, names)
+            if problems:
+                raise RuntimeError(f"refusing to unpack: {problems[0]}")
+
+            for zi in z.infolist():
+                if zi.is_dir():
+                    safe_member_path(dest_path, zi.filename).mkdir(
+                        parents=True, exist_ok=True
+                    )
+            for _, path in files:
+                path.parent.mkdir(parents=True, exist_ok=True)
+
+            def extract(item):
+                zi, path = item
+                expected_hash, expected_size = record[zi.filename]
+                digest, size = write_chunks(member_data_chunks(view, zi), path)
+                if not matches_record(
+                    zi.filename, digest, size, expected_hash, expected_size
+                ):
+                    path.unlink()
+                    raise RuntimeError(f"{zi.filename}: doesn't match RECORD")
+                mode = (zi.external_attr >> MODE_SHIFT) & 0o777
+                if mode & 0o111 and os.name == "posix":
+                    os.chmod(path, mode)
+
+            for _ in ordered_map(extract, files, jobs):
+                pass
+
+            for path, target in symlinks:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                os.symlink(target, path)
+            check_created_symlinks([path for (path, _) in symlinks], dest_path)
+        finally:
+            view.release()
+
+    return len(files), len(symlinks)
+
+
+def verify_pybi(pybi_path, *, jobs=1):
+    # Checks a pybi the way unpack_pybi would, but without writing anything: every
+    # member's sha256 and size against RECORD, every member's CRC (which covers RECORD
+    # itself too), and that symlinks follow the rules pack_pybi enforces. Members are
+    # streamed out of a memory-mapped archive. Instead of stopping at the first problem,
+    # this collects them all.
+    #
+    # Returns (sha256 hex digest of the whole archive, list of problems)
+    problems = []
+    with contextlib.ExitStack() as stack:
+        f = stack.enter_context(open(pybi_path, "rb"))
+        try:
+            m = stack.enter_context(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except (ValueError, OSError) as exc:
+            # An empty file can't be mapped, for one; that's a broken pybi, not a crash
+            hasher = hashlib.new("sha256")
+            for chunk in read_chunks(f):
+                hasher.update(chunk)
+            return hasher.hexdigest(), [f"can't memory-map the file: {exc}"]
+        view = memoryview(m)
+        try:
+            sha256 = hashlib.sha256(view).hexdigest()
+            try:
+                z = zipfile.ZipFile(f)
+            except zipfile.BadZipFile as exc:
+                return sha256, [f"not a valid zip file: {exc}"]
+            with z:
+                try:
+                    record = parse_record(z.read(RECORD_NAME))
+                    pybi = email.message_from_bytes(z.read("pybi-info/PYBI"))
+                except (KeyError, ValueError, zipfile.BadZipFile) as exc:
+                    return sha256, [f"can't read pybi-info: {exc}"]
+                allows_symlinks = platform_allows_symlinks(pybi["Tag"] or "")
+
+                files = []
+                # Same as in unpack_pybi: every symlink's target, and every other
+                # member's name
+                targets = {}
+                names = []
+                for zi in z.infolist():
+                    name = zi.filename
+                    try:
+                        safe_member_path(PurePosixPath("/"), name)
+                    except RuntimeError as exc:
+                        problems.append(str(exc))
+                        continue
+                    if zi.is_dir():
+                        names.append(name.rstrip("/"))
+                        continue
+                    if name not in record:
+                        problems.append(f"{name} is missing from RECORD")
+                        continue
+                    if (zi.external_attr >> MODE_SHIFT) & SYMLINK_MASK != SYMLINK_MODE:
+                        names.append(name)
+                        files.append(zi)
+                        continue
+                    try:
+                        target = z.read(zi).decode("utf-8")
+                    except (zipfile.BadZipFile, zlib.error, UnicodeDecodeError) as exc:
+                        problems.append(f"{name}: can't read symlink target: {exc}")
+                        continue
+                    targets[name] = target
+                    problem = None
+                    if not allows_symlinks:
+                        problem = f"{pybi['Tag']} pybis can't have symlinks"
+                    elif name.startswith("pybi-info/"):
+                        problem = "can't have symlinks inside pybi-info"
+                    if problem is not None:
+                        problems.append(f"{name}: {problem}")
+                    if record[name][0] != f"symlink={target}":
+                        problems.append(f"{name}: symlink doesn't match RECORD")
+                problems.extend(symlink_problems(targets, names))
+                missing = record.keys() - set(z.namelist())
+                if missing:
+                    problems.append(f"RECORD lists missing members: {sorted(missing)}")
+
+                def check(zi):
+                    expected_hash, expected_size = record[zi.filename]
+                    hasher = hashlib.new("sha256")
+                    size = 0
+                    crc = 0
+                    try:
+                        for chunk in member_data_chunks(view, zi):
+                            hasher.update(chunk)
+                            size += len(chunk)
+                            crc = zlib.crc32(chunk, crc)
+                    except (RuntimeError, zlib.error, struct.error, ValueError) as exc:
+                        # struct.error is a local header past the end of the archive
+                        return f"{zi.filename}: {exc}"
+                    if crc != zi.CRC:
+                        return f"{zi.filename}: bad CRC"
+                    if not matches_record(
+                        zi.filename, hasher.digest(), size, expected_hash, expected_size
+                    ):
+                        return f"{zi.filename}: doesn't match RECORD"
+                    return None
+
+                for problem in ordered_map(check, files, jobs):
+                    if problem is not None:
+                        problems.append(problem)
+        finally:
+            view.release()
+    return sha256, problems
+
+
+# Pinned, so the cached copy never goes stale. These are the last versions that still
+# run on every interpreter we build (3.6+).
+PACKAGING_VERSION = "21.3"
+PYPARSING_VERSION = "2.4.7"
+
+
+def packaging_bootstrap(cache_path):
+    # Returns a directory containing a vendored copy of packaging (and its deps), to put
+    # on sys.path of the interpreter we're probing. It's installed once and then reused,
+    # so once the cache is warm we don't need the network.
+    target = cache_path / f"packaging-{PACKAGING_VERSION}-pyparsing-{PYPARSING_VERSION}"
+    if target.exists():
+        return target
+    cache_path.mkdir(parents=True, exist_ok=True)
+    with TemporaryDirectory(dir=cache_path) as temp:
+        temp_target = Path(temp) / target.name
         # --no-user is needed because otherwise, on windows, I get:
         #   ERROR: Can not combine '--user' and '--target'
         # Some kind of buggy default, I guess?
         subprocess.run(
-            [sys.executable, "-m", "pip", "install", "packaging", "--no-user", "--target", temp],
+            [
+                sys.executable,
+                "-m",
+                "pip",
+                "install",
+                f"packaging=={PACKAGING_VERSION}",
+                f"pyparsing=={PYPARSING_VERSION}",
+                "--no-user",
+                "--target",
+                temp_target,
+            ],
             check=True,
         )
+        try:
+            os.rename(temp_target, target)
+        except OSError:
+            # Lost a race with a concurrent build, which is fine
+            if not target.exists():
+                raise
+    return target
 
-        pybi_json_code = (
-            f"""
+
+# Runs inside the target interpreter, with the packaging bootstrap dir as argv[1], and
+# dumps the info we need for pybi-info/METADATA as json.
+PROBE_CODE = r"""
 import sys
-sys.path.insert(0, {temp!r})
-"""
-            + r"""
+sys.path.insert(0, sys.argv[1])
 import packaging.markers
 import packaging.tags
 import sysconfig
 import os.path
+import posixpath
 import json
 import sys
 
@@ -219,17 +1731,248 @@ while "Python.framework" in base_path:
 paths = {key: os.path.relpath(path, base_path).replace("\\", "/") for (key, path) in sysconfig.get_paths().items()}
 
 json.dump({"markers_env": markers_env, "tags": str_tags, "paths": paths}, sys.stdout)
-            """
-        )
+"""
+
 
+def interpreter_fingerprint_paths(base_path, python_path):
+    # The probe output is determined by the interpreter. But on some platforms the
+    # binary is a small stub that could be identical across versions, and the real
+    # interpreter is in a shared library -- so include those in the fingerprint too.
+    # The sysconfig paths come from _sysconfigdata_*.py, which the relocation and
+    # repair steps rewrite without touching the binaries, so that goes in as well.
+    paths = [python_path.resolve()]
+    paths += python_path.parent.glob("python3*.dll")
+    paths += base_path.glob("lib/libpython3*")
+    paths += base_path.glob("lib/python3*/_sysconfigdata_*.py")
+    paths += base_path.glob("Python.framework/Versions/*/Python")
+    paths += base_path.glob(
+        "Python.framework/Versions/*/lib/python3*/_sysconfigdata_*.py"
+    )
+    return sorted(set(path.resolve() for path in paths))
+
+
+def probe_interpreter(base_path, python_path, cache_path, trace=None):
+    # Results are cached, keyed by the hash of the interpreter binaries and sysconfig
+    # data, the probe code, and the packaging version, so re-packing an unchanged tree
+    # skips the subprocess.
+    hasher = hashlib.new("sha256")
+    hasher.update(PROBE_CODE.encode("utf-8"))
+    hasher.update(f"{PACKAGING_VERSION} {PYPARSING_VERSION}".encode("ascii"))
+    for path in interpreter_fingerprint_paths(base_path, python_path):
+        with open(path, "rb") as f:
+            for chunk in read_chunks(f):
+                hasher.update(chunk)
+    probe_cache_path = cache_path / "probes" / f"{hasher.hexdigest()}.json"
+    if probe_cache_path.exists():
+        return probe_cache_path.read_bytes()
+
+    with trace_stage(trace, "packaging bootstrap"):
+        bootstrap_path = packaging_bootstrap(cache_path)
+    with trace_stage(trace, "interpreter probe"):
         result = subprocess.run(
-            [scripts_path / "python"],
-            input=pybi_json_code.encode("utf-8"),
+            [python_path, "-", bootstrap_path],
+            input=PROBE_CODE.encode("utf-8"),
             stdout=subprocess.PIPE,
             check=True,
         )
+    probe_cache_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = probe_cache_path.with_name(
+        f".tmp-{os.getpid()}-{probe_cache_path.name}"
+    )
+    temp_path.write_bytes(result.stdout)
+    os.replace(temp_path, probe_cache_path)
+    return result.stdout
+
+
+def state_path_for(out_dir_path):
+    # Bookkeeping about the pybis in out_dir_path (build number claims, digest
+    # sidecars, build_matrix.py's state) lives next to it, not inside it: built/ gets
+    # synced up to the server wholesale. Same reason regen-simple.py keeps its manifest
+    # outside built/.
+    return out_dir_path.parent / f"{out_dir_path.name}-state"
+
+
+def claim_path_for(pybi_path):
+    return state_path_for(pybi_path.parent) / "claims" / f"{pybi_path.name}.claim"
+
+
+# The claims this process holds, as {pybi path: open claim file}. The claim file stays
+# open (and locked) for as long as the build runs.
+_held_claims = {}
+
+
+def _try_lock(f):
+    # Non-blocking exclusive lock on all of f. The OS drops it when f is closed, or when
+    # the process dies, however it dies -- so unlike the file's existence, the lock
+    # can't go stale.
+    try:
+        if os.name == "nt":
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+    return True
+
+
+def _lock_claim(claim_path):
+    # Opens and locks claim_path, creating it if needed, and returns the open file, or
+    # None if someone else holds it. A claim file that nobody holds a lock on was left
+    # by a build that died, so it's up for grabs.
+    claim_path.parent.mkdir(parents=True, exist_ok=True)
+    while True:
+        f = open(claim_path, "a+")
+        if not _try_lock(f):
+            f.close()
+            return None
+        # Whoever held it last may have removed it between our open and our lock,
+        # in which case we locked a file that isn't the claim anymore
+        try:
+            current = os.path.samestat(os.fstat(f.fileno()), os.stat(claim_path))
+        except FileNotFoundError:
+            current = False
+        if current:
+            return f
+        f.close()
+
+
+def _remove_claim(claim_path, f):
+    # Unix lets us remove it while we still hold the lock; Windows doesn't let anyone
+    # remove an open file, so there it's removed right after, if nobody else opened it
+    # in between.
+    if os.name != "nt":
+        claim_path.unlink(missing_ok=True)
+        f.close()
+    else:
+        f.close()
+        try:
+            claim_path.unlink()
+        except OSError:
+            pass
+
+
+def claim_pybi_path(out_dir_path, name, version, platform_tag):
+    # Picks the first build number whose pybi doesn't exist yet, and reserves it by
+    # holding a lock on its claim file, so concurrent builds of the same version can't
+    # pick the same number -- even from other docker containers sharing out_dir_path.
+    # The claim is released by release_pybi_claim once the pybi is in place (or the
+    # build fails), or by the OS if the build dies.
+    for build_number in itertools.count():
+        if build_number > 0:
+            pybi_name = f"{name}-{version}-{build_number}-{platform_tag}.pybi"
+        else:
+            pybi_name = f"{name}-{version}-{platform_tag}.pybi"
+        pybi_path = out_dir_path / pybi_name
+        # A digest sidecar on its own means the pybi was streamed somewhere else
+        if pybi_path.exists() or digest_path_for(pybi_path).exists():
+            continue
+        claim_path = claim_path_for(pybi_path)
+        f = _lock_claim(claim_path)
+        if f is None:
+            continue
+        # Someone could have finished this exact pybi between our exists() check and
+        # the claim
+        if pybi_path.exists() or digest_path_for(pybi_path).exists():
+            _remove_claim(claim_path, f)
+            continue
+        # Just so a human can tell who's building what
+        f.truncate(0)
+        f.write(f"{socket.gethostname()} {os.getpid()}\n")
+        f.flush()
+        _held_claims[pybi_path] = f
+        return build_number, pybi_path
+
+
+def digest_path_for(pybi_path):
+    digests_path = state_path_for(pybi_path.parent) / "digests"
+    return digests_path / f"{pybi_path.name}.digest.json"
+
+
+def metadata_path(pybi_path):
+    # PEP 658 location for the METADATA of a distribution file
+    return pybi_path.with_name(pybi_path.name + ".metadata")
+
+
+def is_delta(path):
+    return path.name.endswith(".pybi-delta")
 
-    pybi_json_bytes = result.stdout
+
+def file_key(st):
+    # What regen-simple.py and verify-built.py remember about a file in built/. If none
+    # of these changed, we assume the contents didn't either.
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "ino": st.st_ino}
+
+
+def write_digest(pybi_path, digest):
+    # The sidecar that lets regen-simple.py index a pybi without reading it again
+    digest_path = digest_path_for(pybi_path)
+    digest_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = digest_path.with_name(f".{digest_path.name}.{os.getpid()}.tmp")
+    temp_path.write_text(json.dumps(digest._asdict()))
+    os.replace(temp_path, digest_path)
+
+
+def read_digest(pybi_path):
+    # Returns the ArchiveDigest from pybi_path's sidecar, or None if there isn't one or
+    # it's not trustworthy: the pybi must be the size it says, and mustn't have been
+    # modified after the sidecar was written.
+    digest_path = digest_path_for(pybi_path)
+    try:
+        digest = ArchiveDigest(**json.loads(digest_path.read_text()))
+        digest_st = digest_path.stat()
+        pybi_st = pybi_path.stat()
+    except (OSError, ValueError, TypeError):
+        return None
+    if pybi_st.st_size != digest.size or pybi_st.st_mtime_ns > digest_st.st_mtime_ns:
+        return None
+    return digest
+
+
+def release_pybi_claim(pybi_path):
+    f = _held_claims.pop(pybi_path, None)
+    if f is not None:
+        _remove_claim(claim_path_for(pybi_path), f)
+
+
+def remove_stale_claims(out_dir_path):
+    # Removes the claim files left behind by builds that died. claim_pybi_path takes
+    # those over by itself, so this is only tidying up. Returns the number removed.
+    removed = 0
+    claims_path = state_path_for(Path(out_dir_path)) / "claims"
+    for claim_path in claims_path.glob("*.pybi.claim"):
+        f = _lock_claim(claim_path)
+        if f is not None:
+            _remove_claim(claim_path, f)
+            removed += 1
+    return removed
+
+
+def add_pybi_metadata(
+    base_path: Path,
+    scripts_path: Path,
+    platform_tag: str,
+    out_dir_path: Path,
+    cache_path: Path = None,
+    trace=None,
+):
+    scripts_path = base_path / scripts_path
+    if cache_path is None:
+        cache_path = default_cache_path()
+
+    if os.name == "nt":
+        python_path = scripts_path / "python.exe"
+        if not python_path.exists():
+            raise RuntimeError(f"can't find python.exe in {scripts_path}")
+    else:
+        python_path = scripts_path / "python"
+        if not python_path.exists():
+            if (scripts_path / "python3").exists():
+                python_path.symlink_to("python3")
+            else:
+                raise RuntimeError(f"can't find python in {scripts_path}")
+
+    pybi_json_bytes = probe_interpreter(base_path, python_path, cache_path, trace)
     pybi_json = json.loads(pybi_json_bytes)
 
     # import pprint
@@ -244,14 +1987,8 @@ json.dump({"markers_env": markers_env, "tags": str_tags, "paths": paths}, sys.st
     # for now these are all "proof of concept" builds
     name = f"{name}_unofficial"
 
-    for build_number in itertools.count():
-        if build_number > 0:
-            pybi_name = f"{name}-{version}-{build_number}-{platform_tag}.pybi"
-        else:
-            pybi_name = f"{name}-{version}-{platform_tag}.pybi"
-        pybi_path = out_dir_path / pybi_name
-        if not pybi_path.exists():
-            break
+    # The caller has to release_pybi_claim(pybi_path) when it's done
+    build_number, pybi_path = claim_pybi_path(out_dir_path, name, version, platform_tag)
 
     pybi_info_path = base_path / "pybi-info"
     pybi_info_path.mkdir(exist_ok=True)
@@ -289,7 +2026,191 @@ json.dump({"markers_env": markers_env, "tags": str_tags, "paths": paths}, sys.st
     return pybi_path, scripts_dir
 
 
-def make_pybi(base_path, out_dir_path, *, scripts_path, platform_tag, build_number=0):
+# Test data that's deliberately not valid Python (or not valid Python 3)
+PYC_EXCLUDE_RE = (
+    r"[/\\]tests?[/\\](.*[/\\])?(data|tokenizedata)[/\\]|[/\\]test[/\\]bad\w*\.py$"
+)
+
+
+# Precompiles the stdlib with the target interpreter, so the first import of each
+# module doesn't have to (and read-only installs don't have to on every run). The pycs
+# are unchecked-hash pycs (PEP 552), which the import system uses without comparing
+# against the source's mtime, so they stay valid after the pybi is unpacked somewhere
+# else. Those need Python 3.7+; returns False if the interpreter is too old.
+def compile_stdlib(base_path, python_path, *, jobs=1):
+    metadata = email.message_from_bytes(
+        (base_path / "pybi-info" / "METADATA").read_bytes()
+    )
+    markers_env = json.loads(metadata["Pybi-Environment-Marker-Variables"])
+    python_version = tuple(map(int, markers_env["python_version"].split(".")))
+    if python_version < (3, 7):
+        print(f"Not precompiling, Python {python_version} has no unchecked-hash pycs")
+        return False
+
+    # Anything already here was written by the build or the probe, with whatever
+    # invalidation mode and paths they happened to use
+    for path in base_path.rglob("*.pyc"):
+        path.unlink()
+
+    stdlib_dir = json.loads(metadata["Pybi-Paths"])["stdlib"]
+    subprocess.run(
+        [
+            python_path,
+            "-E",
+            "-m", "compileall",
+            "-q",
+            "-f",
+            "-j", str(jobs),
+            "--invalidation-mode", "unchecked-hash",
+            # Embed relative paths rather than our temporary directory, so the output
+            # is reproducible (and the blob cache can hit)
+            "-d", stdlib_dir,
+            "-x", PYC_EXCLUDE_RE,
+            base_path / stdlib_dir,
+        ],
+        check=True,
+    )
+    return True
+
+
+def make_pybi(
+    base_path,
+    out_dir_path,
+    *,
+    scripts_path,
+    platform_tag,
+    build_number=0,
+    jobs=1,
+    cache=None,
+    cache_path=None,
+    dedup=False,
+    prune_profile=None,
+    compile_bytecode=False,
+    compression_policy=None,
+    trace=None,
+    index=None,
+    open_stream=None,
+    run_in_place=False,
+):
+    # index is an optional TreeIndex of base_path, e.g. one that repair already
+    # built and kept up to date.
+    #
+    # compression_policy is an optional CompressionPolicy, for pack_pybi. Without one,
+    # everything is deflated at zlib's default level.
+    #
+    # run_in_place makes a pybi that run_in_place.py can make a stub of, which imports
+    # the stdlib straight out of the pybi. This runs the interpreter once, to see what
+    # has to stay on disk. Best combined with compile_bytecode.
+    #
+    # Normally the pybi is written to out_dir_path. If open_stream is given, it's
+    # called with the pybi's name, and should return a writable binary stream (say, the
+    # stdin of an upload process) to write it to instead; it doesn't have to be
+    # seekable, and it gets closed afterwards. Either way, the archive's sha256 and size
+    # are computed as it's written, and saved in a .digest.json sidecar (see
+    # write_digest and state_path_for).
+    if dedup and not platform_allows_symlinks(platform_tag):
+        print(f"Not deduplicating, {platform_tag} pybis can't contain symlinks")
+        dedup = False
     out_dir_path.mkdir(parents=True, exist_ok=True)
-    pybi_path, scripts_dir = add_pybi_metadata(base_path, scripts_path, platform_tag, out_dir_path)
-    pack_pybi(base_path, pybi_path, scripts_dir)
+    with trace_stage(trace, "add_pybi_metadata"):
+        pybi_path, scripts_dir = add_pybi_metadata(
+            base_path, scripts_path, platform_tag, out_dir_path, cache_path, trace
+        )
+    try:
+        python = "python.exe" if os.name == "nt" else "python"
+        python_path = base_path / scripts_dir / python
+        if index is None:
+            with trace_stage(trace, "walk tree"):
+                index = TreeIndex(base_path)
+        else:
+            # add_pybi_metadata wrote pybi-info/, and maybe a python -> python3 symlink
+            index.update(base_path / "pybi-info")
+            index.update(python_path)
+        # After the metadata, because the prune rules are written in terms of Pybi-Paths
+        if prune_profile is not None:
+            with trace_stage(trace, "prune"):
+                prune_tree(base_path, prune_profile, jobs=jobs, index=index)
+        bootstrap = None
+        if run_in_place:
+            # Not at the top, since run_in_place imports this module
+            from run_in_place import prepare_tree
+
+            with trace_stage(trace, "prepare run in place"):
+                bootstrap = prepare_tree(base_path, python_path, index=index)
+        include_pyc = False
+        if compile_bytecode:
+            with trace_stage(trace, "compile bytecode"):
+                include_pyc = compile_stdlib(base_path, python_path, jobs=jobs)
+            # Replaces .pyc files all over the tree
+            index.update(base_path)
+        pack = functools.partial(
+            pack_pybi,
+            base_path,
+            scripts_dir=scripts_dir,
+            jobs=jobs,
+            cache=cache,
+            dedup=dedup,
+            include_pyc=include_pyc,
+            policy=compression_policy,
+            trace=trace,
+            index=index,
+            run_in_place=bootstrap,
+        )
+        if open_stream is not None:
+            with trace_stage(trace, "pack"), open_stream(pybi_path.name) as out:
+                digest = pack(out)
+        else:
+            # Pack to a temporary name and then rename, so an interrupted build never
+            # leaves behind a partial .pybi that looks like a finished one.
+            temp_path = pybi_path.with_name(f".{pybi_path.name}.{os.getpid()}.tmp")
+            try:
+                with trace_stage(trace, "pack"):
+                    digest = pack(temp_path)
+                os.replace(temp_path, pybi_path)
+            except BaseException:
+                temp_path.unlink(missing_ok=True)
+                raise
+        # After the rename, so the sidecar is never older than the pybi
+        write_digest(pybi_path, digest)
+    finally:
+        # Only after the rename, so the build number is never up for grabs in between
+        release_pybi_claim(pybi_path)
+    return pybi_path
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="pybi.py")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    unpack_parser = subparsers.add_parser("unpack", help="unpack a pybi")
+    unpack_parser.add_argument("pybi")
+    unpack_parser.add_argument("dest")
+    unpack_parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count())
+
+    verify_parser = subparsers.add_parser(
+        "verify", help="check pybis against their RECORDs, without unpacking them"
+    )
+    verify_parser.add_argument("pybis", nargs="+")
+    verify_parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count())
+
+    args = parser.parse_args()
+    if args.command == "unpack":
+        file_count, symlink_count = unpack_pybi(
+            args.pybi, args.dest, jobs=args.jobs
+        )
+        print(
+            f"Unpacked {file_count} files and {symlink_count} symlinks to {args.dest}"
+        )
+    elif args.command == "verify":
+        failed = False
+        for pybi in args.pybis:
+            _, problems = verify_pybi(pybi, jobs=args.jobs)
+            for problem in problems:
+                print(f"{pybi}: {problem}")
+            failed = failed or bool(problems)
+        if failed:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
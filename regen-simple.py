@@ -1,7 +1,133 @@
 from pathlib import Path
 import hashlib
+import json
+import os
+import struct
+import sys
+import zipfile
+import zlib
+
+from pybi import (
+    file_key,
+    is_delta,
+    metadata_path,
+    ordered_map,
+    read_chunks,
+    read_digest,
+    read_pybi_metadata,
+)
+from delta import DELTA_INFO_NAME
 
 built_path = Path("built")
+# Kept outside built/, so it doesn't get synced up to the server
+manifest_path = Path("regen-simple-manifest.json")
+
+
+def hash_file(path):
+    hasher = hashlib.new("sha256")
+    with open(path, "rb") as f:
+        for chunk in read_chunks(f):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+# Returns the manifest, as {name: {"size": ..., "mtime_ns": ..., "ino": ...,
+# "sha256": ..., "metadata_sha256": ...}}. Only files that are new or changed since the
+# last run get hashed (and get their .metadata sidecar extracted), so the cost is
+# proportional to what changed, not to the size of built/.
+#
+# Deltas (see delta.py) are in here too, with "source" and "target" instead of
+# "metadata_sha256".
+def update_manifest(built_path, manifest_path, *, jobs=os.cpu_count()):
+    try:
+        old_manifest = json.loads(manifest_path.read_text())
+    except FileNotFoundError:
+        old_manifest = {}
+
+    manifest = {}
+    to_hash = []
+    paths = [*built_path.glob("*.pybi"), *built_path.glob("*.pybi-delta")]
+    for pybi_path in paths:
+        key = file_key(pybi_path.stat())
+        old_entry = old_manifest.get(pybi_path.name)
+        if (
+            old_entry is not None
+            and all(old_entry[k] == v for (k, v) in key.items())
+            and (
+                is_delta(pybi_path)
+                or (
+                    "metadata_sha256" in old_entry
+                    and metadata_path(pybi_path).exists()
+                )
+            )
+        ):
+            manifest[pybi_path.name] = old_entry
+        else:
+            to_hash.append((pybi_path, key))
+
+    # Returns (name, manifest entry), or (name, None) if the file is broken, so one bad
+    # upload doesn't stop the rest of the index from being regenerated
+    def hash_one(item):
+        pybi_path, key = item
+        print(f"Hashing {pybi_path}")
+        try:
+            if is_delta(pybi_path):
+                with zipfile.ZipFile(pybi_path) as z:
+                    delta_info = json.loads(z.read(DELTA_INFO_NAME))
+                source_name = delta_info["source"]["name"]
+                target_name = delta_info["target"]["name"]
+            else:
+                metadata = read_pybi_metadata(pybi_path)
+        except (
+            OSError,
+            RuntimeError,
+            KeyError,
+            ValueError,
+            struct.error,
+            zipfile.BadZipFile,
+            zlib.error,
+        ) as exc:
+            print(f"Skipping {pybi_path}: {exc!r}", file=sys.stderr)
+            return pybi_path.name, None
+        if is_delta(pybi_path):
+            return pybi_path.name, {
+                **key,
+                "sha256": hash_file(pybi_path),
+                "source": source_name,
+                "target": target_name,
+            }
+        metadata_path(pybi_path).write_bytes(metadata)
+        # make_pybi saves the digest it computed while writing the pybi, so normally
+        # there's no need to read the whole thing again
+        digest = read_digest(pybi_path)
+        if digest is not None:
+            sha256 = digest.sha256
+        else:
+            sha256 = hash_file(pybi_path)
+        return pybi_path.name, {
+            **key,
+            "sha256": sha256,
+            "metadata_sha256": hashlib.sha256(metadata).hexdigest(),
+        }
+
+    for name, entry in ordered_map(hash_one, to_hash, jobs):
+        if entry is not None:
+            manifest[name] = entry
+
+    temp_path = manifest_path.with_name(manifest_path.name + ".tmp")
+    temp_path.write_text(json.dumps(manifest, indent=1, sort_keys=True))
+    os.replace(temp_path, manifest_path)
+    return manifest
+
+
+full_manifest = update_manifest(built_path, manifest_path)
+manifest = {}
+delta_manifest = {}
+for name, entry in full_manifest.items():
+    if name.endswith(".pybi-delta"):
+        delta_manifest[name] = entry
+    else:
+        manifest[name] = entry
 
 (built_path / "index.html").write_text(
     """<!DOCTYPE html>
@@ -34,19 +160,65 @@ built_path = Path("built")
     </html>
     """)
 
+# PEP 691 JSON versions of the same pages. We're just a static file host, so we can't
+# do content negotiation; these live next to the HTML as index.json.
+SIMPLE_JSON_META = {"api-version": "1.0"}
+
+(built_path / "index.json").write_text(
+    json.dumps({"meta": SIMPLE_JSON_META, "projects": [{"name": "cpython_unofficial"}]})
+)
+
 (built_path / "cpython-unofficial").mkdir(exist_ok=True)
 
 with open(built_path / "cpython-unofficial" / "index.html", "w") as f:
     f.write("<!DOCTYPE html><html><body>\n")
     # I guess if we wanted to be fancy we could do a proper version sort, but a naive
     # string sort is still better than nothing.
-    for pybi_path in sorted(built_path.glob("*.pybi")):
-        print(pybi_path)
-        assert pybi_path.name.startswith("cpython_unofficial-")
-        hasher = hashlib.new("sha256")
-        hasher.update(pybi_path.read_bytes())
-        raw_hash = hasher.digest()
+    for name, entry in sorted(manifest.items()):
+        assert name.startswith("cpython_unofficial-")
+        # PEP 658 says data-dist-info-metadata, PEP 714 renamed it to
+        # data-core-metadata; clients look for one or the other, so emit both.
+        metadata_attr = f"sha256={entry['metadata_sha256']}"
         f.write(
-            f"""<a href="/{pybi_path.name}#sha256={raw_hash.hex()}">{pybi_path.name}</a><br>\n"""
+            f"""<a href="/{name}#sha256={entry["sha256"]}" """
+            f"""data-core-metadata="{metadata_attr}" """
+            f"""data-dist-info-metadata="{metadata_attr}">{name}</a><br>\n"""
         )
     f.write("</body></html>\n")
+
+files = []
+for name, entry in sorted(manifest.items()):
+    metadata_hashes = {"sha256": entry["metadata_sha256"]}
+    files.append(
+        {
+            "filename": name,
+            "url": f"/{name}",
+            "hashes": {"sha256": entry["sha256"]},
+            "core-metadata": metadata_hashes,
+            "dist-info-metadata": metadata_hashes,
+        }
+    )
+(built_path / "cpython-unofficial" / "index.json").write_text(
+    json.dumps(
+        {"meta": SIMPLE_JSON_META, "name": "cpython-unofficial", "files": files},
+        indent=1,
+    )
+)
+
+# Deltas aren't distributions, so they stay off the PEP 503/691 pages (installers
+# would try to make sense of them); tools that know about them find them here.
+deltas = []
+for name, entry in sorted(delta_manifest.items()):
+    deltas.append(
+        {
+            "filename": name,
+            "url": f"/{name}",
+            "hashes": {"sha256": entry["sha256"]},
+            "size": entry["size"],
+            "source": entry["source"],
+            "target": entry["target"],
+        }
+    )
+(built_path / "cpython-unofficial" / "deltas.json").write_text(
+    json.dumps({"name": "cpython-unofficial", "deltas": deltas}, indent=1)
+)
@@ -0,0 +1,391 @@
+# Run-in-place mode: instead of unpacking a whole pybi, make a thin "stub" of it on
+# disk, and serve the pure-Python stdlib straight out of the pybi. The stub has
+# everything that has to be a real file -- the interpreter, shared libraries,
+# extension modules, data files, site-packages -- plus the handful of stdlib modules
+# the interpreter imports before our importer is installed. Everything else in the stdlib (.py files,
+# and the __pycache__ .pycs that make_pybi(compile_bytecode=True) adds) is read out of
+# a memory map of the pybi by a small importer, which the stub's site-packages installs
+# with a .pth file.
+#
+#   python3 run_in_place.py built/cpython_unofficial-3.11.7-macosx_11_0_arm64.pybi stub
+#
+# This needs a pybi made by make_pybi(run_in_place=True), which does all the work that
+# needs the interpreter once, at build time: it adds the importer to the stdlib, finds
+# out which modules startup imports, and records where every served member is in the
+# archive (see pybi.run_in_place_table). Making a stub is then a single unpack_pybi
+# pass that skips the served members, plus writing the .pth file. Combine it with
+# compile_bytecode: served pycs are stored, so they're imported without decompressing
+# anything, and are only used if they're hash-based (which is what compile_bytecode
+# makes). The stub refers to the pybi by absolute path, so the pybi has to stay put.
+#
+# Caveats: with -S, site doesn't run, so only the stub's on-disk modules are importable.
+# Virtual environments made from the stub don't see its site-packages either, so they
+# need the same .pth file in their own. A stdlib module that something imports before
+# the .pth file runs, and that neither the discovery run nor EARLY_IMPORTS caught, is
+# an ImportError.
+#
+# This doesn't make anything faster. Measured with bench-run-in-place.py on a 3.11.7
+# no-tests pybi with compile_bytecode: startup (`import asyncio, json, ssl`) is the
+# same as from an unpacked tree, within noise; the pybi is 26% bigger (35.5 vs 28.1
+# MiB), since served pycs are stored; and the stub plus the pybi it needs keep more
+# disk (99.9 MiB) than the unpacked tree (89.2 MiB). What it does save is setup time
+# (0.6-0.95 s vs ~1.55 s to unpack) and peak disk during setup (99.9 vs 124.7 MiB,
+# counting the downloaded pybi), so it's only worth it where the pybi has to be kept
+# around anyway.
+
+import argparse
+import email
+import json
+import marshal
+import os
+import subprocess
+import zipfile
+from pathlib import Path, PurePosixPath
+
+from prune import read_pybi_paths
+from pybi import RUN_IN_PLACE_NAME, read_pybi_metadata, unpack_pybi
+
+IMPORTER_MODULE = "_pybi_run_in_place"
+PTH_NAME = "00-pybi-run-in-place.pth"
+
+# Stdlib modules that startup can import before our .pth file runs, depending on the
+# version, platform and environment, so the discovery run might not see them: e.g. on
+# 3.6 and 3.7 site imports sysconfig (and so _sysconfigdata_*, and _osx_support on
+# macOS) to find the user site directory, and the user site's own .pth files run
+# before ours. These always stay on disk, if the pybi has them. Globs are relative to
+# the stdlib; a name without a .py is a package.
+EARLY_IMPORTS = [
+    "site.py",
+    "_sitebuiltins.py",
+    "sysconfig.py",
+    "sysconfig",
+    "_sysconfigdata_*.py",
+    "_osx_support.py",
+    "_collections_abc.py",
+    "_bootlocale.py",
+    "_weakrefset.py",
+    "abc.py",
+    "codecs.py",
+    "io.py",
+    "stat.py",
+    "genericpath.py",
+    "posixpath.py",
+    "ntpath.py",
+    "types.py",
+    "warnings.py",
+]
+
+# Runs in the interpreter being packed, and prints the file of every module that's been
+# imported by the time -c code runs, i.e. everything startup and site needed.
+DISCOVER_CODE = r"""
+import sys
+for module in list(sys.modules.values()):
+    path = getattr(module, "__file__", None)
+    if path:
+        print(path)
+"""
+
+# The _pybi_run_in_place module, which prepare_tree adds to the stdlib. This runs on
+# whatever Python the pybi contains (3.6+), while site is still processing .pth files,
+# so it can only use modules that are builtin or already on disk: the heavy lifting is
+# left to the loaders in importlib's own bootstrap. It runs on every startup, so
+# rather than parse the pybi's central directory each time, it loads the table that
+# pack_pybi made, which the stub has on disk.
+IMPORTER_CODE = r'''
+# Added by run_in_place.py: serves this interpreter's pure-Python stdlib straight out
+# of its pybi, instead of from files on disk. In a stub made by run_in_place.py,
+# install() is called by 00-pybi-run-in-place.pth, before anything else in
+# site-packages. Otherwise nothing imports it.
+import marshal
+import mmap
+import os
+import sys
+
+import _frozen_importlib_external as _bootstrap_external
+
+STDLIB_PATH = os.path.dirname(os.path.abspath(__file__))
+LOCAL_HEADER_SIZE = 30
+
+_pybi_path = None
+_map = None
+# The pybi's Pybi-Paths["stdlib"]
+_stdlib_name = None
+# {name relative to the stdlib: (local header offset, compression method, compressed
+# size, size, mtime)}
+MEMBERS = {}
+# {directory relative to the stdlib ("" for the top): names of its entries}
+DIRECTORIES = {}
+
+
+def _read(name):
+    offset, method, compress_size, _, _ = MEMBERS[name]
+    # Checking the local header is cheap, and catches a pybi that was replaced after
+    # the stub was made
+    start = offset + LOCAL_HEADER_SIZE
+    name_len = int.from_bytes(_map[offset + 26 : offset + 28], "little")
+    extra_len = int.from_bytes(_map[offset + 28 : offset + 30], "little")
+    if (
+        _map[offset : offset + 4] != b"PK\x03\x04"
+        or _map[start : start + name_len] != (_stdlib_name + "/" + name).encode()
+    ):
+        raise ImportError(
+            _pybi_path + " has changed since this interpreter was set up to run from it"
+        )
+    start += name_len + extra_len
+    data = _map[start : start + compress_size]
+    if method == 8:
+        import zlib
+
+        data = zlib.decompress(data, -15)
+    return data
+
+
+def _member_name(path):
+    # The name relative to the stdlib of a path in the stub's stdlib directory, or None
+    path = os.path.normpath(os.path.abspath(path))
+    if path == STDLIB_PATH:
+        return ""
+    if not path.startswith(STDLIB_PATH + os.sep):
+        return None
+    return path[len(STDLIB_PATH) + 1 :].replace(os.sep, "/")
+
+
+class PybiLoader(_bootstrap_external.FileLoader, _bootstrap_external.SourceLoader):
+    # Like SourceFileLoader, but sources and pycs come out of the pybi, and compiled
+    # bytecode is never written anywhere. Paths that aren't in the pybi are read from
+    # disk as usual.
+    def get_data(self, path):
+        name = _member_name(path)
+        if name in MEMBERS:
+            return _read(name)
+        return super().get_data(path)
+
+    def path_stats(self, path):
+        name = _member_name(path)
+        if name in MEMBERS:
+            _, _, _, size, mtime = MEMBERS[name]
+            return {"mtime": mtime, "size": size}
+        st = os.stat(path)
+        return {"mtime": st.st_mtime, "size": st.st_size}
+
+
+class PybiFinder:
+    # Path entry finder for a directory of the stdlib. Modules that are in the pybi
+    # come from there, anything else (extension modules, the on-disk bootstrap modules)
+    # from whatever finder the other path hooks would have made.
+    def __init__(self, path, name, fallback):
+        self.path = path
+        self.name = name
+        self.fallback = fallback
+
+    def _member(self, entry):
+        return self.name + "/" + entry if self.name else entry
+
+    def find_spec(self, fullname, target=None):
+        tail = fullname.rpartition(".")[2]
+        member = self._member(tail)
+        if member + "/__init__.py" in MEMBERS:
+            package_path = os.path.join(self.path, tail)
+            filename = os.path.join(package_path, "__init__.py")
+            locations = [package_path]
+        elif member + ".py" in MEMBERS:
+            filename = os.path.join(self.path, tail + ".py")
+            locations = None
+        elif self.fallback is not None:
+            return self.fallback.find_spec(fullname, target)
+        else:
+            return None
+        return _bootstrap_external.spec_from_file_location(
+            fullname,
+            filename,
+            loader=PybiLoader(fullname, filename),
+            submodule_search_locations=locations,
+        )
+
+    def invalidate_caches(self):
+        if self.fallback is not None:
+            self.fallback.invalidate_caches()
+
+    # For pkgutil.iter_modules
+    def iter_modules(self, prefix=""):
+        import pkgutil
+
+        seen = set()
+        for entry in DIRECTORIES[self.name]:
+            if entry.endswith(".py") and entry != "__init__.py":
+                modname, ispkg = entry[:-3], False
+            elif self._member(entry) + "/__init__.py" in MEMBERS:
+                modname, ispkg = entry, True
+            else:
+                continue
+            if modname.isidentifier():
+                seen.add(modname)
+                yield prefix + modname, ispkg
+        if self.fallback is not None:
+            for modname, ispkg in pkgutil.iter_importer_modules(self.fallback, prefix):
+                if modname[len(prefix) :] not in seen:
+                    yield modname, ispkg
+
+
+def _path_hook(path):
+    name = _member_name(path or ".")
+    if name not in DIRECTORIES:
+        raise ImportError("not a stdlib directory of " + _pybi_path)
+    fallback = None
+    for hook in sys.path_hooks:
+        if hook is _path_hook:
+            continue
+        try:
+            fallback = hook(path)
+        except ImportError:
+            continue
+        break
+    return PybiFinder(path, name, fallback)
+
+
+def install(pybi_path, table_path):
+    # Problems are written out here rather than raised: site would import traceback to
+    # report them, and without the pybi, traceback isn't importable
+    global _pybi_path, _map, _stdlib_name, MEMBERS, DIRECTORIES
+    if _map is not None:
+        return
+    try:
+        with open(table_path, "rb") as f:
+            table = marshal.loads(f.read())
+        with open(pybi_path, "rb") as f:
+            pybi_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError, EOFError) as exc:
+        sys.stderr.write("Can't run the stdlib in place: " + str(exc) + "\n")
+        return
+    _pybi_path = pybi_path
+    _map = pybi_map
+    _stdlib_name = table["stdlib"]
+    MEMBERS = table["members"]
+    DIRECTORIES = table["directories"]
+    sys.path_hooks.insert(0, _path_hook)
+    # Startup already made regular finders for the stdlib directories
+    for path in list(sys.path_importer_cache):
+        if isinstance(path, str) and _member_name(path or ".") in DIRECTORIES:
+            del sys.path_importer_cache[path]
+'''
+
+
+def member_in(name, prefix):
+    return name == prefix or name.startswith(prefix + "/")
+
+
+def prepare_tree(base_path, python_path, *, index=None):
+    # Gets an unpacked interpreter ready for make_pybi(run_in_place=True): adds the
+    # importer module to its stdlib, and returns the names (relative to base_path, with
+    # /s) of the stdlib sources a stub has to keep on disk, because the interpreter
+    # imports them before site has run our .pth file. Call it before compile_stdlib, so
+    # the importer gets a pyc too. If index (a TreeIndex of base_path) is given, it's
+    # kept up to date.
+    base_path = Path(base_path).resolve()
+    stdlib_name = read_pybi_paths(base_path)["stdlib"]
+    stdlib_path = base_path / stdlib_name
+    importer_path = stdlib_path / f"{IMPORTER_MODULE}.py"
+    importer_path.write_text(IMPORTER_CODE.lstrip())
+    if index is not None:
+        index.update(importer_path)
+
+    # Startup needs os.py to find the stdlib at all, and the codecs for whatever the
+    # locale turns out to be, which we can't predict here
+    bootstrap = {f"{stdlib_name}/os.py", f"{stdlib_name}/{IMPORTER_MODULE}.py"}
+    early_paths = [stdlib_path / "encodings"]
+    for pattern in EARLY_IMPORTS:
+        early_paths.extend(stdlib_path.glob(pattern))
+    for early_path in early_paths:
+        if early_path.is_dir():
+            sources = early_path.rglob("*.py")
+        else:
+            sources = [early_path]
+        bootstrap.update(path.relative_to(base_path).as_posix() for path in sources)
+    # Same flags as a plain `python` (so site does everything it normally does,
+    # user site included), except -B, so the tree doesn't get stray pycs. The build's
+    # own PYTHON* variables aren't what users will have, though.
+    env = {
+        key: value
+        for (key, value) in os.environ.items()
+        if not key.startswith("PYTHON")
+    }
+    output = subprocess.run(
+        [python_path, "-B", "-c", DISCOVER_CODE],
+        stdout=subprocess.PIPE,
+        env=env,
+        check=True,
+    ).stdout.decode("utf-8")
+    for path in output.splitlines():
+        # Frozen modules know where their source would be on disk, too
+        path = os.path.normpath(path)
+        if path.startswith(str(base_path) + os.sep) and path.endswith(".py"):
+            bootstrap.add(path[len(str(base_path)) + 1 :].replace(os.sep, "/"))
+    return bootstrap
+
+
+def make_stub(pybi_path, dest, *, jobs=1):
+    # Makes the run-in-place stub of pybi_path in dest, which must not exist yet or be
+    # empty. Returns (number of stdlib files on disk, number served from the pybi).
+    pybi_path = Path(pybi_path).resolve()
+    dest_path = Path(dest)
+    metadata = email.message_from_bytes(read_pybi_metadata(pybi_path))
+    pybi_paths = json.loads(metadata["Pybi-Paths"])
+    stdlib_name = pybi_paths["stdlib"]
+    # site-packages lives inside the stdlib directory, but it isn't the stdlib
+    not_stdlib_names = [
+        pybi_paths[key] for key in ["purelib", "platlib"] if key in pybi_paths
+    ]
+    with zipfile.ZipFile(pybi_path) as z:
+        try:
+            table = marshal.loads(z.read(RUN_IN_PLACE_NAME))
+        except KeyError:
+            raise RuntimeError(
+                f"{pybi_path.name} can't run in place; it has to be made with "
+                f"make_pybi(run_in_place=True)"
+            ) from None
+        stdlib_count = sum(
+            1
+            for name in z.namelist()
+            if member_in(name, stdlib_name)
+            and not name.endswith("/")
+            and not any(member_in(name, other) for other in not_stdlib_names)
+        )
+    served = {f"{stdlib_name}/{name}" for name in table["members"]}
+
+    unpack_pybi(pybi_path, dest_path, jobs=jobs, keep=lambda name: name not in served)
+    dest_path = dest_path.resolve()
+
+    # The directories that served modules would be in, so package __path__s and
+    # __file__s point somewhere real
+    for name in table["directories"]:
+        dest_path.joinpath(stdlib_name, *PurePosixPath(name).parts).mkdir(
+            parents=True, exist_ok=True
+        )
+
+    purelib_path = dest_path / pybi_paths["purelib"]
+    # Pruned pybis can have an empty site-packages, which means no directory at all
+    purelib_path.mkdir(parents=True, exist_ok=True)
+    table_path = dest_path.joinpath(*PurePosixPath(RUN_IN_PLACE_NAME).parts)
+    # ascii(), so the .pth file doesn't depend on the locale's encoding
+    arguments = f"{ascii(str(pybi_path))}, {ascii(str(table_path))}"
+    (purelib_path / PTH_NAME).write_text(
+        f"import {IMPORTER_MODULE}; {IMPORTER_MODULE}.install({arguments})\n"
+    )
+    return stdlib_count - len(served), len(served)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="run_in_place.py")
+    parser.add_argument("pybi")
+    parser.add_argument("dest")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    on_disk, in_pybi = make_stub(args.pybi, args.dest, jobs=args.jobs)
+    print(
+        f"Made a run-in-place stub in {args.dest}: {in_pybi} stdlib files are served "
+        f"from {args.pybi}, {on_disk} are on disk"
+    )
+
+
+if __name__ == "__main__":
+    main()
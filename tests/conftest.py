@@ -0,0 +1,80 @@
+import hashlib
+import os
+import sys
+import zipfile
+from pathlib import Path
+
+import pytest
+
+# The tools are plain scripts at the top of the repo, not an installed package
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from pybi import (  # noqa: E402
+    MODE_SHIFT,
+    RECORD_NAME,
+    SYMLINK_MODE,
+    pack_pybi,
+    record_hash,
+)
+
+PLATFORM_TAG = "manylinux_2_17_x86_64"
+
+
+def make_tree(base_path, files, symlinks=None, *, tag=PLATFORM_TAG):
+    # files maps names (with /s) to bytes; symlinks maps names to link targets.
+    # Writes a minimal pybi tree with pybi-info/ filled in, and returns base_path.
+    base_path.mkdir(parents=True)
+    all_files = {
+        "pybi-info/PYBI": (
+            f"Pybi-Version: 1.0\nGenerator: tests\nTag: {tag}\nBuild: 0\n"
+        ).encode("ascii"),
+        "pybi-info/METADATA": b"Metadata-Version: 2.2\nName: cpython\nVersion: 3.9.5\n",
+        **files,
+    }
+    for name, data in all_files.items():
+        path = base_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+    (base_path / "bin").mkdir(exist_ok=True)
+    for name, target in (symlinks or {}).items():
+        path = base_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.symlink(target, path)
+    return base_path
+
+
+@pytest.fixture
+def pack(tmp_path):
+    # pack(files, symlinks=None, name="test.pybi", **pack_pybi_kwargs) -> pybi path
+    def pack(files, symlinks=None, name="test.pybi", **kwargs):
+        base_path = make_tree(tmp_path / f"{name}.tree", files, symlinks)
+        pybi_path = tmp_path / name
+        pack_pybi(base_path, pybi_path, "bin", **kwargs)
+        return pybi_path
+
+    return pack
+
+
+def write_pybi(pybi_path, files, symlinks=None, *, tag=PLATFORM_TAG):
+    # Writes a pybi by hand, without any of pack_pybi's checks, so tests can make
+    # archives that pack_pybi would refuse to. Returns pybi_path.
+    members = {
+        "pybi-info/PYBI": f"Pybi-Version: 1.0\nTag: {tag}\n".encode("ascii"),
+        "pybi-info/METADATA": b"Metadata-Version: 2.2\nName: cpython\n",
+        **files,
+    }
+    records = []
+    with zipfile.ZipFile(pybi_path, "w", compression=zipfile.ZIP_DEFLATED) as z:
+        for name, data in members.items():
+            z.writestr(name, data)
+            digest = hashlib.sha256(data).digest()
+            records.append((name, record_hash(digest), len(data)))
+        for name, target in (symlinks or {}).items():
+            zi = zipfile.ZipInfo(name)
+            zi.external_attr = (SYMLINK_MODE | 0o644) << MODE_SHIFT
+            z.writestr(zi, target)
+            records.append((name, f"symlink={target}", ""))
+        records.append((RECORD_NAME, "", ""))
+        record = "".join(f"{name},{hash},{size}\n" for (name, hash, size) in records)
+        z.writestr(RECORD_NAME, record)
+    return pybi_path
@@ -0,0 +1,40 @@
+from pybi import (
+    claim_path_for,
+    claim_pybi_path,
+    release_pybi_claim,
+    remove_stale_claims,
+    state_path_for,
+)
+
+ARGS = ("cpython_unofficial", "3.9.6", "manylinux_2_17_x86_64")
+
+
+def test_concurrent_claims_get_different_build_numbers(tmp_path):
+    out_dir_path = tmp_path / "built"
+    first = claim_pybi_path(out_dir_path, *ARGS)
+    second = claim_pybi_path(out_dir_path, *ARGS)
+    try:
+        assert (first[0], second[0]) == (0, 1)
+        assert claim_path_for(first[1]).parent.parent == tmp_path / "built-state"
+        # Held claims aren't stale
+        assert remove_stale_claims(out_dir_path) == 0
+    finally:
+        release_pybi_claim(first[1])
+        release_pybi_claim(second[1])
+    assert not any((state_path_for(out_dir_path) / "claims").iterdir())
+
+
+def test_claim_left_by_dead_build_is_taken_over(tmp_path):
+    out_dir_path = tmp_path / "built"
+    _, pybi_path = claim_pybi_path(out_dir_path, *ARGS)
+    release_pybi_claim(pybi_path)
+    # What a killed build leaves behind: the file, but nobody holding its lock
+    claim_path = claim_path_for(pybi_path)
+    claim_path.write_text("other-host 1234\n")
+
+    assert claim_pybi_path(out_dir_path, *ARGS) == (0, pybi_path)
+    release_pybi_claim(pybi_path)
+
+    claim_path.write_text("other-host 1234\n")
+    assert remove_stale_claims(out_dir_path) == 1
+    assert not claim_path.exists()
@@ -0,0 +1,51 @@
+import json
+import random
+import zipfile
+
+import pytest
+
+from delta import DELTA_INFO_NAME, apply_delta, make_all_deltas
+from pybi import unpack_pybi
+
+
+def tree_contents(path):
+    return {
+        p.relative_to(path).as_posix(): (p.read_bytes(), p.stat().st_mode & 0o777)
+        for p in sorted(path.rglob("*"))
+        if p.is_file()
+    }
+
+
+def test_round_trip_with_small_binary_diff_min_size(tmp_path, pack):
+    pytest.importorskip("bsdiff4")
+    rng = random.Random(0)
+    library = bytes(rng.getrandbits(8) for _ in range(64 * 1024))
+    source_files = {
+        f"lib/python3.9/module_{i:04}.py": f"value = {i}\n".encode() for i in range(300)
+    }
+    source_files["lib/libpython3.9.so"] = library
+    target_files = dict(source_files)
+    target_files["lib/python3.9/module_0001.py"] = b"value = 'changed'\n"
+    del target_files["lib/python3.9/module_0002.py"]
+    target_files["lib/python3.9/new_module.py"] = b"new = True\n"
+    target_files["lib/libpython3.9.so"] = library[:1000] + b"patched" + library[1007:]
+
+    built_path = tmp_path / "built"
+    built_path.mkdir()
+    source = pack(source_files, name="cpython-3.9.5-manylinux_2_17_x86_64.pybi")
+    target = pack(target_files, name="cpython-3.9.6-manylinux_2_17_x86_64.pybi")
+    source = source.rename(built_path / source.name)
+    target = target.rename(built_path / target.name)
+
+    # Small enough that the target RECORD would be worth patching
+    [delta_path] = make_all_deltas(built_path, binary_diff_min_size=1000)
+    with zipfile.ZipFile(delta_path) as z:
+        delta_info = json.loads(z.read(DELTA_INFO_NAME))
+        assert "files/pybi-info/RECORD" in z.namelist()
+    assert list(delta_info["patched"]) == ["lib/libpython3.9.so"]
+    assert delta_info["removed"] == ["lib/python3.9/module_0002.py"]
+
+    unpack_pybi(source, tmp_path / "source")
+    unpack_pybi(target, tmp_path / "expected")
+    apply_delta(tmp_path / "source", delta_path, tmp_path / "applied")
+    assert tree_contents(tmp_path / "applied") == tree_contents(tmp_path / "expected")
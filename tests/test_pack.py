@@ -0,0 +1,128 @@
+import hashlib
+import io
+import random
+import zipfile
+
+import pytest
+
+import pybi
+from pybi import (
+    MODE_SHIFT,
+    CompressionPolicy,
+    DigestWriter,
+    deflate_chunks,
+    store_chunks,
+    write_compressed,
+    write_recompressed,
+)
+
+rng = random.Random(0)
+FILES = {
+    "lib/python3.9/ensurepip/_bundled/pip-21.1.3-py3-none-any.whl": b"PK" * 4096,
+    "lib/python3.9/module.py": b"x = 1\n" * 1000,
+    "lib/python3.9/random.bin": bytes(rng.getrandbits(8) for _ in range(64 * 1024)),
+}
+
+
+def compress_types(pybi_path):
+    with zipfile.ZipFile(pybi_path) as z:
+        return {zi.filename: zi.compress_type for zi in z.infolist()}
+
+
+def test_default_deflates_everything(pack):
+    # No policy means the behavior from before CompressionPolicy: every member
+    # deflated, whatever it contains
+    types = compress_types(pack(FILES))
+    assert set(types.values()) == {zipfile.ZIP_DEFLATED}
+
+
+def test_compression_policy_is_opt_in(pack):
+    types = compress_types(pack(FILES, policy=CompressionPolicy()))
+    assert types["lib/python3.9/ensurepip/_bundled/pip-21.1.3-py3-none-any.whl"] == (
+        zipfile.ZIP_STORED
+    )
+    assert types["lib/python3.9/random.bin"] == zipfile.ZIP_STORED
+    assert types["lib/python3.9/module.py"] == zipfile.ZIP_DEFLATED
+
+
+class Unseekable(io.RawIOBase):
+    # Like a pipe: write-only, no tell() or seek()
+    def __init__(self):
+        self.data = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.data += data
+        return len(data)
+
+
+def precompressed_member(name, data, compress_type):
+    zi = zipfile.ZipInfo(name)
+    zi.external_attr = 0o644 << MODE_SHIFT
+    zi.compress_type = compress_type
+    compressed = io.BytesIO()
+    if compress_type == zipfile.ZIP_DEFLATED:
+        _, zi.file_size, zi.CRC = deflate_chunks([data], compressed)
+    else:
+        _, zi.file_size, zi.CRC = store_chunks([data], compressed)
+    zi.compress_size = compressed.tell()
+    compressed.seek(0)
+    return zi, compressed
+
+
+@pytest.mark.parametrize("write", [write_compressed, write_recompressed])
+@pytest.mark.parametrize("output", ["seekable", "unseekable", "digest-writer"])
+@pytest.mark.parametrize("zip64", [False, True], ids=["zip32", "zip64"])
+def test_write_compressed_round_trip(monkeypatch, write, output, zip64):
+    if zip64:
+        # Small enough that every member needs zip64 sizes, without writing 4 GiB
+        monkeypatch.setattr(zipfile, "ZIP64_LIMIT", 1000)
+    members = {
+        "deflated.py": (b"x = 1\n" * 1000, zipfile.ZIP_DEFLATED),
+        "stored.pyc": (bytes(range(256)) * 20, zipfile.ZIP_STORED),
+    }
+    if output == "seekable":
+        out = io.BytesIO()
+    elif output == "unseekable":
+        out = Unseekable()
+    else:
+        out = DigestWriter(io.BytesIO())
+    with zipfile.ZipFile(out, "w", allowZip64=True) as z:
+        for name, (data, compress_type) in members.items():
+            write(z, *precompressed_member(name, data, compress_type))
+
+    if output == "seekable":
+        archive = out.getvalue()
+    elif output == "unseekable":
+        archive = bytes(out.data)
+    else:
+        archive = out._f.getvalue()
+        assert out.digest().sha256 == hashlib.sha256(archive).hexdigest()
+    with zipfile.ZipFile(io.BytesIO(archive)) as z:
+        assert z.testzip() is None
+        for name, (data, compress_type) in members.items():
+            zi = z.getinfo(name)
+            assert z.read(name) == data
+            assert zi.compress_type == compress_type
+            # zip64 extra field
+            assert (zi.extra[:2] == b"\x01\x00") == zip64
+
+
+def test_write_compressed_falls_back_to_public_api(monkeypatch):
+    monkeypatch.setattr(pybi, "ZIPFILE_INTERNALS", [*pybi.ZIPFILE_INTERNALS, "_gone"])
+    calls = []
+
+    def spy(*args):
+        calls.append(args[1].filename)
+        write_recompressed(*args)
+
+    monkeypatch.setattr(pybi, "write_recompressed", spy)
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, "w") as z:
+        zi, compressed = precompressed_member("a.py", b"a = 1\n", zipfile.ZIP_DEFLATED)
+        write_compressed(z, zi, compressed)
+    assert calls == ["a.py"]
+    with zipfile.ZipFile(out) as z:
+        assert z.read("a.py") == b"a = 1\n"
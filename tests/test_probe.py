@@ -0,0 +1,16 @@
+from pybi import interpreter_fingerprint_paths
+
+
+def test_fingerprint_includes_sysconfigdata(tmp_path):
+    python_path = tmp_path / "bin" / "python3.9"
+    sysconfigdata_path = (
+        tmp_path / "lib" / "python3.9" / "_sysconfigdata__linux_x86_64-linux-gnu.py"
+    )
+    for path in [python_path, tmp_path / "lib" / "libpython3.9.so", sysconfigdata_path]:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"")
+    (tmp_path / "lib" / "python3.9" / "sysconfig.py").write_bytes(b"")
+
+    paths = interpreter_fingerprint_paths(tmp_path, python_path)
+    assert sysconfigdata_path.resolve() in paths
+    assert len(paths) == 3
@@ -0,0 +1,79 @@
+import json
+import zipfile
+
+from pybi import RUN_IN_PLACE_NAME, TAIL_FETCH_SIZE, FileRangeSource, read_pybi_info
+
+PATHS = {"stdlib": "lib/python3.9", "purelib": "lib/python3.9/site-packages"}
+METADATA = (
+    "Metadata-Version: 2.2\nName: cpython\nVersion: 3.9.5\n"
+    f"Pybi-Paths: {json.dumps(PATHS)}\n"
+).encode("ascii")
+
+
+def test_skips_run_in_place_table(pack):
+    files = {
+        f"lib/python3.9/module_{i:04}.py": f"value = {i}\n".encode() for i in range(300)
+    }
+    files["pybi-info/METADATA"] = METADATA
+    pybi_path = pack(files, run_in_place=[])
+    with zipfile.ZipFile(pybi_path) as z:
+        table_zi = z.getinfo(RUN_IN_PLACE_NAME)
+
+    info = read_pybi_info(pybi_path, tail_size=512)
+    assert info.metadata["Name"] == "cpython"
+    assert RUN_IN_PLACE_NAME not in info.files
+    # Everything fetched comes after the table
+    table_end = table_zi.header_offset + table_zi.compress_size
+    assert info.bytes_fetched <= pybi_path.stat().st_size - table_end
+
+
+class CountingSource(FileRangeSource):
+    def __init__(self, path):
+        super().__init__(path)
+        self.requests = []
+
+    def read_tail(self, length):
+        self.requests.append(("tail", length))
+        return super().read_tail(length)
+
+    def read_range(self, start, end):
+        self.requests.append(("range", end - start))
+        return super().read_range(start, end)
+
+
+def test_small_tail_fetch(pack):
+    files = {
+        f"lib/python3.9/module_{i:04}.py": f"value = {i}\n".encode() for i in range(300)
+    }
+    pybi_path = pack(files)
+    source = CountingSource(pybi_path)
+    info = read_pybi_info(source)
+    assert info.metadata["Name"] == "cpython"
+    assert source.requests[0] == ("tail", TAIL_FETCH_SIZE)
+    assert info.round_trips == len(source.requests) <= 3
+
+
+def test_long_archive_comment(pack):
+    pybi_path = pack({"lib/python3.9/os.py": b""})
+    with zipfile.ZipFile(pybi_path, "a") as z:
+        z.comment = b"x" * (2 * TAIL_FETCH_SIZE)
+    info = read_pybi_info(pybi_path)
+    assert info.metadata["Name"] == "cpython"
+    assert info.round_trips == 2
+
+
+def test_zip64(pack, monkeypatch):
+    # Small enough that the archive needs a zip64 EOCD, and zip64 extra fields
+    monkeypatch.setattr(zipfile, "ZIP64_LIMIT", 1000)
+    files = {f"lib/python3.9/module_{i}.py": b"x = 1\n" * 1000 for i in range(5)}
+    pybi_path = pack(files)
+    assert b"PK\x06\x07" in pybi_path.read_bytes()[-200:]
+    # Cuts the zip64 locator off
+    info = read_pybi_info(pybi_path, tail_size=30)
+    assert info.metadata["Name"] == "cpython"
+    assert [row[0] for row in info.record] == [
+        "pybi-info/RECORD",
+        *sorted(files),
+        "pybi-info/METADATA",
+        "pybi-info/PYBI",
+    ]
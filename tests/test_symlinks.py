@@ -0,0 +1,51 @@
+import pytest
+
+from conftest import write_pybi
+from pybi import unpack_pybi, verify_pybi
+
+BAD_ARCHIVES = {
+    "member under a symlinked directory": (
+        {"lib/real/module.py": b"x = 1\n", "lib/link/evil.py": b"x = 2\n"},
+        {"lib/link": "real"},
+    ),
+    "link under a symlinked directory": (
+        {},
+        {"lib/A": ".", "lib/A/B": "../../escape"},
+    ),
+    "chain that escapes": (
+        {},
+        {"lib/up": "..", "lib/x": "up/../.."},
+    ),
+    "loop": (
+        {},
+        {"lib/a": "b", "lib/b": "a"},
+    ),
+    "absolute": (
+        {},
+        {"lib/abs": "/etc"},
+    ),
+}
+
+
+@pytest.mark.parametrize("files, symlinks", BAD_ARCHIVES.values(), ids=BAD_ARCHIVES)
+def test_verify_and_unpack_agree_on_bad_symlinks(tmp_path, files, symlinks):
+    pybi_path = write_pybi(tmp_path / "test.pybi", files, symlinks)
+    _, problems = verify_pybi(pybi_path)
+    assert problems
+    with pytest.raises(RuntimeError, match="refusing to unpack"):
+        unpack_pybi(pybi_path, tmp_path / "dest")
+
+
+def test_good_symlinks(tmp_path):
+    pybi_path = write_pybi(
+        tmp_path / "test.pybi",
+        {"bin/python3.9": b"\x7fELF", "lib/python3.9/os.py": b""},
+        {
+            "bin/python3": "python3.9",
+            "lib/python": "python3.9",
+            "lib/os.py": "python/os.py",
+        },
+    )
+    assert verify_pybi(pybi_path)[1] == []
+    assert unpack_pybi(pybi_path, tmp_path / "dest") == (5, 3)
+    assert (tmp_path / "dest" / "lib" / "os.py").read_bytes() == b""
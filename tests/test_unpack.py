@@ -0,0 +1,41 @@
+import zipfile
+import zlib
+
+import pytest
+
+from pybi import LOCAL_HEADER_STRUCT, unpack_pybi
+
+MODULE_NAME = "lib/python3.9/module.py"
+
+
+def corrupt_member(pybi_path, name):
+    # Overwrites the start of a deflated member's payload with an invalid block type
+    with zipfile.ZipFile(pybi_path) as z:
+        zi = z.getinfo(name)
+    assert zi.compress_type == zipfile.ZIP_DEFLATED
+    with open(pybi_path, "r+b") as f:
+        f.seek(zi.header_offset)
+        header = LOCAL_HEADER_STRUCT.unpack(f.read(LOCAL_HEADER_STRUCT.size))
+        name_len, extra_len = header[-2:]
+        f.seek(name_len + extra_len, 1)
+        f.write(b"\xff" * 16)
+
+
+def test_corrupt_member_raises_underlying_error(tmp_path, pack):
+    pybi_path = pack({MODULE_NAME: b"x = 1\n" * 10000})
+    corrupt_member(pybi_path, MODULE_NAME)
+    dest_path = tmp_path / "dest"
+    # Not a BufferError from closing the memory map while the traceback still holds
+    # slices of it
+    with pytest.raises(zlib.error):
+        unpack_pybi(pybi_path, dest_path)
+    assert not (dest_path / MODULE_NAME).exists()
+
+
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_unpack(tmp_path, pack, jobs):
+    files = {f"lib/python3.9/module_{i}.py": f"x = {i}\n".encode() for i in range(20)}
+    pybi_path = pack(files)
+    assert unpack_pybi(pybi_path, tmp_path / "dest", jobs=jobs) == (len(files) + 3, 0)
+    for name, data in files.items():
+        assert (tmp_path / "dest" / name).read_bytes() == data
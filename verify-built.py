@@ -0,0 +1,232 @@
+# Pre-upload check of built/: run this after regen-simple.py and before syncing built/
+# up to the server. It checks that
+#
+#   - every pybi matches its RECORD (hashes, sizes and CRCs of every member), and its
+#     symlinks follow the rules pack_pybi enforces; see pybi.verify_pybi
+#   - every pybi's .digest.json sidecar from make_pybi, if it's current, matches it
+#   - every delta is a readable zip whose CRCs all check out
+#   - the index pages (index.html, index.json, deltas.json) list exactly the archives
+#     that are in built/, with the right sha256s, and every pybi's .metadata sidecar
+#     matches both the index and the METADATA inside the pybi
+#   - no build bookkeeping was left in built/ (it belongs in built-state/; see
+#     pybi.state_path_for)
+#
+# Archives are checked in parallel, streamed out of memory maps without extracting
+# anything. Archives that pass are recorded in a manifest; with --changed, archives
+# whose size/mtime/inode haven't changed since they last passed are trusted (their
+# recorded sha256 is still checked against the index), so a nightly run only has to
+# read the new ones.
+#
+#   python3 verify-built.py [--changed]
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+import zipfile
+from pathlib import Path
+
+from pybi import (
+    digest_path_for,
+    file_key,
+    is_delta,
+    metadata_path,
+    ordered_map,
+    read_chunks,
+    read_digest,
+    read_pybi_metadata,
+    verify_pybi,
+)
+
+# Kept outside built/, so it doesn't get synced up to the server
+DEFAULT_MANIFEST_PATH = Path("verify-manifest.json")
+
+INDEX_HTML_LINK_RE = re.compile(
+    r'<a href="/(?P<name>[^"#]+)#sha256=(?P<sha256>[0-9a-f]+)" '
+    r'data-core-metadata="sha256=(?P<metadata_sha256>[0-9a-f]+)"'
+)
+
+
+def verify_delta(delta_path):
+    # Returns (sha256 hex digest, list of problems)
+    hasher = hashlib.new("sha256")
+    with open(delta_path, "rb") as f:
+        for chunk in read_chunks(f):
+            hasher.update(chunk)
+    try:
+        with zipfile.ZipFile(delta_path) as z:
+            bad_member = z.testzip()
+    except zipfile.BadZipFile as exc:
+        return hasher.hexdigest(), [f"not a valid zip file: {exc}"]
+    if bad_member is not None:
+        return hasher.hexdigest(), [f"{bad_member}: bad CRC"]
+    return hasher.hexdigest(), []
+
+
+def verify_archive(path):
+    # Returns (sha256 hex digest, list of problems)
+    if is_delta(path):
+        return verify_delta(path)
+    sha256, problems = verify_pybi(path)
+    # regen-simple.py trusts this instead of hashing the pybi itself
+    digest = read_digest(path)
+    if digest is not None and digest.sha256 != sha256:
+        problems.append(f"{digest_path_for(path).name} doesn't match the pybi")
+    if not problems:
+        sidecar_path = metadata_path(path)
+        if not sidecar_path.exists():
+            problems.append(f"{sidecar_path.name} is missing (rerun regen-simple.py)")
+        elif sidecar_path.read_bytes() != read_pybi_metadata(path):
+            problems.append(f"{sidecar_path.name} doesn't match pybi-info/METADATA")
+    return sha256, problems
+
+
+def load_index(built_path):
+    # Returns {index file name: {archive name: {"sha256": ..., maybe
+    # "metadata_sha256": ...}}}, for each of the index files regen-simple.py writes
+    project_path = built_path / "cpython-unofficial"
+    indexes = {}
+
+    html_path = project_path / "index.html"
+    if html_path.exists():
+        indexes["index.html"] = {
+            match["name"]: {
+                "sha256": match["sha256"],
+                "metadata_sha256": match["metadata_sha256"],
+            }
+            for match in INDEX_HTML_LINK_RE.finditer(html_path.read_text())
+        }
+
+    json_path = project_path / "index.json"
+    if json_path.exists():
+        indexes["index.json"] = {
+            f["filename"]: {
+                "sha256": f["hashes"]["sha256"],
+                "metadata_sha256": f["core-metadata"]["sha256"],
+            }
+            for f in json.loads(json_path.read_text())["files"]
+        }
+
+    deltas_path = project_path / "deltas.json"
+    if deltas_path.exists():
+        indexes["deltas.json"] = {
+            d["filename"]: {"sha256": d["hashes"]["sha256"]}
+            for d in json.loads(deltas_path.read_text())["deltas"]
+        }
+    return indexes
+
+
+def check_index(built_path, hashes):
+    # hashes is {archive name: sha256}, for everything in built/. Returns a list of
+    # problems.
+    problems = []
+    indexes = load_index(built_path)
+    for index_name in ["index.html", "index.json", "deltas.json"]:
+        if index_name not in indexes:
+            problems.append(f"{index_name} is missing (rerun regen-simple.py)")
+    for index_name, index in indexes.items():
+        wants_deltas = index_name == "deltas.json"
+        for name, sha256 in hashes.items():
+            if name.endswith(".pybi-delta") != wants_deltas:
+                continue
+            entry = index.get(name)
+            if entry is None:
+                problems.append(f"{name}: not in {index_name} (rerun regen-simple.py)")
+                continue
+            if entry["sha256"] != sha256:
+                problems.append(f"{name}: sha256 in {index_name} is stale")
+            if "metadata_sha256" in entry:
+                sidecar_path = metadata_path(built_path / name)
+                if sidecar_path.exists():
+                    with open(sidecar_path, "rb") as f:
+                        metadata_sha256 = hashlib.sha256(f.read()).hexdigest()
+                    if entry["metadata_sha256"] != metadata_sha256:
+                        problems.append(
+                            f"{name}: metadata sha256 in {index_name} is stale"
+                        )
+        for name in sorted(index.keys() - hashes.keys()):
+            problems.append(f"{name}: listed in {index_name}, but not in built/")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="verify-built.py")
+    parser.add_argument("built", nargs="?", default="built")
+    parser.add_argument(
+        "--changed",
+        action="store_true",
+        help="only read archives that changed since they last passed",
+    )
+    parser.add_argument("--manifest", default=DEFAULT_MANIFEST_PATH, type=Path)
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    built_path = Path(args.built)
+    try:
+        old_manifest = json.loads(args.manifest.read_text())
+    except FileNotFoundError:
+        old_manifest = {}
+
+    manifest = {}
+    hashes = {}
+    to_verify = []
+    paths = sorted([*built_path.glob("*.pybi"), *built_path.glob("*.pybi-delta")])
+    for path in paths:
+        key = file_key(path.stat())
+        old_entry = old_manifest.get(path.name)
+        if (
+            args.changed
+            and old_entry is not None
+            and all(old_entry[k] == v for (k, v) in key.items())
+        ):
+            manifest[path.name] = old_entry
+            hashes[path.name] = old_entry["sha256"]
+        else:
+            to_verify.append((path, key))
+
+    def verify_one(item):
+        path, key = item
+        sha256, problems = verify_archive(path)
+        return path.name, key, sha256, problems
+
+    problem_count = 0
+    # One archive per thread: hashing and inflating both release the GIL, and whole
+    # archives balance out better than members of a single one
+    for name, key, sha256, problems in ordered_map(verify_one, to_verify, args.jobs):
+        hashes[name] = sha256
+        for problem in problems:
+            print(f"{name}: {problem}")
+        problem_count += len(problems)
+        if not problems:
+            manifest[name] = {**key, "sha256": sha256}
+
+    for problem in check_index(built_path, hashes):
+        print(problem)
+        problem_count += 1
+    # Older builds wrote their bookkeeping into built/, where it would get synced
+    for path in sorted(
+        [
+            *built_path.glob("*.pybi.digest.json"),
+            *built_path.glob(".*.pybi.claim"),
+            *built_path.glob(".build-matrix.json"),
+        ]
+    ):
+        print(f"{path.name}: build bookkeeping in built/ (delete it before syncing)")
+        problem_count += 1
+
+    temp_path = args.manifest.with_name(args.manifest.name + ".tmp")
+    temp_path.write_text(json.dumps(manifest, indent=1, sort_keys=True))
+    os.replace(temp_path, args.manifest)
+
+    print(
+        f"Verified {len(to_verify)} archives ({len(paths) - len(to_verify)} unchanged "
+        f"since they last passed), {problem_count} problems"
+    )
+    if problem_count:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()